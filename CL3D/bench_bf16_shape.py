@@ -0,0 +1,138 @@
+########### Compare bfloat16 autocast against float32 on a checkpoint: throughput, IoU and Chamfer distance
+import torch
+import numpy as np
+import os
+import time
+import argparse
+import config_shape as config
+import utils_shape as utils
+from dataloader_shape import Dataset
+from dataloader_packed import Dataset as Dataset_Packed
+from model_shape import SDFNet
+
+parser = argparse.ArgumentParser(description="bf16 autocast report")
+parser.add_argument("--exposure", default=0, type=int,
+                    help="Learning exposure whose best model is loaded, test data of "
+                    "all classes seen up to it is used")
+parser.add_argument("--checkpoint", default=None, type=str,
+                    help="Model state dict to load instead of the best model of --exposure")
+parser.add_argument("--num_batches", default=10, type=int,
+                    help="Number of test batches for throughput and IoU")
+parser.add_argument("--num_meshes", default=4, type=int,
+                    help="Number of objects whose meshes are generated for Chamfer "
+                    "distance, sdf only")
+
+def load_batches(dataset, num_batches):
+    '''
+    First batches of the test split, loaded once so that both precisions
+    see the same samples
+    '''
+    loader = torch.utils.data.DataLoader(dataset, \
+        batch_size=config.training['batch_size_eval'], num_workers=4)
+    batches = []
+    for i, batch in enumerate(loader):
+        if i == num_batches:
+            break
+        batches.append(batch)
+    return batches
+
+def run_forward(model, batches, device, shape_rep, bf16):
+    '''
+    Forward passes over the batches
+    returns:
+        samples per second and mean IoU
+    '''
+    ious = []
+    num_samples = 0
+    elapsed = 0.
+    with torch.no_grad():
+        for i, batch in enumerate(batches):
+            img_input, points_input, values = batch[:3]
+            img_input, points_input = img_input.to(device), points_input.to(device)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            with utils.get_autocast(device, bf16):
+                logits = model(points_input, img_input)
+            logits = logits.float()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            # The first batch warms up
+            if i != 0 or len(batches) == 1:
+                elapsed += time.time()-start
+                num_samples += len(img_input)
+            logits = logits.cpu().numpy()
+            if shape_rep == 'occ':
+                ious.append(utils.compute_iou(1./(1.+np.exp(-logits)), values.numpy()))
+            else:
+                ious.append(utils.compute_acc(logits, values.numpy())[2])
+    return num_samples/elapsed, np.mean(ious)
+
+def run_meshes(model, batches, device, num_meshes, bf16):
+    '''
+    Chamfer distances of meshes generated for the first num_meshes objects
+    '''
+    cds = []
+    for batch in batches:
+        img_input, points_input, values, pointclouds, normals = batch[:5]
+        for i in range(len(img_input)):
+            if len(cds) == num_meshes:
+                return cds
+            img = img_input[i:i+1].to(device)
+            mesh = utils.generate_mesh_mise_sdf(img, None, model, \
+                box_size=config.testing['box_size'], upsampling_steps=2, \
+                resolution=64, bf16=bf16)
+            out_dict = utils.eval_mesh(mesh, pointclouds[i:i+1].clone(), \
+                normals[i:i+1].clone(), points_input[i:i+1], values[i:i+1], \
+                shape_rep='sdf')
+            cds.append(out_dict['cd'])
+    return cds
+
+def main():
+    args = parser.parse_args()
+    out_dir = config.training['out_dir']
+    shape_rep = config.training['shape_rep']
+    pointcloud = config.training['pointcloud']
+    device = torch.device(config.training['device'])
+
+    if config.path['packed_dataset_path'] is not None:
+        dataset_cls = Dataset_Packed
+    else:
+        dataset_cls = Dataset
+    if pointcloud:
+        raise Exception("Only SDFNet with image inputs is supported")
+    dataset = dataset_cls(config, num_points=config.training['num_points'], \
+        mode='test', shape_rep=shape_rep, coord_system=config.training['coord_system'])
+    all_classes = np.load(os.path.join(out_dir, 'train.npz'), allow_pickle=True)['perm']
+    classes = list(set(all_classes[:args.exposure+1].reshape(-1)))
+    dataset.update_class_map({cls: i for i, cls in enumerate(sorted(classes))})
+    dataset.activate_classes(classes)
+    batches = load_batches(dataset, args.num_batches)
+
+    checkpoint = args.checkpoint
+    if checkpoint is None:
+        checkpoint = os.path.join(out_dir, 'best_model_iou_train-%s.pth.tar'%(args.exposure) \
+            if shape_rep == 'sdf' else 'best_model_train-%s.pth.tar'%(args.exposure))
+    model = SDFNet(config)
+    model.load_state_dict(torch.load(checkpoint, map_location=device))
+    model = model.to(device)
+    model.eval()
+    print('Checkpoint %s, %s test batches on %s'%(checkpoint, len(batches), device))
+
+    results = {}
+    for name, bf16 in [('fp32', False), ('bf16', True)]:
+        throughput, iou = run_forward(model, batches, device, shape_rep, bf16)
+        cds = []
+        if shape_rep == 'sdf' and args.num_meshes > 0:
+            cds = run_meshes(model, batches, device, args.num_meshes, bf16)
+        results[name] = (throughput, iou, np.mean(cds) if len(cds) != 0 else np.nan)
+
+    print('%6s %14s %10s %10s'%('', 'samples/s', 'IoU', 'Chamfer'))
+    for name in ['fp32', 'bf16']:
+        print('%6s %14.2f %10.4f %10.5f'%((name,)+results[name]))
+    fp32, bf16 = results['fp32'], results['bf16']
+    print('%6s %13.2fx %+10.4f %+10.5f'%('delta', bf16[0]/fp32[0], \
+        bf16[1]-fp32[1], bf16[2]-fp32[2]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+########### Report training step memory and throughput over point budgets, with and without activation checkpointing
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import numpy as np
+import time
+import argparse
+import multiprocessing
+import config_shape as config
+import utils_shape as utils
+from model_shape import SDFNet
+from model_pointcloud import PointCloudNet
+
+parser = argparse.ArgumentParser(description="Training memory report")
+parser.add_argument("--num_points", default=[2048, 4096, 8192, 16384], type=int, nargs='+',
+                    help="Numbers of points per sample to measure")
+parser.add_argument("--batch_size", default=None, type=int,
+                    help="Batch size, batch_size of config_shape.py by default")
+parser.add_argument("--num_steps", default=3, type=int,
+                    help="Number of training steps, the first one is not timed")
+parser.add_argument("--memory_budget", default=None, type=float,
+                    help="Memory budget in MB, the largest measured point budget "
+                    "fitting in it is reported")
+
+def reset_peak_memory(device):
+    '''
+    Reset the peak memory, the peak resident set of the process on CPU
+    (Linux>=4.0)
+    returns:
+        memory in use in bytes, from which the peak is measured
+    '''
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+        return torch.cuda.memory_allocated(device)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return get_status_bytes('VmRSS')
+
+def get_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated(device)
+    return get_status_bytes('VmHWM')
+
+def get_status_bytes(key):
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(key+':'):
+                return int(line.split()[1])*1024
+    raise Exception("%s not in /proc/self/status"%(key))
+
+def measure(num_points, batch_size, checkpoint_blocks, device, num_steps):
+    '''
+    Train a freshly initialized model on random inputs
+    returns:
+        peak memory of training above the memory in use before the first
+        step in bytes, including gradients and optimizer state, and
+        training steps per second
+    '''
+    config.training['checkpoint_blocks'] = checkpoint_blocks
+    torch.manual_seed(0)
+    if config.training['pointcloud']:
+        model = PointCloudNet(config)
+        inputs = torch.randn(batch_size, num_points, 3)
+    else:
+        model = SDFNet(config)
+        channels = 3 if config.path['input_image_path'] is not None else 4
+        size = config.data_setting['input_size']
+        inputs = torch.randn(batch_size, channels, size, size)
+    model = model.to(device)
+    model.train()
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    if config.training['shape_rep'] == 'occ':
+        criterion = nn.BCEWithLogitsLoss()
+    else:
+        criterion = utils.LpLoss
+    inputs = inputs.to(device)
+    points = torch.rand(batch_size, num_points, 3, device=device)-0.5
+    values = (torch.rand(batch_size, num_points, device=device)-0.5)*0.1
+    if config.training['shape_rep'] == 'occ':
+        values = (values <= 0.003).float()
+
+    def step():
+        optimizer.zero_grad()
+        loss = criterion(model(points, inputs), values)
+        loss.backward()
+        optimizer.step()
+
+    base = reset_peak_memory(device)
+    step()
+    start = time.time()
+    for _ in range(num_steps-1):
+        step()
+    steps = (num_steps-1)/(time.time()-start) if num_steps > 1 else np.nan
+    return get_peak_memory(device)-base, steps
+
+def measure_process(queue, *args):
+    queue.put(measure(*args))
+
+def measure_in_process(*args):
+    '''
+    Run measure in a new process, so that memory freed by earlier
+    measurements and kept by the allocator is not reused
+    '''
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=measure_process, args=(queue,)+args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(config.training['device'])
+    batch_size = args.batch_size if args.batch_size is not None \
+        else config.training['batch_size']
+
+    mb = 1024.*1024.
+    print('Batch size %s on %s'%(batch_size, device))
+    print('%10s %12s %12s %12s %12s'%('points', 'checkpoint', 'peak', 'steps/s', 'points/s'))
+    fits = {False: None, True: None}
+    for num_points in args.num_points:
+        for checkpoint_blocks in [False, True]:
+            peak, steps = measure_in_process(num_points, batch_size, checkpoint_blocks, \
+                device, args.num_steps)
+            print('%10s %12s %10.1fMB %12.3f %12.0f'%(num_points, checkpoint_blocks, \
+                peak/mb, steps, steps*batch_size*num_points))
+            if args.memory_budget is not None and peak/mb <= args.memory_budget:
+                fits[checkpoint_blocks] = num_points
+    if args.memory_budget is not None:
+        for checkpoint_blocks in [False, True]:
+            print('Largest num_points within %.0fMB, checkpoint_blocks=%s: %s'\
+                %(args.memory_budget, checkpoint_blocks, fits[checkpoint_blocks]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+########### Background checkpoint writes with atomic rename and retention of periodic checkpoints
+import os
+import re
+import inspect
+import random
+import threading
+import collections
+import numpy as np
+import torch
+
+def to_cpu(obj):
+    '''
+    Copy of the tensors of a state dict, or of nested dicts and lists of
+    them, in CPU memory
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def get_rng_state():
+    '''
+    States of the python, numpy and torch random number generators of
+    the process
+    '''
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), \
+        'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    '''
+    Restore the states of get_rng_state
+    '''
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def load_checkpoint(path, map_location=None):
+    '''
+    torch.load of a checkpoint holding RNG states and metric arrays
+    besides tensors, which torch>=2.6 only loads without weights_only
+    '''
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+def find_periodic(out_dir, pattern=r'model-(\d+)-(\d+)\.pth\.tar$'):
+    '''
+    Periodic checkpoints already in out_dir, e.g. of a continued run,
+    oldest first. The last epoch of every exposure is left out, as the
+    checkpoint cont continues from
+    args:
+        out_dir: directory of the checkpoints
+        pattern: regular expression of the file names, with the exposure
+            and the epoch as groups
+    returns:
+        list of file names
+    '''
+    if not os.path.isdir(out_dir):
+        return []
+    files = {}
+    for name in os.listdir(out_dir):
+        match = re.match(pattern, name)
+        if match is not None:
+            files[name] = (int(match.group(1)), int(match.group(2)))
+    last_epochs = {}
+    for exposure, epoch in files.values():
+        last_epochs[exposure] = max(epoch, last_epochs.get(exposure, epoch))
+    return sorted([name for name, (exposure, epoch) in files.items() \
+        if epoch != last_epochs[exposure]], key=lambda name: files[name])
+
+def save_atomic(obj, path):
+    '''
+    torch.save to a temporary file renamed to path, so that path always
+    holds a complete checkpoint
+    '''
+    tmp_path = '%s.tmp'%(path)
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointManager(object):
+    '''
+    Writes checkpoints of the training loop. Objects are copied to CPU
+    memory on the calling thread, the only part on the critical path, and
+    written by a background thread. A checkpoint waiting to be written is
+    replaced by a newer one of the same file, and snapshots of the same
+    step are copied once. Periodic checkpoints beyond the keep_last most
+    recent are deleted, except the ones saved with keep; best models are
+    not periodic and are never deleted. Periodic checkpoints found in
+    out_dir by find_periodic count as the oldest ones
+    args:
+        out_dir: directory of the checkpoints
+        keep_last: number of periodic checkpoints kept, None keeps all
+        background: whether to write on a background thread
+    '''
+    def __init__(self, out_dir, keep_last=None, background=True):
+        self.out_dir = out_dir
+        self.keep_last = keep_last
+        self.background = background
+        # File name -> (object, periodic, keep), in order of first request
+        self.pending = collections.OrderedDict()
+        self.periodic = find_periodic(out_dir)
+        self.snapshots = {}
+        self.snapshot_step = None
+        self.error = None
+        self.writing = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def snapshot(self, obj, key, step):
+        '''
+        CPU copy of a state dict, copied once per key and step
+        args:
+            obj: state dict
+            key: name of the state, e.g. 'model'
+            step: identifier of the training step, e.g. (exposure, epoch)
+        '''
+        if step != self.snapshot_step:
+            self.snapshots = {}
+            self.snapshot_step = step
+        if key not in self.snapshots:
+            self.snapshots[key] = to_cpu(obj)
+        return self.snapshots[key]
+
+    def save(self, obj, name, periodic=False, keep=False):
+        '''
+        Write obj, of CPU tensors, to name in out_dir
+        args:
+            obj: object to save, see snapshot
+            name: file name
+            periodic: whether the checkpoint counts towards keep_last
+            keep: whether a periodic checkpoint is never deleted, e.g. the
+                last epoch of an exposure, from which training continues
+        '''
+        self.raise_error()
+        if not self.background:
+            self.write(name, obj, periodic, keep)
+            return
+        with self.condition:
+            # Only the newest checkpoint of a file is written
+            self.pending[name] = (obj, periodic, keep)
+            self.condition.notify_all()
+
+    def flush(self):
+        '''
+        Wait for all requested checkpoints to be written
+        '''
+        with self.condition:
+            while len(self.pending) != 0 or self.writing:
+                self.condition.wait()
+        self.raise_error()
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+            self.thread.join()
+            self.thread = None
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise Exception("Checkpoint write failed: %s"%(error))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    return
+                name, (obj, periodic, keep) = self.pending.popitem(last=False)
+                self.writing = True
+            try:
+                self.write(name, obj, periodic, keep)
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, name, obj, periodic, keep):
+        save_atomic(obj, os.path.join(self.out_dir, name))
+        if name in self.periodic:
+            self.periodic.remove(name)
+        if not periodic or keep:
+            return
+        self.periodic.append(name)
+        if self.keep_last is None:
+            return
+        while len(self.periodic) > self.keep_last:
+            try:
+                os.remove(os.path.join(self.out_dir, self.periodic.pop(0)))
+            except OSError:
+                pass
@@ -6,14 +6,44 @@ path = dict(
 		input_seg_path = 'segmentation',
 		src_pt_path = '/data/DevLearning/SDFNet_data/ShapeNet55_sdf',	
 		src_ptcl_path = '/data/DevLearning/SDFNet_data/ShapeNet_ptcl_55',
-		data_split_json_path = '/data/DevLearning/SDFNet_data/json_files/data_split_55.json'
+		data_split_json_path = '/data/DevLearning/SDFNet_data/json_files/data_split_55.json',
+		# Output of pack_shape.py. If not None, sdf samples, pointclouds
+		# and metadata are read from the packed shards
+		packed_dataset_path = None,
+		# Output of shard_shape.py. If not None, training data is streamed
+		# sequentially from tar shards, for network filesystems
+		stream_dataset_path = None,
+		# Directory of the cached index of the objects and view files of
+		# the data splits, None for a manifest directory in out_dir
+		manifest_dir = None
 		)
 data_setting = dict(
 		input_size = 224,
 		img_extension = 'png',
+		# Resize depth in float instead of quantizing it to uint8
+		lossless_depth = False,
 		random_view = True,
 		seq_len = 25,
-		categories = None
+		categories = None,
+		# Rotate points to the input view batch-wise at collate time
+		batch_rotate = False,
+		# Max number of sdf h5 files kept open by each loader worker
+		h5_pool_size = 64,
+		# Budget in bytes of the decoded sample cache in shared memory
+		# (/dev/shm), None to disable
+		shm_cache_budget = None,
+		# Number of views of an object drawn together in training, sharing
+		# one sdf read, a divisor of seq_len. None for one view per sample
+		views_per_object = None,
+		# Keep loader workers alive across epochs and exposures, they follow
+		# class changes through shared memory. All loaders keep their
+		# workers, so more processes are alive at once
+		persistent_workers = False,
+		# Read rate limit in bytes/s of the background prefetch of the next
+		# exposure's files into the page cache, None to disable
+		prefetch_rate = None,
+		# Number of views buffered for shuffling by the streaming dataset
+		shuffle_buffer = 1000
 		)
 training = dict(
 		out_dir = '/data/devlearning/model_output_incr/test_release',
@@ -22,6 +52,11 @@ training = dict(
 		num_epochs = 500,
 
 		save_model_step = 50,
+		# Number of model-<exposure>-<epoch> checkpoints kept besides the
+		# last epoch of every exposure, None to keep all of them
+		keep_checkpoints = None,
+		# Whether to write checkpoints on a background thread
+		async_checkpoints = True,
 		# Evaluated on val data of all seen classes after each exposure
 		eval_step = 500, 
 		verbose_step = 10,
@@ -35,6 +70,42 @@ training = dict(
 		pointcloud = False,
 		num_rep = 1,
 		nclass = 5,
+		# 'cuda' or 'cpu'. Run with torchrun --nproc_per_node=N for N
+		# DistributedDataParallel processes
+		device = 'cuda',
+		# Backend of distributed runs, gloo works on CPU and GPU, nccl on GPU
+		dist_backend = 'gloo',
+		# Run the networks in bfloat16 autocast for training, evaluation
+		# and mesh generation (torch>=1.10). BatchNorm and losses stay in
+		# float32
+		bf16 = False,
+		# Recompute the activations of the residual blocks of the decoder
+		# and pointcloud encoder in the backward pass instead of storing
+		# them, for larger batch_size or num_points in the same memory
+		checkpoint_blocks = False,
+		# Validate all seen classes in one pass over their data, with
+		# loss and metrics aggregated per class, instead of one pass per
+		# class
+		val_single_pass = True,
+		# Best models are selected on all samples of the training classes
+		# of every exposure, or with eval_subset_objects on a fixed subset
+		# of eval_subset_objects objects per class and eval_subset_views
+		# views per object, e.g. 32 and 2
+		eval_subset_objects = None,
+		eval_subset_views = 2,
+		# Number of bootstrap resamples and confidence level of the
+		# intervals of subset scores. The full set is evaluated when the
+		# interval of a candidate overlaps the one of the best model
+		eval_bootstrap = 1000,
+		eval_confidence = 0.95,
+		# Whether to end an exposure before num_epochs once the train IoU
+		# has not improved by more than plateau_min_delta for
+		# plateau_patience epochs, after at least plateau_min_epochs epochs.
+		# The IoU is evaluated every verbose_step epochs
+		plateau_stop = False,
+		plateau_min_epochs = 100,
+		plateau_patience = 50,
+		plateau_min_delta = 0.001,
 		)
 logging = dict(
 		log_dir = '/data/DevLearning/SDFNet_model_output/log',
@@ -0,0 +1,225 @@
+import numpy as np
+import os
+import torch
+import utils_shape as utils
+import quantize_shape as quantize
+import pack_shape
+
+from dataloader_shape import Dataset as Dataset_Incr
+
+class Dataset(Dataset_Incr):
+    '''
+    Dataset serving sdf samples, GT pointclouds, view metadata and
+    optionally decoded input tensors from the shards written by
+    pack_shape.py instead of per object files. Shards are memory mapped,
+    so an object is a slice of a few open files
+    '''
+    def __init__(self, config, num_points=-1, mode='train', shape_rep='sdf', \
+        coord_system='3dvc', iso=0.003, perm=None, all_classes=None, \
+        batch_rotate=False, views_per_object=None, image_only=False):
+        # The packed index is loaded by load_pose_table during
+        # initialization of the base Dataset
+        super().__init__(config, num_points, mode, shape_rep, coord_system, \
+            iso, perm, all_classes, batch_rotate, views_per_object, image_only)
+
+    def load_packed_index(self):
+        '''
+        Map objects of obj_cat_map to rows of the packed shards
+        '''
+        self.packed_dataset_path = self.config.path['packed_dataset_path']
+        self.packed_split_path = os.path.join(self.packed_dataset_path, self.mode)
+
+        index = np.load(os.path.join(self.packed_split_path, pack_shape.INDEX_FILE))
+        packed_rows = {(obj, cat): i for i, (obj, cat) in \
+            enumerate(zip(index['obj'].astype(str), index['cat'].astype(str)))}
+        missing = [oc for oc in self.obj_cat_map if oc not in packed_rows]
+        if len(missing) != 0:
+            raise Exception("%s objects are not in %s, please rerun pack_shape.py"\
+                %(len(missing), self.packed_split_path))
+        # Row in the packed shards of each object in obj_cat_map
+        self.packed_rows = np.asarray([packed_rows[oc] for oc in self.obj_cat_map], \
+            dtype=np.int64)
+        self.sdf_offsets = index['sdf_offsets']
+        self.ptcl_offsets = index['ptcl_offsets']
+
+        # Shards written with pack_shape.py --quantize
+        self.quantized = 'quantized' in index.files
+        if self.quantized:
+            self.coord_bound = float(index['coord_bound'])
+            self.sdf_encoding = str(index['sdf_encoding'])
+            self.sdf_log_eps = float(index['log_eps'])
+            self.sdf_log_max = float(index['log_max'])
+            self.packed_iso = float(index['iso'])
+            self.occ_offsets = index['occ_offsets']
+            self.sdf_shards = [pack_shape.SDF_COORDS_SHARD, pack_shape.SDF_VALUES_SHARD]
+            self.ptcl_shard = pack_shape.PTCL_Q_SHARD
+        else:
+            self.sdf_shards = [pack_shape.SDF_SHARD]
+            self.ptcl_shard = pack_shape.PTCL_SHARD
+
+        # Decoded input tensors are optional
+        self.packed_inputs = os.path.exists(\
+            os.path.join(self.packed_split_path, pack_shape.INPUT_SHARD))
+        if self.packed_inputs:
+            input_shape = np.load(os.path.join(self.packed_split_path, \
+                pack_shape.INPUT_SHARD), mmap_mode='r').shape
+            if input_shape[-1] != self.input_size or input_shape[1] < self.seq_len:
+                raise Exception("Packed inputs of %s do not match input_size and seq_len"\
+                    %(self.packed_split_path))
+
+        # Shards are opened lazily so that each worker maps its own copy
+        self.shards = None
+
+    def open_shards(self):
+        '''
+        Memory map all shards of the split
+        '''
+        # Assigned once complete, shards may be opened by a prefetch thread
+        shards = {}
+        names = self.sdf_shards+[self.ptcl_shard, \
+            pack_shape.META_SHARD, pack_shape.HVC_META_SHARD]
+        if self.quantized:
+            names.append(pack_shape.OCC_SHARD)
+        for name in names:
+            shards[name] = np.load(\
+                os.path.join(self.packed_split_path, name), mmap_mode='r')
+        if self.packed_inputs:
+            shards[pack_shape.INPUT_SHARD] = np.load(os.path.join(\
+                self.packed_split_path, pack_shape.INPUT_SHARD), mmap_mode='r')
+        self.shards = shards
+
+    def get_shard(self, name):
+        if self.shards is None:
+            self.open_shards()
+        return self.shards[name]
+
+    def get_shard_range(self, name, start, end):
+        '''
+        File range of rows start:end of a shard
+        '''
+        shard = self.get_shard(name)
+        row_size = shard.itemsize*int(np.prod(shard.shape[1:]))
+        return (os.path.join(self.packed_split_path, name), \
+            shard.offset+int(start)*row_size, (int(end)-int(start))*row_size)
+
+    def get_sdf_ranges(self, index):
+        row = self.packed_rows[index]
+        ranges = [self.get_shard_range(name, self.sdf_offsets[row], \
+            self.sdf_offsets[row+1]) for name in self.sdf_shards]
+        if self.use_packed_occ():
+            ranges.append(self.get_shard_range(pack_shape.OCC_SHARD, \
+                self.occ_offsets[row], self.occ_offsets[row+1]))
+        return ranges
+
+    def get_pointcloud_ranges(self, index):
+        row = self.packed_rows[index]
+        return [self.get_shard_range(self.ptcl_shard, \
+            self.ptcl_offsets[row], self.ptcl_offsets[row+1])]
+
+    def get_image_ranges(self, index):
+        if not self.packed_inputs:
+            return super().get_image_ranges(index)
+        row = self.packed_rows[index]
+        return [self.get_shard_range(pack_shape.INPUT_SHARD, row, row+1)]
+
+    def decode_image_data(self, index, img_idx):
+        if not self.packed_inputs:
+            return super().decode_image_data(index, img_idx)
+        # A single contiguous slice of the input shard
+        row = self.packed_rows[index]
+        return self.get_shard(pack_shape.INPUT_SHARD)[row, img_idx]\
+            .astype(np.float32)
+
+    def use_packed_occ(self):
+        '''
+        Whether occupancy is read from the bit-packed shard
+        '''
+        return self.quantized and self.shape_rep == 'occ' \
+            and self.iso == self.packed_iso
+
+    def sample_sdf_rows(self, index, num_points):
+        '''
+        Rows of the sdf samples of an object, drawn as in utils.sample_rows
+        returns:
+            row of the object in the shards and sample rows within the
+            object
+        '''
+        row = self.packed_rows[index]
+        count = int(self.sdf_offsets[row+1]-self.sdf_offsets[row])
+        if num_points != -1:
+            return row, torch.randint(count, size=(num_points,)).numpy()
+        return row, np.arange(count)
+
+    def load_quantized_sdf_sample(self, index, num_points):
+        '''
+        Decode sampled coordinates of an object, and their sdf values or
+        their occupancy from the bit-packed shard
+        '''
+        row, idx = self.sample_sdf_rows(index, num_points)
+        start = self.sdf_offsets[row]
+        input_points = quantize.decode_fixed(self.get_shard(\
+            pack_shape.SDF_COORDS_SHARD)[start+idx], self.coord_bound)
+        if self.use_packed_occ():
+            occ = self.get_shard(pack_shape.OCC_SHARD)\
+                [self.occ_offsets[row]:self.occ_offsets[row+1]]
+            return input_points, quantize.unpack_occ(occ, idx)
+        input_sdfs = quantize.decode_sdf(self.get_shard(\
+            pack_shape.SDF_VALUES_SHARD)[start+idx], self.sdf_encoding, \
+            self.sdf_log_eps, self.sdf_log_max)
+        return input_points, input_sdfs
+
+    def load_sdf_sample(self, index, num_points=None):
+        if num_points is None:
+            num_points = self.num_points
+        if self.quantized:
+            return self.load_quantized_sdf_sample(index, num_points)
+        row = self.packed_rows[index]
+        obj_sdf = self.get_shard(pack_shape.SDF_SHARD)\
+            [self.sdf_offsets[row]:self.sdf_offsets[row+1]]
+        obj_sdf = utils.sample_rows(obj_sdf, num_points)
+        return obj_sdf[:, :3], obj_sdf[:, 3]
+
+    def load_shape_sample(self, index, num_points=None):
+        if num_points is None:
+            num_points = self.num_points
+        if self.use_packed_occ():
+            # Occupancy at iso is stored, skip the sdf values
+            return self.load_quantized_sdf_sample(index, num_points)
+        return super().load_shape_sample(index, num_points)
+
+    def load_pointcloud(self, index, num_points=-1):
+        row = self.packed_rows[index]
+        obj_ptcl = self.get_shard(self.ptcl_shard)\
+            [self.ptcl_offsets[row]:self.ptcl_offsets[row+1]]
+        if self.quantized:
+            if num_points != -1:
+                obj_ptcl = utils.sample_rows(obj_ptcl, num_points)
+            return quantize.decode_fixed(obj_ptcl[:, :3], self.coord_bound), \
+                quantize.decode_fixed(obj_ptcl[:, 3:], 1.)
+        return utils.sample_pointcloud(obj_ptcl[:, :3], obj_ptcl[:, 3:], num_points)
+
+    def load_metadata(self, index):
+        row = self.packed_rows[index]
+        meta = self.get_shard(pack_shape.META_SHARD)[row]
+        hvc_meta = None
+        if self.coord_system == '3dvc':
+            hvc_meta = self.get_shard(pack_shape.HVC_META_SHARD)[row]
+        return meta, hvc_meta
+
+    def load_pose_table(self):
+        self.load_packed_index()
+        if self.coord_system not in ['2dvc', '3dvc'] \
+                or len(self.obj_cat_map) == 0 or self.image_only:
+            return None
+        # Gather metadata rows of all objects at once
+        meta = self.get_shard(pack_shape.META_SHARD)[self.packed_rows]
+        hvc_meta = self.get_shard(pack_shape.HVC_META_SHARD)[self.packed_rows]
+        self.shards = None
+        return utils.get_view_rotations(meta[:, :self.seq_len], \
+            hvc_meta, self.coord_system)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Memory maps are reopened in the receiving process
+        state['shards'] = None
+        return state
@@ -0,0 +1,10 @@
+from dataloader_ptcl import Dataset as Dataset_Ptc
+from dataloader_packed import Dataset as Dataset_Packed
+
+class Dataset(Dataset_Ptc, Dataset_Packed):
+    '''
+    Pointcloud input Dataset reading GT pointclouds, sdf samples and view
+    metadata from the shards written by pack_shape.py. Only the sampled
+    rows of the pointcloud shard are read during training
+    '''
+    pass
@@ -3,14 +3,108 @@ import torch
 from torch.utils.data import Dataset
 from PIL import Image
 import os
-import glob
+import mmap
+import inspect
+import random
 import utils_shape as utils
+import manifest_shape
+import shm_cache
 import json
 from torchvision import transforms
+from torch.utils.data.dataloader import default_collate
+
+# GT pointcloud and normals of an object as one N x 6 float32 array, next
+# to pointcloud.npz
+PTCL_NPY = 'pointcloud.npy'
+
+def get_img_transform(input_size):
+    '''
+    Input RGB image transform function
+    '''
+    return transforms.Compose([
+        transforms.Resize(input_size),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+
+def decode_view(input_image, input_depth, input_seg, input_normal, input_size, \
+    img_transform, lossless_depth=False):
+    '''
+    Decode the input images of a view into a C x H x W array
+    args:
+        input_image, input_depth, input_seg, input_normal: paths or
+            file objects of the view images, None if not used
+        input_size: size of the inputs
+        img_transform: transform of the RGB image
+        lossless_depth: resize depth in float
+    '''
+    if input_image is not None:
+        image_data = Image.open(input_image).convert('RGB')
+        image_data = img_transform(image_data)
+        image_data = np.array(image_data.numpy())
+    else:
+        image_data = np.array([])
+
+    if input_depth is not None:
+        with np.load(input_depth) as depth_npz:
+            depth_data = depth_npz['img']
+            depth_min_max = depth_npz['min_max']
+        min_d, max_d = depth_min_max[0], depth_min_max[1]
+
+        # Resize depth npz from 256x256 to 224x224
+        if lossless_depth:
+            # Resize in float instead of quantizing to uint8
+            depth_image = Image.fromarray(depth_data.astype(np.float32), mode='F')
+            depth_image = depth_image.resize(\
+                (input_size, input_size))
+            depth_data = np.array(depth_image, dtype=np.float64)
+        else:
+            depth_image = Image.fromarray(np.uint8(depth_data*255.))
+            depth_image = depth_image.resize(\
+                (input_size, input_size))            
+            depth_data = np.array(depth_image)/255.
+
+        # Convert depth to range min to max
+        depth_data = 1 - depth_data
+        seg_data = Image.open(input_seg).convert('L')
+        seg_data = seg_data.resize((input_size, input_size))
+        seg_data = np.array(seg_data)/255. # 0-1 with object as 1
+
+        depth_data[seg_data == 0.] = 10. # Set background to max value
+
+        depth_data[seg_data != 0.] = depth_data[seg_data != 0.]*(max_d-min_d)+min_d
+        depth_data = np.expand_dims(depth_data, axis=2)
+        depth_data = depth_data.transpose(2,0,1)
+
+        if len(image_data) == 0:
+            image_data = depth_data
+        else:
+            image_data = np.concatenate(\
+                [image_data, depth_data],axis=0)
+
+    else:
+        depth_data = None
+    if input_normal is not None:
+        normal_data = Image.open(input_normal).convert('RGB')
+        # Resize and normalize
+        normal_data = normal_data.resize(\
+            (input_size, input_size))
+        normal_data = np.array(normal_data)/255.
+        normal_data = normal_data.transpose(2,0,1)
+        if len(image_data) == 0:
+            image_data = normal_data
+        else: 
+            image_data = np.concatenate(\
+                [image_data, normal_data],axis=0)
+    else:
+        normal_data = None
+
+    return np.asarray(image_data, dtype=np.float32)
 
 class Dataset(Dataset):
     def __init__(self, config, num_points=-1,mode='train',shape_rep='sdf',\
-        coord_system='3dvc', iso=0.003, perm=None, all_classes=None):
+        coord_system='3dvc', iso=0.003, perm=None, all_classes=None, \
+        batch_rotate=False, views_per_object=None, image_only=False):
 
         self.mode = mode
         self.coord_system = coord_system
@@ -27,6 +121,8 @@ class Dataset(Dataset):
         self.input_seg_path = self.config.path['input_seg_path']
 
         self.img_extension = self.config.data_setting['img_extension']
+        # Keep full precision depth instead of the uint8 round trip
+        self.lossless_depth = self.config.data_setting['lossless_depth']
 
 
         self.src_pt_path = self.config.path['src_pt_path']
@@ -40,11 +136,27 @@ class Dataset(Dataset):
 
         self.iso = iso
 
+        # Return unrotated points and the view rotation, points are then
+        # rotated batch-wise by collate_rotate
+        self.batch_rotate = batch_rotate
+
+        # Only return the encoder input and label, for encoder-only
+        # consumers. Shape samples and view poses are not loaded
+        self.image_only = image_only
+
+        # Each item is a group of views of one object sharing one sdf read,
+        # batches are flattened by collate_views
+        self.views_per_object = None if image_only else views_per_object
+
         with open(self.data_split_json_path, 'r') as data_split_file:
             self.data_splits = json.load(data_split_file)
         self.split = self.data_splits[self.mode]
         self.random_view = self.config.data_setting['random_view']
         self.seq_len = self.config.data_setting['seq_len']
+        if self.views_per_object is not None \
+                and self.seq_len % self.views_per_object != 0:
+            raise Exception("seq_len %s is not a multiple of views_per_object %s"\
+                %(self.seq_len, self.views_per_object))
 
         self.catnames = sorted(list(self.split.keys()))
         self.cat_map = {}
@@ -53,86 +165,98 @@ class Dataset(Dataset):
             self.catnames = sorted([c for c in self.catnames \
                             if c in self.categories])
 
-        self.obj_cat_map = [(obj,cat) for cat in self.catnames \
-                                for obj in self.split[cat] \
-                            if os.path.exists(os.path.join(self.src_dataset_path, cat,obj))]
+        # Objects and view files are resolved once per split json and
+        # path config, see manifest_shape
+        manifest = [entry for entry in manifest_shape.get_manifest(self.config, self.mode) \
+                        if entry['cat'] in self.catnames and self.use_object(entry)]
+
+        self.obj_cat_map = [(entry['obj'], entry['cat']) for entry in manifest]
 
         self.classes = np.asarray([cat for _, cat in self.obj_cat_map])
         self.all_indices = np.arange(len(self.classes))
+
+        # Class to object table in CSR layout: objects of class_names[i] are
+        # class_objects[class_offsets[i]:class_offsets[i+1]]
+        self.class_names, self.class_ids, class_counts = np.unique(self.classes, \
+            return_inverse=True, return_counts=True)
+        self.class_ids = self.class_ids.astype(np.int64)
+        self.class_objects = self.all_indices[np.argsort(self.class_ids, kind='stable')]
+        self.class_offsets = np.concatenate([[0], np.cumsum(class_counts)]).astype(np.int64)
+
+        # Current indices are kept in a preallocated buffer, index_state[0]
+        # is the number of current indices followed by the buffer
+        self.index_state = np.zeros(len(self.classes)+1, dtype=np.int64)
+        # Whether index_state is in memory shared with loader workers
+        self.shared_indices = False
+        # (class, start, end) runs of same class objects in the buffer
+        self.active_segments = []
         # Init current training indices
         self.current_indices = []
 
+        # Path tables are compact arrays built from obj_cat_map, so that
+        # loader workers do not copy them on access
+        self.obj_cat_map = utils.ObjectTable(self.obj_cat_map)
         # Get all image paths
-        self.img_paths = [os.path.join(self.src_dataset_path, cat, obj) \
-                                for (obj, cat) in self.obj_cat_map \
-                                if os.path.exists(os.path.join(self.src_dataset_path, cat,obj))]
+        self.img_paths = utils.PathTable(self.src_dataset_path, self.obj_cat_map)
         # Get all sdf paths
-        self.sdf_h5_paths = [os.path.join(self.src_pt_path, cat, obj, 'ori_sample.h5') \
-                        for (obj, cat) in self.obj_cat_map \
-                        if os.path.exists(os.path.join(self.src_dataset_path, cat, obj))]
+        self.sdf_h5_paths = utils.PathTable(self.src_pt_path, self.obj_cat_map, \
+            'ori_sample.h5')
         # Get all pointcloud paths
-        self.pointcld_split_paths = [os.path.join(self.src_ptcl_path, cat, obj) \
-                            for (obj, cat) in self.obj_cat_map \
-                            if os.path.exists(os.path.join(self.src_dataset_path, cat, obj))]
+        self.pointcld_split_paths = utils.PathTable(self.src_ptcl_path, self.obj_cat_map)
         # Get all metadata paths                        
-        self.metadata_split_paths = [os.path.join(self.src_dataset_path, cat, \
-                        obj, 'metadata.txt') \
-                            for (obj, cat) in self.obj_cat_map \
-                            if os.path.exists(os.path.join(self.src_dataset_path, cat, obj))]
+        self.metadata_split_paths = utils.PathTable(self.src_dataset_path, \
+            self.obj_cat_map, 'metadata.txt')
         if self.coord_system == '3dvc':
-            # self.hvc_metadata_split_paths = [os.path.join(self.src_dataset_path, cat, \
-            #             obj, 'hard_vc_metadata.txt') \
-            #                 for (obj, cat) in self.obj_cat_map \
-            #                 if os.path.exists(os.path.join(self.src_dataset_path, cat, obj))]
-            self.hvc_metadata_split_paths = [os.path.join(self.src_dataset_path, cat, \
-                        obj, '3DOF_vc_metadata.txt') \
-                            for (obj, cat) in self.obj_cat_map \
-                            if os.path.exists(os.path.join(self.src_dataset_path, cat, obj))]
+            self.hvc_metadata_split_paths = utils.PathTable(self.src_dataset_path, \
+                self.obj_cat_map, '3DOF_vc_metadata.txt')
         # Input RGB image transform function
-        self.img_transform = transforms.Compose([
-            transforms.Resize(self.input_size),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+        self.img_transform = get_img_transform(self.input_size)
         self.image_split_paths, self.depth_split_paths, \
-            self.normal_split_paths, self.seg_split_paths = self.load_image_paths()
+            self.normal_split_paths, self.seg_split_paths = self.load_image_paths(manifest)
+
+        # num objects x seq_len x 3 x 3 composite view rotations
+        self.pose_table = self.load_pose_table()
+
+        # Open sdf h5 files, per worker
+        self.h5_pool = utils.H5FilePool(self.config.data_setting['h5_pool_size'])
 
-    def load_image_paths(self):
+        # Decoded samples in shared memory, shared by all loader workers
+        self.cache = None
+        if self.config.data_setting['shm_cache_budget'] is not None:
+            self.cache = shm_cache.get_cache(self.config.data_setting['shm_cache_budget'])
+
+    def use_object(self, entry):
+        '''
+        Whether to use an object of the manifest
+        args:
+            entry: manifest entry of the object
+        '''
+        return True
+
+    def load_image_paths(self, manifest):
         '''
         Loads all images paths
+        args:
+            manifest: manifest entries of all objects
         '''
+        def get_split_files(sub_dir, key):
+            # Objects without the view directory are skipped
+            return utils.ViewPathTable(self.img_paths, sub_dir, \
+                [entry[key] for entry in manifest])
+
         if self.input_image_path is not None:
-            image_split_files = [sorted(glob.glob(
-                        os.path.join(obj_path, self.input_image_path, '*.%s' 
-                            % self.img_extension)))[:] \
-                                for obj_path in self.img_paths \
-                                if os.path.exists(\
-                                    os.path.join(obj_path, self.input_image_path))]
+            image_split_files = get_split_files(self.input_image_path, 'image')
         else:
             image_split_files = None
 
         if self.input_depth_path is not None:
-            seg_split_files = [sorted(glob.glob(
-                    os.path.join(obj_path, self.input_seg_path, '*.%s'%self.img_extension\
-                            )))[:] for obj_path in self.img_paths \
-                                    if os.path.exists(\
-                                        os.path.join(obj_path, self.input_seg_path))]
-
-            depth_split_files = [sorted(glob.glob(
-                    os.path.join(obj_path, self.input_depth_path, '*.npz'\
-                            )))[:] for obj_path in self.img_paths \
-                                    if os.path.exists(\
-                                        os.path.join(obj_path, self.input_depth_path))]
+            seg_split_files = get_split_files(self.input_seg_path, 'seg')
+            depth_split_files = get_split_files(self.input_depth_path, 'depth')
         else:
             depth_split_files = None
             seg_split_files = None
         if self.input_normal_path is not None:
-            normal_split_files = [sorted(glob.glob(
-                    os.path.join(obj_path, self.input_normal_path, '*.%s' 
-                        % self.img_extension)))[:] \
-                            for obj_path in self.img_paths \
-                            if os.path.exists(\
-                                os.path.join(obj_path, self.input_normal_path))]
+            normal_split_files = get_split_files(self.input_normal_path, 'normal')
         else:
             normal_split_files = None
 
@@ -155,69 +279,189 @@ class Dataset(Dataset):
 
         index = self.current_indices[index]
 
-        if self.image_split_paths is not None:
+        image_data = torch.FloatTensor(self.load_image_data(index, img_idx))
+        label = self.cat_map[self.classes[index]]
 
-            input_image = self.image_split_paths[index][img_idx]
-            image_data = Image.open(input_image).convert('RGB')
-            image_data = self.img_transform(image_data)
-            image_data = np.array(image_data.numpy())
+        return image_data, label
+
+    def load_image_data(self, index, img_idx):
+        '''
+        Input images of a view, from the shared cache if enabled
+        args:
+            index: object index into obj_cat_map
+            img_idx: view index
+        '''
+        if self.cache is not None:
+            obj, cat = self.obj_cat_map[index]
+            key = '%s-input-%s'%(obj, img_idx)
+            image_data = self.cache.get(cat, key)
+            if image_data is None:
+                image_data = self.decode_image_data(index, img_idx)
+                self.cache.put(cat, key, image_data)
+            else:
+                # Copy out of the read-only shared memory
+                image_data = np.array(image_data)
         else:
-            image_data = np.array([])
+            image_data = self.decode_image_data(index, img_idx)
+        return image_data
 
+    def decode_image_data(self, index, img_idx):
+        '''
+        Decode the input images of a view into a C x H x W array
+        args:
+            index: object index into obj_cat_map
+            img_idx: view index
+        '''
+        input_image, input_depth, input_seg, input_normal = None, None, None, None
+        if self.image_split_paths is not None:
+            input_image = self.image_split_paths[index][img_idx]
         if self.depth_split_paths is not None:
             input_depth = self.depth_split_paths[index][img_idx]
             input_seg = self.seg_split_paths[index][img_idx]
-            depth_data = np.load(input_depth)['img']
-            depth_min_max = np.load(input_depth)['min_max']
-            min_d, max_d = depth_min_max[0], depth_min_max[1]
-
-            # Resize depth npz from 256x256 to 224x224
-            depth_image = Image.fromarray(np.uint8(depth_data*255.))
-            depth_image = depth_image.resize(\
-                (self.input_size, self.input_size))            
-            depth_data = np.array(depth_image)/255.
-
-            # Convert depth to range min to max
-            depth_data = 1 - depth_data
-            seg_data = Image.open(input_seg).convert('L')
-            seg_data = seg_data.resize((self.input_size, self.input_size))
-            seg_data = np.array(seg_data)/255. # 0-1 with object as 1
-
-            depth_data[seg_data == 0.] = 10. # Set background to max value
+        if self.normal_split_paths is not None:
+            input_normal = self.normal_split_paths[index][img_idx]
+        return decode_view(input_image, input_depth, input_seg, input_normal, \
+            self.input_size, self.img_transform, self.lossless_depth)
 
-            depth_data[seg_data != 0.] = depth_data[seg_data != 0.]*(max_d-min_d)+min_d
-            depth_data = np.expand_dims(depth_data, axis=2)
-            depth_data = depth_data.transpose(2,0,1)
+    def load_sdf_sample(self, index, num_points=None):
+        '''
+        Load sdf samples of an object and subsample num_points of them
+        args:
+            index: object index into obj_cat_map
+            num_points: number of samples, defaults to self.num_points
+        '''
+        if num_points is None:
+            num_points = self.num_points
+        if self.cache is not None:
+            # Cache all samples of the object and subsample from the cache
+            obj, cat = self.obj_cat_map[index]
+            sample_sdf = self.cache.get(cat, '%s-sdf'%(obj))
+            if sample_sdf is None:
+                sample_sdf = self.h5_pool.get(self.sdf_h5_paths[index])\
+                    ['pc_sdf_sample'][:].astype(np.float32)
+                self.cache.put(cat, '%s-sdf'%(obj), sample_sdf)
+            sample_sdf = utils.sample_rows(sample_sdf, num_points)
+            return sample_sdf[:,:3], sample_sdf[:,3]
+        return utils.get_sdf_h5_sample(self.sdf_h5_paths[index], \
+            num_points, self.h5_pool)
+
+    def load_pointcloud(self, index, num_points=-1):
+        '''
+        Load GT pointcloud and normals of an object. A PTCL_NPY file written
+        by pack_shape.py --ptcl_npy is memory mapped if present, so that
+        only the sampled rows are read
+        args:
+            index: object index into obj_cat_map
+            num_points: number of random points, -1 for all points
+        '''
+        try:
+            obj_ptcl = np.load(os.path.join(self.pointcld_split_paths[index], \
+                PTCL_NPY), mmap_mode='r')
+            input_pointcld, input_normals = obj_ptcl[:, :3], obj_ptcl[:, 3:]
+        except FileNotFoundError:
+            input_pointcld_path = os.path.join(self.pointcld_split_paths[index],\
+                                        'pointcloud.npz')
+            with np.load(input_pointcld_path) as input_ptcld_dict:
+                input_pointcld = input_ptcld_dict['points']
+                input_normals = input_ptcld_dict['normals']
+        return utils.sample_pointcloud(input_pointcld, input_normals, num_points)
+
+    def load_metadata(self, index):
+        '''
+        Load view metadata (azim, elev per view) and 3-DOF VC metadata
+        of an object. 3-DOF VC metadata is None for 2dvc
+        args:
+            index: object index into obj_cat_map
+        '''
+        meta = np.loadtxt(self.metadata_split_paths[index])
+        hvc_meta = None
+        if self.coord_system == '3dvc':
+            hvc_meta = np.loadtxt(self.hvc_metadata_split_paths[index])
+        return meta, hvc_meta
 
-            if len(image_data) == 0:
-                image_data = depth_data
-            else:
-                image_data = np.concatenate(\
-                    [image_data, depth_data],axis=0)
+    def load_pose_table(self):
+        '''
+        Load metadata of all objects once and precompute the composite
+        rotation of every view
+        '''
+        if self.coord_system not in ['2dvc', '3dvc'] \
+                or len(self.obj_cat_map) == 0 or self.image_only:
+            return None
+        all_meta = []
+        all_hvc_meta = []
+        for index in range(len(self.obj_cat_map)):
+            meta, hvc_meta = self.load_metadata(index)
+            meta = np.asarray(meta).reshape(-1, np.shape(meta)[-1])[:self.seq_len, :2]
+            if len(meta) < self.seq_len:
+                raise Exception("%s has %s views, fewer than seq_len=%s"\
+                    %(self.metadata_split_paths[index], len(meta), self.seq_len))
+            all_meta.append(meta)
+            if hvc_meta is not None:
+                all_hvc_meta.append(np.asarray(hvc_meta)[:2])
+        if len(all_hvc_meta) == 0:
+            all_hvc_meta = None
+        return utils.get_view_rotations(np.stack(all_meta), \
+            all_hvc_meta, self.coord_system)
+
+    def get_rotation(self, index, img_idx):
+        '''
+        Rotation of a view, identity if the coordinate system is not
+        viewer centered
+        args:
+            index: object index into obj_cat_map
+            img_idx: view index
+        '''
+        if self.pose_table is None:
+            return np.eye(3, dtype=np.float32)
+        return self.pose_table[index, img_idx]
 
-        else:
-            depth_data = None
-        if self.normal_split_paths is not None:
-            input_normal = self.normal_split_paths[index][img_idx]
+    def get_sdf_ranges(self, index):
+        '''
+        File ranges read for the sdf samples of an object, as
+        (path, offset, size) with size None for the rest of the file
+        '''
+        return [(self.sdf_h5_paths[index], 0, None)]
 
-            normal_data = Image.open(input_normal).convert('RGB')
-            # Resize and normalize
-            normal_data = normal_data.resize(\
-                (self.input_size, self.input_size))
-            normal_data = np.array(normal_data)/255.
-            normal_data = normal_data.transpose(2,0,1)
-            if len(image_data) == 0:
-                image_data = normal_data
-            else: 
-                image_data = np.concatenate(\
-                    [image_data, normal_data],axis=0)
-        else:
-            normal_data = None
+    def get_pointcloud_ranges(self, index):
+        '''
+        File ranges read for the GT pointcloud of an object
+        '''
+        return [(os.path.join(self.pointcld_split_paths[index], name), 0, None) \
+                    for name in [PTCL_NPY, 'pointcloud.npz']]
 
-        image_data = torch.FloatTensor(image_data)
-        label = self.cat_map[self.classes[index]]
+    def get_image_ranges(self, index):
+        '''
+        File ranges read for the input images of all views of an object
+        '''
+        ranges = []
+        for split_paths in [self.image_split_paths, self.depth_split_paths, \
+                self.normal_split_paths, self.seg_split_paths]:
+            if split_paths is not None:
+                ranges += [(path, 0, None) for path in split_paths[index]]
+        return ranges
+
+    def get_prefetch_ranges(self, index):
+        '''
+        File ranges read when loading an object, see prefetch_shape
+        args:
+            index: object index into obj_cat_map
+        '''
+        if self.image_only:
+            return self.get_image_ranges(index)
+        ranges = self.get_sdf_ranges(index)+self.get_image_ranges(index)
+        if self.mode == 'test':
+            ranges += self.get_pointcloud_ranges(index)
+        return ranges
 
-        return image_data, label
+    def load_shape_sample(self, index, num_points=None):
+        '''
+        Load sampled points of an object and their values in shape_rep,
+        sdf or occupancy at iso
+        '''
+        input_points, input_sdfs = self.load_sdf_sample(index, num_points)
+        if self.shape_rep == 'occ':
+            input_sdfs = (input_sdfs <= self.iso).astype(np.float32)
+        return input_points, input_sdfs
 
     def get_points_sdf_sample(self, index, img_idx=-1):
         '''
@@ -234,32 +478,11 @@ class Dataset(Dataset):
 
         index = self.current_indices[index]
 
-        ori_pt, ori_sdf_val, input_points, input_sdfs, norm_params, \
-            sdf_params  = utils.get_sdf_h5(self.sdf_h5_paths[index])
-        input_points, input_sdfs = utils.sample_points(input_points,\
-                                           input_sdfs,\
-                                           self.num_points)
-
-        if self.coord_system == '2dvc':
+        input_points, input_sdfs = self.load_shape_sample(index)
 
-            input_metadata_path = self.metadata_split_paths[index]
-            meta = np.loadtxt(input_metadata_path)
-            rotate_dict = {'elev': meta[img_idx][1], 'azim': meta[img_idx][0]}
-
-            input_points = utils.apply_rotate(input_points, rotate_dict)
-
-        elif self.coord_system == '3dvc':
-            # Rotate points for 3-DOF VC
-            input_hvc_meta_path = self.hvc_metadata_split_paths[index]
-            hvc_meta = np.loadtxt(input_hvc_meta_path)
-            hvc_rotate_dict = {'elev': hvc_meta[1], 'azim': hvc_meta[0]}
-            input_points = utils.apply_rotate(input_points, hvc_rotate_dict)
-
-            input_metadata_path = self.metadata_split_paths[index]
-            meta = np.loadtxt(input_metadata_path)
-            rotate_dict = {'elev': meta[img_idx][1], 'azim': meta[img_idx][0]-180}
-
-            input_points = utils.apply_rotate(input_points, rotate_dict)
+        if not self.batch_rotate:
+            rotation = self.get_rotation(index, img_idx)
+            input_points = input_points@rotation.T
 
         input_points = torch.FloatTensor(input_points)
         input_sdfs = torch.FloatTensor(input_sdfs)
@@ -280,37 +503,12 @@ class Dataset(Dataset):
 
         index = self.current_indices[index]
 
-        input_pointcld_path = self.pointcld_split_paths[index]
-        input_pointcld_path = os.path.join(input_pointcld_path,\
-                                    'pointcloud.npz')
-        input_ptcld_dict = np.load(input_pointcld_path, mmap_mode='r')
-        input_pointcld = input_ptcld_dict['points'].astype(np.float32)
-        input_normals = input_ptcld_dict['normals'].astype(np.float32)
-
-        if self.coord_system == '2dvc':
-
-            input_metadata_path = self.metadata_split_paths[index]
-            meta = np.loadtxt(input_metadata_path)
-            rotate_dict = {'elev': meta[img_idx][1], 'azim': meta[img_idx][0]}
-
-            input_pointcld = utils.apply_rotate(input_pointcld, rotate_dict)
-            input_normals = utils.apply_rotate(input_normals, rotate_dict)
-
-        elif self.coord_system == '3dvc':           
+        input_pointcld, input_normals = self.load_pointcloud(index)
 
-            input_hvc_meta_path = self.hvc_metadata_split_paths[index]
-            hvc_meta = np.loadtxt(input_hvc_meta_path)
-            hvc_rotate_dict = {'elev': hvc_meta[1], 'azim': hvc_meta[0]}
-            input_pointcld = utils.apply_rotate(input_pointcld, hvc_rotate_dict)
-            input_normals = utils.apply_rotate(input_normals, hvc_rotate_dict)
-
-
-            input_metadata_path = self.metadata_split_paths[index]
-            meta = np.loadtxt(input_metadata_path)
-            rotate_dict = {'elev': meta[img_idx][1], 'azim': meta[img_idx][0]-180}
-
-            input_pointcld = utils.apply_rotate(input_pointcld, rotate_dict)
-            input_normals = utils.apply_rotate(input_normals, rotate_dict)
+        if not self.batch_rotate:
+            rotation = self.get_rotation(index, img_idx)
+            input_pointcld = input_pointcld@rotation.T
+            input_normals = input_normals@rotation.T
 
         input_pointcld = torch.FloatTensor(input_pointcld)
         input_normals = torch.FloatTensor(input_normals)
@@ -318,25 +516,97 @@ class Dataset(Dataset):
         return input_pointcld, input_normals
 
     def __getitem__(self, index):
+        if self.views_per_object is not None:
+            return self.get_view_group(index)
         if self.random_view:
             img_idx = np.random.choice(self.seq_len)
         else:
             img_idx = -1
         image_data, label = self.get_data_sample(index, img_idx)
+        if self.image_only:
+            return image_data, label
 
         points_data, vals_data = self.get_points_sdf_sample(index, img_idx)
-        if self.shape_rep == 'occ':
-            vals_data = (vals_data.cpu().numpy() <= self.iso).astype(np.float32)
-            vals_data = torch.FloatTensor(vals_data)
 
+        idx, img_idx = self.get_img_index(index, img_idx)
         if self.mode == 'test':
-            idx, img_idx = self.get_img_index(index, img_idx)            
             pointcloud_data, normals_data = \
                     self.get_pointcloud_sample(index, img_idx)
-            return image_data, points_data, vals_data, pointcloud_data, \
+            sample = (image_data, points_data, vals_data, pointcloud_data, \
                         normals_data, self.obj_cat_map[self.current_indices[idx]], \
-                        img_idx, label
-        return image_data, points_data, vals_data, label
+                        img_idx, label)
+        else:
+            sample = (image_data, points_data, vals_data, label)
+        return self.add_rotation(sample, self.current_indices[idx], img_idx)
+
+    def get_view_group(self, index):
+        '''
+        Get views_per_object views of one object for __getitem__. The sdf
+        samples and pointcloud of the object are loaded once, each view
+        gets its own random subset of points. With random_view, group
+        index draws one of the objects index*views_per_object, ... so that
+        an epoch has as many samples as without views_per_object
+        returns:
+            list of samples in the same format as __getitem__
+        '''
+        num_views = self.views_per_object
+        if self.random_view:
+            first = index*num_views
+            num_objs = min(num_views, len(self.current_indices)-first)
+            obj_index = self.current_indices[first+np.random.randint(num_objs)]
+            img_indices = np.random.choice(self.seq_len, num_views, replace=False)
+        else:
+            num_groups = self.seq_len//num_views
+            obj_index = self.current_indices[index//num_groups]
+            img_indices = np.arange(num_views)+(index % num_groups)*num_views
+
+        if self.num_points != -1:
+            input_points, input_sdfs = self.load_shape_sample(obj_index, \
+                self.num_points*num_views)
+            input_points = input_points.reshape(num_views, self.num_points, 3)
+            input_sdfs = input_sdfs.reshape(num_views, self.num_points)
+        else:
+            input_points, input_sdfs = self.load_shape_sample(obj_index)
+            input_points = np.repeat(input_points[None], num_views, axis=0)
+            input_sdfs = np.repeat(input_sdfs[None], num_views, axis=0)
+        if self.mode == 'test':
+            input_pointcld, input_normals = self.load_pointcloud(obj_index)
+        label = self.cat_map[self.classes[obj_index]]
+
+        samples = []
+        for view, img_idx in enumerate(img_indices):
+            image_data = torch.FloatTensor(self.load_image_data(obj_index, img_idx))
+            points_data = input_points[view]
+            if not self.batch_rotate:
+                rotation = self.get_rotation(obj_index, img_idx)
+                points_data = points_data@rotation.T
+            points_data = torch.FloatTensor(points_data)
+            vals_data = torch.FloatTensor(input_sdfs[view])
+            if self.mode == 'test':
+                pointcloud_data, normals_data = input_pointcld, input_normals
+                if not self.batch_rotate:
+                    pointcloud_data = pointcloud_data@rotation.T
+                    normals_data = normals_data@rotation.T
+                sample = (image_data, points_data, vals_data, \
+                            torch.FloatTensor(pointcloud_data), \
+                            torch.FloatTensor(normals_data), \
+                            self.obj_cat_map[obj_index], int(img_idx), label)
+            else:
+                sample = (image_data, points_data, vals_data, label)
+            samples.append(self.add_rotation(sample, obj_index, img_idx))
+        return samples
+
+    def add_rotation(self, sample, index, img_idx):
+        '''
+        Append the view rotation to a sample in batch_rotate mode
+        args:
+            index: object index into obj_cat_map
+            img_idx: view index
+        '''
+        if not self.batch_rotate:
+            return sample
+        rotation = self.get_rotation(index, img_idx)
+        return sample + (torch.from_numpy(rotation),)
 
     def __len__(self):
         if len(self.current_indices) != 0:
@@ -350,6 +620,11 @@ class Dataset(Dataset):
                 num_mdl = len(self.normal_split_paths)
             else:
                 raise Exception("Must have at least 1 input image type")
+        if self.views_per_object is not None:
+            # Groups of views_per_object samples
+            if self.random_view:
+                return -(-num_mdl//self.views_per_object)
+            return num_mdl*(self.seq_len//self.views_per_object)
         if self.random_view:
             return num_mdl
         return num_mdl*self.seq_len
@@ -363,6 +638,111 @@ class Dataset(Dataset):
 
         return idx, img_idx
 
+    @property
+    def index_buffer(self):
+        return self.index_state[1:]
+
+    @property
+    def num_current(self):
+        return int(self.index_state[0])
+
+    @num_current.setter
+    def num_current(self, num_current):
+        self.index_state[0] = num_current
+
+    def share_indices(self, capacity=None):
+        '''
+        Move the current indices to anonymous shared memory. Changes made
+        in the main process then reach DataLoader workers forked before
+        them, so that persistent workers follow class changes
+        args:
+            capacity: maximum number of current indices, defaults to
+                twice the number of objects
+        '''
+        if self.shared_indices:
+            return
+        if capacity is None:
+            # Classes may be activated twice in one exposure
+            capacity = 2*len(self.classes)
+        capacity = max(capacity, self.num_current)
+        index_state = np.frombuffer(mmap.mmap(-1, 8*(capacity+1)), dtype=np.int64)
+        index_state[:self.num_current+1] = self.index_state[:self.num_current+1]
+        self.index_state = index_state
+        self.shared_indices = True
+
+    @property
+    def current_indices(self):
+        return self.index_buffer[:self.num_current]
+
+    @current_indices.setter
+    def current_indices(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        self.num_current = 0
+        self.active_segments = []
+        if len(indices) == 0:
+            return
+        # Split into runs of same class objects
+        ids = self.class_ids[indices]
+        bounds = np.concatenate([[0], np.where(np.diff(ids) != 0)[0]+1, [len(ids)]])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self.append_indices(self.class_names[ids[start]], indices[start:end])
+
+    def append_indices(self, cls, indices):
+        '''
+        Append indices of objects of a class to the current indices
+        '''
+        start = self.num_current
+        end = start+len(indices)
+        if end > len(self.index_buffer):
+            # Only happens when classes are activated more than once
+            if self.shared_indices:
+                raise Exception("Current indices exceed the shared index buffer, "
+                    "please increase its capacity in share_indices")
+            index_state = np.zeros(max(end, 2*len(self.index_buffer))+1, dtype=np.int64)
+            index_state[:start+1] = self.index_state[:start+1]
+            self.index_state = index_state
+        self.index_buffer[start:end] = indices
+        self.num_current = end
+        self.active_segments.append((cls, start, end))
+
+    def get_class_objects(self, cls):
+        '''
+        Indices of all objects of a class
+        '''
+        i = np.searchsorted(self.class_names, cls)
+        if i == len(self.class_names) or self.class_names[i] != cls:
+            return self.class_objects[:0]
+        return self.class_objects[self.class_offsets[i]:self.class_offsets[i+1]]
+
+    def get_current_class_objects(self, cls):
+        '''
+        Current indices of objects of a class, in current order
+        '''
+        segments = [self.index_buffer[start:end] \
+                        for seg_cls, start, end in self.active_segments if seg_cls == cls]
+        if len(segments) == 0:
+            return self.class_objects[:0]
+        return np.concatenate(segments)
+
+    def activate_classes(self, classes):
+        '''
+        Append all objects of classes to the current indices
+        '''
+        for cls in classes:
+            self.append_indices(cls, self.get_class_objects(cls))
+
+    def deactivate_classes(self, classes):
+        '''
+        Remove all objects of classes from the current indices
+        '''
+        segments = [(cls, start, end) for cls, start, end in self.active_segments \
+                        if cls not in classes]
+        indices = [self.index_buffer[start:end].copy() for _, start, end in segments]
+        self.num_current = 0
+        self.active_segments = []
+        for (cls, _, _), cls_indices in zip(segments, indices):
+            self.append_indices(cls, cls_indices)
+
     def clear(self):
         self.current_indices = []
 
@@ -372,11 +752,15 @@ class Dataset(Dataset):
         args:
             cls: ground truth class
         '''
-        indices = self.current_indices
-        self.current_indices = self.all_indices[self.classes == cls]
         # Append distinct classes
-        if len(indices) != 0:
-            self.current_indices = np.concatenate([indices, self.current_indices])
+        self.activate_classes([cls])
+
+    def set_cache_scope(self, classes):
+        '''
+        Restrict the shared sample cache to classes of the current exposure
+        '''
+        if self.cache is not None:
+            self.cache.set_scope(classes)
 
     def update_class_map(self, cat_map):
         '''
@@ -402,8 +786,7 @@ class Dataset(Dataset):
             self.exemplar_indices[o_cls] = keep_samples
 
     def sample_exemplar(self, r_cls, m):
-        current_cls_ind = self.classes[self.current_indices]
-        current_cls_sample_ind = self.current_indices[current_cls_ind == r_cls]
+        current_cls_sample_ind = self.get_current_class_objects(r_cls)
         chosen_samples_ind = np.random.choice(len(current_cls_sample_ind),m,replace=False)
         self.exemplar_indices.append(current_cls_sample_ind[chosen_samples_ind])
 
@@ -413,8 +796,7 @@ class Dataset(Dataset):
         '''
         n_classes_seen = len(self.exemplar_indices)
         o_cls = self.cat_map[r_cls]
-        current_cls_ind = self.classes[self.current_indices]
-        current_cls_sample_ind = self.current_indices[current_cls_ind == r_cls]
+        current_cls_sample_ind = self.get_current_class_objects(r_cls)
         chosen_samples_ind = np.random.choice(len(current_cls_sample_ind),m,replace=False)
 
         if o_cls < n_classes_seen:
@@ -423,4 +805,60 @@ class Dataset(Dataset):
             self.exemplar_indices.append(current_cls_sample_ind[chosen_samples_ind])
 
     def set_train_on_exemplar(self):
-        self.current_indices = np.concatenate(self.exemplar_indices, axis=0)
\ No newline at end of file
+        self.current_indices = np.concatenate(self.exemplar_indices, axis=0)
+
+def collate_rotate(batch):
+    '''
+    Collate function for datasets in batch_rotate mode. The last element of
+    each sample is its view rotation, all B x N x 3 point tensors of the
+    batch are rotated with one batched matmul
+    '''
+    batch = default_collate(batch)
+    rotations = batch[-1]
+    out = []
+    for data in batch[:-1]:
+        if torch.is_tensor(data) and data.dim() == 3 and data.size(2) == 3:
+            data = torch.bmm(data, rotations.transpose(1, 2))
+        out.append(data)
+    return out
+
+def collate_views(batch, collate_fn=default_collate):
+    '''
+    Collate function for datasets with views_per_object. The view groups of
+    the batch are flattened and collated with collate_fn
+    '''
+    return collate_fn([sample for group in batch for sample in group])
+
+def seed_worker(worker_id, worker_init_fn=None):
+    '''
+    DataLoader worker_init_fn seeding numpy and random of a worker from
+    its torch seed, which DataLoader draws from the torch RNG of the main
+    process, so that sampling in workers follows the restored RNG state
+    of resumed training (numpy is only seeded by torch>=1.9)
+    args:
+        worker_id: id of the worker
+        worker_init_fn: worker_init_fn called afterwards
+    '''
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+    if worker_init_fn is not None:
+        worker_init_fn(worker_id)
+
+def get_data_loader(dataset, persistent_workers=False, **kwargs):
+    '''
+    DataLoader of a Dataset. With persistent_workers, the current indices
+    of the Dataset are shared with the workers, which are kept alive
+    across iterations together with their open files and caches
+    (torch>=1.7, workers are forked every iteration otherwise)
+    args:
+        dataset: Dataset
+        persistent_workers: whether to keep workers alive
+        kwargs: DataLoader arguments
+    '''
+    if persistent_workers and kwargs.get('num_workers', 0) > 0:
+        dataset.share_indices()
+        if 'persistent_workers' in \
+                inspect.signature(torch.utils.data.DataLoader.__init__).parameters:
+            kwargs['persistent_workers'] = True
+    return torch.utils.data.DataLoader(dataset, **kwargs)
@@ -0,0 +1,247 @@
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+import os
+import io
+import json
+import mmap
+import tarfile
+import utils_shape as utils
+import shard_shape
+from dataloader_shape import decode_view, get_img_transform
+
+class Dataset(IterableDataset):
+    '''
+    Training Dataset streaming the tar shards written by shard_shape.py.
+    Shards of active classes are read sequentially, in a random order
+    split between loader workers, and views go through a shuffle buffer.
+    Stands in for the training Dataset of dataloader_shape, samples have
+    the same format
+    '''
+    def __init__(self, config, num_points=-1, mode='train', shape_rep='sdf', \
+        coord_system='3dvc', iso=0.003, batch_rotate=False):
+
+        self.mode = mode
+        if self.mode == 'test':
+            raise Exception("Streaming Dataset does not support test mode")
+        self.coord_system = coord_system
+        self.config = config
+        self.num_points = num_points
+        self.shape_rep = shape_rep
+        self.iso = iso
+        self.batch_rotate = batch_rotate
+
+        self.input_size = self.config.data_setting['input_size']
+        self.lossless_depth = self.config.data_setting['lossless_depth']
+        self.random_view = self.config.data_setting['random_view']
+        self.seq_len = self.config.data_setting['seq_len']
+        self.categories = self.config.data_setting['categories']
+        self.shuffle_buffer = self.config.data_setting['shuffle_buffer']
+        self.img_transform = get_img_transform(self.input_size)
+
+        with open(self.config.path['data_split_json_path'], 'r') as data_split_file:
+            self.split = json.load(data_split_file)[self.mode]
+        self.catnames = sorted(list(self.split.keys()))
+        if self.categories is not None:
+            self.catnames = sorted([c for c in self.catnames \
+                            if c in self.categories])
+        self.cat_map = {}
+
+        self.stream_split_path = os.path.join(\
+            self.config.path['stream_dataset_path'], self.mode)
+        with open(os.path.join(self.stream_split_path, shard_shape.INDEX_FILE), 'r') \
+                as index_file:
+            index = json.load(index_file)
+        if index['seq_len'] < self.seq_len:
+            raise Exception("Shards of %s have fewer views than seq_len"\
+                %(self.stream_split_path))
+        shards = [s for s in index['shards'] if s['cat'] in self.catnames]
+        self.shard_names = [s['name'] for s in shards]
+        self.shard_objects = np.asarray([s['num_objects'] for s in shards], dtype=np.int64)
+
+        self.class_names = np.asarray(self.catnames)
+        self.shard_class_ids = np.searchsorted(self.class_names, \
+            [s['cat'] for s in shards]).astype(np.int64)
+        # Whether each class of class_names is active
+        self.class_mask = np.zeros(len(self.class_names), dtype=np.uint8)
+        # Epoch mixed into the seeds of every iteration, as the seeds of
+        # persistent workers do not change between iterations
+        self.epoch = np.zeros(1, dtype=np.int64)
+        self.shared_indices = False
+
+    def get_class_id(self, cls):
+        i = np.searchsorted(self.class_names, cls)
+        if i == len(self.class_names) or self.class_names[i] != cls:
+            raise Exception("Class %s is not in the shards"%(cls))
+        return i
+
+    def activate_classes(self, classes):
+        for cls in classes:
+            self.class_mask[self.get_class_id(cls)] = 1
+
+    def deactivate_classes(self, classes):
+        for cls in classes:
+            self.class_mask[self.get_class_id(cls)] = 0
+
+    def get_current_data_class(self, cls):
+        self.activate_classes([cls])
+
+    def clear(self):
+        self.class_mask[:] = 0
+
+    def share_indices(self):
+        '''
+        Move the active classes to anonymous shared memory, see
+        dataloader_shape.Dataset.share_indices
+        '''
+        if self.shared_indices:
+            return
+        class_mask = np.frombuffer(mmap.mmap(-1, max(len(self.class_mask), 1)), \
+            dtype=np.uint8)[:len(self.class_mask)]
+        class_mask[:] = self.class_mask
+        self.class_mask = class_mask
+        epoch = np.frombuffer(mmap.mmap(-1, self.epoch.nbytes), dtype=np.int64)
+        epoch[:] = self.epoch
+        self.epoch = epoch
+        self.shared_indices = True
+
+    def set_epoch(self, epoch):
+        '''
+        Set the epoch of the next iteration, which draws its shard order,
+        shuffle buffer and views from the seed of the loader and the epoch
+        '''
+        self.epoch[0] = epoch
+
+    def set_cache_scope(self, classes):
+        pass
+
+    def update_class_map(self, cat_map):
+        self.cat_map = cat_map
+
+    def get_class_objects(self, cls):
+        '''
+        Shards of a class, the units prefetched by prefetch_shape
+        '''
+        return np.where(self.shard_class_ids == self.get_class_id(cls))[0]
+
+    def get_prefetch_ranges(self, index):
+        return [(os.path.join(self.stream_split_path, self.shard_names[index]), 0, None)]
+
+    def get_active_shards(self):
+        return np.where(self.class_mask[self.shard_class_ids] != 0)[0]
+
+    def __len__(self):
+        num_mdl = int(self.shard_objects[self.get_active_shards()].sum())
+        if self.random_view:
+            return num_mdl
+        return num_mdl*self.seq_len
+
+    def read_shard(self, shard):
+        '''
+        Read the objects of a shard sequentially
+        returns:
+            iterator of (obj, cat, members) with members a dict of member
+            name to bytes
+        '''
+        cat = self.class_names[self.shard_class_ids[shard]]
+        obj, members = None, {}
+        path = os.path.join(self.stream_split_path, self.shard_names[shard])
+        with tarfile.open(path, 'r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                member_obj, name = member.name.split('/', 1)
+                if member_obj != obj:
+                    if obj is not None:
+                        yield obj, cat, members
+                    obj, members = member_obj, {}
+                members[name] = tar.extractfile(member).read()
+        if obj is not None:
+            yield obj, cat, members
+
+    def load_object(self, obj, cat, members):
+        '''
+        Decode the sdf samples and view rotations of an object once, views
+        are decoded when they leave the shuffle buffer
+        '''
+        sdf = np.load(io.BytesIO(members[shard_shape.SDF_MEMBER]))
+        meta = np.load(io.BytesIO(members[shard_shape.META_MEMBER]))[:self.seq_len]
+        hvc_meta = None
+        if shard_shape.HVC_META_MEMBER in members:
+            hvc_meta = np.load(io.BytesIO(members[shard_shape.HVC_META_MEMBER]))[None]
+        rotations = utils.get_view_rotations(meta[None], hvc_meta, self.coord_system)
+        views = {}
+        for kind in shard_shape.VIEW_KINDS:
+            names = sorted([name for name in members if name.startswith(kind+'/')])
+            if len(names) != 0:
+                views[kind] = [members[name] for name in names]
+        return {'obj': obj, 'cat': cat, 'sdf': sdf, 'views': views, \
+            'rotations': None if rotations is None else rotations[0]}
+
+    def get_sample(self, record, img_idx):
+        '''
+        Sample of a view of an object, in the format of
+        dataloader_shape.Dataset in train mode
+        '''
+        view_files = []
+        for kind in shard_shape.VIEW_KINDS:
+            if kind in record['views']:
+                view_files.append(io.BytesIO(record['views'][kind][img_idx]))
+            else:
+                view_files.append(None)
+        image_data = decode_view(*view_files, input_size=self.input_size, \
+            img_transform=self.img_transform, lossless_depth=self.lossless_depth)
+
+        sample_sdf = utils.sample_rows(record['sdf'], self.num_points)
+        input_points, input_sdfs = sample_sdf[:, :3], sample_sdf[:, 3]
+        if record['rotations'] is None:
+            rotation = np.eye(3, dtype=np.float32)
+        else:
+            rotation = record['rotations'][img_idx]
+        if not self.batch_rotate:
+            input_points = input_points@rotation.T
+        if self.shape_rep == 'occ':
+            input_sdfs = (input_sdfs <= self.iso).astype(np.float32)
+
+        sample = (torch.FloatTensor(image_data), torch.FloatTensor(input_points), \
+            torch.FloatTensor(input_sdfs), self.cat_map[record['cat']])
+        if self.batch_rotate:
+            sample = sample + (torch.from_numpy(rotation),)
+        return sample
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = torch.initial_seed()
+            shard_seed = seed
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            seed = worker_info.seed
+            # Same for all workers of an iteration
+            shard_seed = worker_info.seed-worker_info.id
+        epoch = int(self.epoch[0])
+        shard_order = np.random.RandomState([shard_seed % 2**32, epoch])\
+            .permutation(self.get_active_shards())
+        rng = np.random.RandomState([seed % 2**32, epoch])
+
+        # (object record, view index) pairs
+        buffer = []
+        def pop_random():
+            i = rng.randint(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            return self.get_sample(*buffer.pop())
+
+        for shard in shard_order[worker_id::num_workers]:
+            for obj, cat, members in self.read_shard(shard):
+                record = self.load_object(obj, cat, members)
+                if self.random_view:
+                    img_indices = [rng.randint(self.seq_len)]
+                else:
+                    img_indices = range(self.seq_len)
+                for img_idx in img_indices:
+                    buffer.append((record, img_idx))
+                    if len(buffer) >= self.shuffle_buffer:
+                        yield pop_random()
+        while len(buffer) != 0:
+            yield pop_random()
@@ -0,0 +1,156 @@
+########### Multi-process distributed training helpers
+import numpy as np
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+def init_distributed(backend='gloo'):
+    '''
+    Join the process group described by the environment of torchrun or
+    torch.distributed.launch --use_env (RANK, WORLD_SIZE, MASTER_ADDR,
+    MASTER_PORT). Single process runs without a group
+    returns:
+        rank, world size and local rank of the process
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, 0
+    dist.init_process_group(backend=backend, init_method='env://')
+    return dist.get_rank(), dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    '''
+    Whether the process writes checkpoints, npz files and logs
+    '''
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def get_module(model):
+    '''
+    Network wrapped by DataParallel or DistributedDataParallel
+    '''
+    if isinstance(model, (torch.nn.DataParallel, \
+            torch.nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+def get_collective_device():
+    '''
+    Device of the tensors of collectives: the current GPU with nccl,
+    which does not support CPU tensors, the CPU otherwise
+    '''
+    if is_distributed() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+def all_reduce_sum(values):
+    '''
+    Sum of values over all processes
+    args:
+        values: array of floats
+    returns:
+        float64 array
+    '''
+    values = torch.tensor(np.asarray(values, dtype=np.float64))
+    if is_distributed():
+        values = values.to(get_collective_device())
+        dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    return values.cpu().numpy()
+
+def all_gather_object(obj):
+    '''
+    Picklable objects of all processes, by rank
+    '''
+    if not is_distributed():
+        return [obj]
+    if not hasattr(dist, 'all_gather_object'):
+        raise Exception("Gathering objects of %s processes requires torch>=1.8"\
+            %(get_world_size()))
+    objs = [None]*get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+def gather_strided(rows, num_rows):
+    '''
+    Rows of all processes when process r holds rows r, r+world_size, ...
+    of num_rows rows, as split by ExposureSampler without padding
+    args:
+        rows: array of floats, rows of the process
+        num_rows: total number of rows
+    returns:
+        float64 array of all rows in order
+    '''
+    rows = np.asarray(rows, dtype=np.float64)
+    gathered = np.zeros((num_rows,)+rows.shape[1:], dtype=np.float64)
+    gathered[get_rank()::get_world_size()] = rows
+    return all_reduce_sum(gathered)
+
+def broadcast_array(array, src=0):
+    '''
+    Array of process src, array has the same shape and dtype on all
+    processes
+    '''
+    if not is_distributed():
+        return array
+    tensor = torch.from_numpy(np.ascontiguousarray(array)).to(get_collective_device())
+    dist.broadcast(tensor, src)
+    return tensor.cpu().numpy()
+
+class ExposureSampler(Sampler):
+    '''
+    Splits the samples of the current exposure of a Dataset between
+    processes. The Dataset length is read at every iteration, so the
+    sampler follows class changes of the Dataset
+    args:
+        dataset: Dataset whose length covers its current classes
+        shuffle: whether to shuffle, with the same order on all processes
+        pad: repeat samples so that all processes get the same number of
+            samples and run the same number of steps, for training
+        seed: shuffling seed, offset by the epoch
+    '''
+    def __init__(self, dataset, shuffle=True, pad=True, seed=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.pad = pad
+        self.seed = seed
+        self.epoch = 0
+        self.rank = get_rank()
+        self.num_replicas = get_world_size()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_indices(self):
+        num_samples = len(self.dataset)
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed+self.epoch)
+            indices = torch.randperm(num_samples, generator=generator).tolist()
+        else:
+            indices = list(range(num_samples))
+        if self.pad and num_samples != 0:
+            total = -(-num_samples//self.num_replicas)*self.num_replicas
+            indices += (indices*self.num_replicas)[:total-num_samples]
+        return indices[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.get_indices())
+
+    def __len__(self):
+        num_samples = len(self.dataset)
+        if self.pad:
+            return -(-num_samples//self.num_replicas)
+        return len(range(self.rank, num_samples, self.num_replicas))
@@ -5,14 +5,26 @@ import trimesh
 from tqdm import tqdm
 import config_shape as config
 from dataloader_shape import Dataset
+from dataloader_packed import Dataset as Dataset_Packed
 
 from model_shape import SDFNet
 from torch.autograd import Variable
 import torch.optim as optim
 import utils_shape as utils
+import threads_shape as threads
+import argparse
 
 
+parser = argparse.ArgumentParser(description="Evaluate C-SDFNet")
+threads.add_thread_args(parser)
+
 def main():
+    args = parser.parse_args()
+    # Cores for intra-op threads, loader workers and kd-tree queries
+    thread_plan = threads.plan_threads('eval', 'cuda', args)
+    print('Thread plan: %s'%(thread_plan))
+    thread_plan.apply()
+
     out_dir = config.training['out_dir']
     shape_rep = config.training['shape_rep']
     cont = config.training['cont']
@@ -31,13 +43,22 @@ def main():
 
     nclass = config.training['nclass']
 
+    # Whether to run the network in bfloat16 autocast
+    bf16 = config.training['bf16']
+
     # Dataset
     print('Loading data...')
-    test_dataset = Dataset(config, mode='test', shape_rep=shape_rep, \
+    # Read from packed shards if available
+    if config.path['packed_dataset_path'] is not None:
+        dataset_cls = Dataset_Packed
+    else:
+        dataset_cls = Dataset
+    test_dataset = dataset_cls(config, mode='test', shape_rep=shape_rep, \
         coord_system=coord_system)
 
     test_loader = torch.utils.data.DataLoader(
-        test_dataset, batch_size=batch_size_test, num_workers=12,pin_memory=True)
+        test_dataset, batch_size=batch_size_test, num_workers=thread_plan.num_workers, \
+        worker_init_fn=thread_plan.worker_init_fn, pin_memory=True)
     all_classes_orig = test_dataset.catnames
 
     # Load info
@@ -62,6 +83,11 @@ def main():
 
     # Loading model
     model = SDFNet(config)
+    # DataParallel replicas run on their own threads, outside the
+    # autocast context of the caller
+    if bf16 and torch.cuda.device_count() > 1:
+        raise Exception("bf16 is not supported with DataParallel over %s GPUs, "\
+            "please set CUDA_VISIBLE_DEVICES to one GPU"%(torch.cuda.device_count()))
     model = torch.nn.DataParallel(model).cuda()
     optimizer = optim.Adam(model.parameters(), lr=1e-4)
 
@@ -146,7 +172,7 @@ def main():
                                 % (cl_count, obj[0]))
                             mesh = utils.generate_mesh_mise_sdf(img_input, \
                                 points_input, model.module, box_size=box_size,\
-                                upsampling_steps=2, resolution=64)
+                                upsampling_steps=2, resolution=64, bf16=bf16)
                             mesh.export(obj_path)
 
                         # Save gen info
@@ -167,7 +193,9 @@ def main():
                                     mesh = None
                             else:
                                 mesh = None
-                            sdf_val = model(points_input, img_input)
+                            with utils.get_autocast(img_input.device, bf16):
+                                sdf_val = model(points_input, img_input)
+                            sdf_val = sdf_val.float()
 
                             out_dict = utils.eval_mesh(mesh, pointclouds, normals, \
                                         points_input, values, shape_rep='sdf',\
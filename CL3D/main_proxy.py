@@ -12,15 +12,18 @@ import config_shape as config
 from datetime import datetime
 import utils_shape as utils
 from dataloader_shape import Dataset
+from dataloader_packed import Dataset as Dataset_Packed
 
 from model_shape import SDFNet
 from tqdm import tqdm
 import copy
 import argparse
+import threads_shape as threads
 
 parser = argparse.ArgumentParser(description="Proxy Task")
 parser.add_argument("--num_explr", default=20, type=int,
                     help="Number of exemplars")
+threads.add_thread_args(parser)
 
 def calc_acc(plabels, glabels):
     '''
@@ -48,10 +51,7 @@ def forward_pass(model, loader, train_loader, num_classes, mode='val'):
     with tqdm(total=int(len(loader)), ascii=True) as pbar:
         with torch.no_grad():
             for data in loader:
-                if mode == 'val':
-                    img_input, points_input, values, labels = data
-                else:
-                    img_input, points_input, values, _, _, _, _, labels = data
+                img_input, labels = data
                 img_input = Variable(img_input).cuda()
 
                 feats.append(model(img_input).cpu().numpy())
@@ -77,7 +77,7 @@ def get_exemplar_feats(model, loader):
     with tqdm(total=int(len(loader)), ascii=True) as pbar:
         with torch.no_grad():
             for data in loader:
-                img_input, points_input, values, labels = data
+                img_input, labels = data
                 img_input = Variable(img_input).cuda()
 
                 feats.append(model(img_input).cpu().numpy())
@@ -114,6 +114,10 @@ def compute_dist(feats, exemplar_feats):
 def main():
     args = parser.parse_args()
     num_explr = args.num_explr
+    # Cores for intra-op threads and loader workers
+    thread_plan = threads.plan_threads('proxy', 'cuda', args)
+    print('Thread plan: %s'%(thread_plan))
+    thread_plan.apply()
 
     torch.backends.cudnn.benchmark=True
     out_dir = config.training['out_dir']
@@ -125,16 +129,23 @@ def main():
 
     # Dataset
     print('Loading data...')
-    train_dataset = Dataset(num_points=2048, mode='train', shape_rep=shape_rep, \
-        coord_system=coord_system, config=config)
-    test_dataset = Dataset(num_points=2048, mode='test', shape_rep=shape_rep, \
-        coord_system=coord_system, config=config)
+    # Read from packed shards if available
+    if config.path['packed_dataset_path'] is not None:
+        dataset_cls = Dataset_Packed
+    else:
+        dataset_cls = Dataset
+    # Only the encoder is used, so only the inputs are loaded
+    train_dataset = dataset_cls(num_points=2048, mode='train', shape_rep=shape_rep, \
+        coord_system=coord_system, config=config, image_only=True)
+    test_dataset = dataset_cls(num_points=2048, mode='test', shape_rep=shape_rep, \
+        coord_system=coord_system, config=config, image_only=True)
 
     train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=256, num_workers=12, shuffle=True,\
-            pin_memory=True)
+        train_dataset, batch_size=256, num_workers=thread_plan.num_workers, shuffle=True,\
+            worker_init_fn=thread_plan.worker_init_fn, pin_memory=True)
     test_loader = torch.utils.data.DataLoader(
-        test_dataset, batch_size=100, num_workers=12, drop_last=False,pin_memory=True)
+        test_dataset, batch_size=100, num_workers=thread_plan.num_workers, drop_last=False,\
+        worker_init_fn=thread_plan.worker_init_fn, pin_memory=True)
 
     # Model
     print('Initializing network...')
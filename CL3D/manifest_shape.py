@@ -0,0 +1,132 @@
+########### Cached index of the objects and view files of a data split
+import os
+import json
+import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Manifests loaded in this process, keyed by manifest key
+_manifests = {}
+
+def get_manifest_dir(config):
+    '''
+    Directory of the cached manifests, manifest_dir of the path config or
+    a manifest directory in out_dir
+    '''
+    if config.path['manifest_dir'] is not None:
+        return config.path['manifest_dir']
+    return os.path.join(config.training['out_dir'], 'manifest')
+
+def get_manifest_key(config):
+    '''
+    Key of a manifest, built from the split json and the path config
+    '''
+    key = [config.path['data_split_json_path'], config.path['src_dataset_path'], \
+        config.path['src_ptcl_path'], config.path['input_image_path'], \
+        config.path['input_depth_path'], config.path['input_normal_path'], \
+        config.path['input_seg_path'], config.data_setting['img_extension']]
+    return hashlib.md5(repr(key).encode()).hexdigest()
+
+def get_mtime(path):
+    if not os.path.exists(path):
+        return None
+    return os.path.getmtime(path)
+
+def get_mtimes(config, data_splits):
+    '''
+    Modification times the manifest depends on: the split json and the
+    category directories, which change when objects are added or removed
+    '''
+    cats = sorted(set([cat for split in data_splits.values() for cat in split]))
+    mtimes = {'split': get_mtime(config.path['data_split_json_path'])}
+    for cat in cats:
+        mtimes[cat] = (get_mtime(os.path.join(config.path['src_dataset_path'], cat)), \
+            get_mtime(os.path.join(config.path['src_ptcl_path'], cat)))
+    return mtimes
+
+def list_files(obj_path, sub_dir, extension):
+    '''
+    Sorted names of files with an extension in a view directory, same as
+    sorted(glob(obj_path/sub_dir/*.extension)). None if there is no
+    such directory
+    '''
+    if sub_dir is None:
+        return None
+    dir_path = os.path.join(obj_path, sub_dir)
+    if not os.path.isdir(dir_path):
+        return None
+    suffix = '.%s'%(extension)
+    return sorted([f for f in os.listdir(dir_path) \
+        if f.endswith(suffix) and not f.startswith('.')])
+
+def scan_object(config, obj, cat):
+    '''
+    Manifest entry of an object, None if it is not in src_dataset_path
+    '''
+    obj_path = os.path.join(config.path['src_dataset_path'], cat, obj)
+    if not os.path.exists(obj_path):
+        return None
+    img_extension = config.data_setting['img_extension']
+    return {'obj': obj, 'cat': cat, \
+        'pointcloud': os.path.exists(os.path.join(config.path['src_ptcl_path'], cat, obj)), \
+        'image': list_files(obj_path, config.path['input_image_path'], img_extension), \
+        'depth': list_files(obj_path, config.path['input_depth_path'], 'npz'), \
+        'normal': list_files(obj_path, config.path['input_normal_path'], img_extension), \
+        'seg': list_files(obj_path, config.path['input_seg_path'], img_extension)}
+
+def build_manifest(config, data_splits, num_threads=16):
+    '''
+    Scan the objects of all splits with a thread pool
+    returns:
+        dict of split name to list of object entries in split order
+    '''
+    manifest = {}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for mode, split in data_splits.items():
+            objs = [(obj, cat) for cat in sorted(split.keys()) for obj in split[cat]]
+            entries = executor.map(lambda oc: scan_object(config, *oc), objs)
+            manifest[mode] = [e for e in entries if e is not None]
+    return manifest
+
+def get_manifest(config, mode):
+    '''
+    Get the manifest entries of a split. The manifest is loaded from
+    get_manifest_dir and rebuilt if the split json or the category directories
+    changed since it was built. Manifests are shared by all Datasets of a
+    process
+    args:
+        config: config module
+        mode: split name
+    '''
+    key = get_manifest_key(config)
+    with open(config.path['data_split_json_path'], 'r') as data_split_file:
+        data_splits = json.load(data_split_file)
+    mtimes = get_mtimes(config, data_splits)
+
+    if key in _manifests and _manifests[key]['mtimes'] == mtimes:
+        return _manifests[key]['splits'][mode]
+
+    manifest_dir = get_manifest_dir(config)
+    manifest_path = os.path.join(manifest_dir, '%s.pkl'%(key))
+    manifest = None
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'rb') as manifest_file:
+                manifest = pickle.load(manifest_file)
+        except Exception:
+            print('Cannot load manifest %s'%(manifest_path))
+        if manifest is not None and manifest['mtimes'] != mtimes:
+            manifest = None
+
+    if manifest is None:
+        print('Building manifest of %s...'%(config.path['data_split_json_path']))
+        manifest = {'mtimes': mtimes, 'splits': build_manifest(config, data_splits)}
+        os.makedirs(manifest_dir, exist_ok=True)
+        # Write to a temporary file first so readers never see partial files
+        tmp_path = '%s.%s.tmp'%(manifest_path, os.getpid())
+        with open(tmp_path, 'wb') as manifest_file:
+            pickle.dump(manifest, manifest_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, manifest_path)
+
+    _manifests[key] = manifest
+    return manifest['splits'][mode]
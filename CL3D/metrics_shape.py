@@ -0,0 +1,137 @@
+########### Evaluation loss and metrics accumulated on the device of the network
+import torch
+import torch.nn.functional as F
+import numpy as np
+import utils_shape as utils
+import distributed_shape as distributed
+
+def sample_iou(occ_pred, occ):
+    '''
+    IoU of each sample of a batch of boolean occupancies, 0 for an empty
+    union
+    returns:
+        IoU and union area of each sample
+    '''
+    occ_pred = occ_pred.reshape(occ_pred.size(0), -1)
+    occ = occ.reshape(occ.size(0), -1)
+    area_union = (occ_pred | occ).sum(dim=-1).double()
+    area_intersect = (occ_pred & occ).sum(dim=-1).double()
+    return area_intersect/area_union.clamp(min=1), area_union
+
+def batch_iou(occ_pred, occ):
+    '''
+    Mean IoU over a batch of boolean occupancies, as utils_shape.compute_iou:
+    0 if any sample has an empty union
+    '''
+    iou, area_union = sample_iou(occ_pred, occ)
+    iou = iou.mean()
+    return torch.where(area_union.min() == 0, torch.zeros_like(iou), iou)
+
+def sample_loss(logits, values, shape_rep):
+    '''
+    Loss of each sample of a batch, the batch mean is the training loss
+    '''
+    if shape_rep == 'occ':
+        return F.binary_cross_entropy_with_logits(logits, values, \
+            reduction='none').mean(dim=-1)
+    return utils.LpLoss(logits, values, reduce=False)
+
+class EvalMetrics(object):
+    '''
+    Running sums of the loss and metrics of the batches of an evaluation,
+    kept on the device so batches need no copy to host. Metrics are the
+    ones of utils_shape.compute_iou for occ and utils_shape.compute_acc
+    (sign accuracy, threshold accuracy, IoU) for sdf. By default they are
+    averaged over batches, with num_labels or keep_samples over samples
+    args:
+        shape_rep: 'occ' or 'sdf'
+        device: device of the logits
+        thres: distance threshold of the sdf threshold accuracy
+        iso: iso value of the sdf surface
+        num_labels: number of labels to aggregate separately
+        keep_samples: whether to also keep the loss, metrics and label of
+            every sample, see get_samples
+    '''
+    def __init__(self, shape_rep, device, thres=0.01, iso=0.003, num_labels=None, \
+        keep_samples=False):
+        self.shape_rep = shape_rep
+        self.thres = thres
+        self.iso = iso
+        self.num_labels = num_labels
+        self.keep_samples = keep_samples
+        self.samples = []
+        num_metrics = 1 if shape_rep == 'occ' else 3
+        # Loss sum, metric sums and number of batches or samples
+        shape = (num_metrics+2,) if num_labels is None else (num_labels, num_metrics+2)
+        self.sums = torch.zeros(shape, dtype=torch.float64, device=device)
+
+    def get_sample_metrics(self, logits, values):
+        '''
+        Metrics of each sample and union areas of their IoU
+        '''
+        if self.shape_rep == 'occ':
+            iou, area_union = sample_iou(torch.sigmoid(logits) >= 0.5, values >= 0.5)
+            return [iou], area_union
+        acc_sign = (((logits-self.iso)*(values-self.iso)) > 0).double().mean(dim=-1)
+        acc_thres = (torch.abs(logits-values) <= self.thres).double().mean(dim=-1)
+        iou, area_union = sample_iou(logits <= self.iso, values <= self.iso)
+        return [acc_sign, acc_thres, iou], area_union
+
+    def update(self, loss, logits, values, labels=None):
+        '''
+        Add a batch
+        args:
+            loss: mean loss of the batch, or loss of each sample with
+                num_labels or keep_samples
+            logits: network output, B x N
+            values: occupancy or sdf targets, B x N
+            labels: label of each sample, with num_labels or keep_samples
+        '''
+        logits = logits.detach().float()
+        metrics, area_union = self.get_sample_metrics(logits, values)
+        if self.num_labels is not None or self.keep_samples:
+            ones = torch.ones_like(metrics[0])
+            stats = torch.stack([loss.detach().double()]+metrics+[ones], dim=1)
+            labels = labels.to(self.sums.device)
+            if self.keep_samples:
+                self.samples.append(torch.cat([stats[:, :-1], \
+                    labels.double().unsqueeze(1)], dim=1))
+            if self.num_labels is not None:
+                self.sums.index_add_(0, labels, stats)
+            else:
+                self.sums += stats.sum(dim=0)
+            return
+        metrics = [m.mean() for m in metrics]
+        # IoU of the batch is 0 if any sample has an empty union
+        metrics[-1] = torch.where(area_union.min() == 0, \
+            torch.zeros_like(metrics[-1]), metrics[-1])
+        one = torch.ones((), dtype=torch.float64, device=self.sums.device)
+        self.sums += torch.stack([loss.detach().double()]+metrics+[one])
+
+    def compute(self):
+        '''
+        Mean loss and metrics over all distributed processes, the only copy
+        to host
+        returns:
+            mean loss and array of mean metrics, per label with num_labels
+            (nan for labels without samples)
+        '''
+        sums = distributed.all_reduce_sum(self.sums.cpu().numpy())
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums[..., 0]/sums[..., -1], sums[..., 1:-1]/sums[..., -1:]
+
+    def get_samples(self):
+        '''
+        Loss, metrics and label of every sample, gathered from all
+        distributed processes in the order of the dataset positions split
+        by an unpadded ExposureSampler
+        returns:
+            array of losses, array samples x metrics and array of labels
+        '''
+        if len(self.samples) != 0:
+            rows = torch.cat(self.samples).cpu().numpy()
+        else:
+            rows = np.zeros((0, self.sums.size(-1)))
+        num_samples = int(distributed.all_reduce_sum([len(rows)])[0])
+        rows = distributed.gather_strided(rows, num_samples)
+        return rows[:, 0], rows[:, 1:-1], rows[:, -1].astype(np.int64)
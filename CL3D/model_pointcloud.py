@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from model_shape import SDFNet
+from model_shape import SDFNet, checkpoint_block
 
 
 def maxpool(x, dim=-1, keepdim=False):
@@ -11,7 +11,8 @@ class PointCloudNet(SDFNet):
 
 	def __init__(self, config, input_point_dim=3, latent_dim=512, size_hidden=512, pretrained=False):
 		super().__init__(config, input_point_dim, latent_dim, size_hidden, pretrained)
-		self.encoder = ResnetPointnet(latent_dim=latent_dim, size_hidden=size_hidden)
+		self.encoder = ResnetPointnet(latent_dim=latent_dim, size_hidden=size_hidden, \
+			checkpoint_blocks=config.training['checkpoint_blocks'])
 
 
 class ResnetPointnet(nn.Module):
@@ -23,11 +24,14 @@ class ResnetPointnet(nn.Module):
         size_hidden: dimension of points block hidden size, default to 512
         pretrained: whether the encoder is ImageNet pretrained, 
             default to False
+        checkpoint_blocks: whether to recompute the activations of the
+            residual blocks in the backward pass instead of storing them
     '''
 
-    def __init__(self, latent_dim=128, point_dim=3, size_hidden=128):
+    def __init__(self, latent_dim=128, point_dim=3, size_hidden=128, checkpoint_blocks=False):
         super().__init__()
         self.latent_dim = latent_dim
+        self.checkpoint_blocks = checkpoint_blocks
 
         self.fc_pos = nn.Linear(point_dim, 2*size_hidden)
         self.block_0 = ResnetBlockFC(2*size_hidden, size_hidden)
@@ -45,23 +49,23 @@ class ResnetPointnet(nn.Module):
 
         # output size: B x T X F
         net = self.fc_pos(p)
-        net = self.block_0(net)
+        net = self.run_block(self.block_0, net)
         pooled = self.pool(net, dim=1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=2)
 
-        net = self.block_1(net)
+        net = self.run_block(self.block_1, net)
         pooled = self.pool(net, dim=1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=2)
 
-        net = self.block_2(net)
+        net = self.run_block(self.block_2, net)
         pooled = self.pool(net, dim=1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=2)
 
-        net = self.block_3(net)
+        net = self.run_block(self.block_3, net)
         pooled = self.pool(net, dim=1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=2)
 
-        net = self.block_4(net)
+        net = self.run_block(self.block_4, net)
 
         # Recude to  B x F
         net = self.pool(net, dim=1)
@@ -70,6 +74,11 @@ class ResnetPointnet(nn.Module):
 
         return c
 
+    def run_block(self, block, net):
+        if self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint_block(block, net)
+        return block(net)
+
 class ResnetBlockFC(nn.Module):
     ''' Fully connected ResNet Block class.
     Args:
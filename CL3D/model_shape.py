@@ -1,6 +1,39 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torchvision import models
+import inspect
+
+def float32_inputs(module, inputs):
+    '''
+    Forward pre-hook casting the inputs of a module to float32, a no-op
+    without autocast
+    '''
+    return tuple(x.float() for x in inputs)
+
+def checkpoint_block(block, *inputs):
+    '''
+    Run a block without storing its activations, they are recomputed in
+    the backward pass. BatchNorm running statistics of the block are
+    restored after the recomputation, so they are updated once per step
+    '''
+    state = {'recompute': False}
+    def run(*inputs):
+        if not state['recompute']:
+            state['recompute'] = True
+            return block(*inputs)
+        buffers = [(b, b.clone()) for m in block.modules() \
+            if isinstance(m, nn.modules.batchnorm._BatchNorm) for b in m.buffers()]
+        try:
+            return block(*inputs)
+        finally:
+            for b, saved in buffers:
+                b.copy_(saved)
+    kwargs = {}
+    # Non-reentrant checkpointing where available (torch>=1.11)
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+        kwargs['use_reentrant'] = False
+    return checkpoint(run, *inputs, **kwargs)
 
 class SDFNet(nn.Module):
     ''' SDFNet 3D regressor class
@@ -17,9 +50,15 @@ class SDFNet(nn.Module):
         super().__init__()
 
         self.encoder = Encoder(config, latent_dim, pretrained=pretrained)
-        self.decoder = Decoder(input_point_dim, latent_dim, size_hidden)
+        self.decoder = Decoder(input_point_dim, latent_dim, size_hidden, \
+            checkpoint_blocks=config.training['checkpoint_blocks'])
         self.config = config
 
+        # BatchNorm statistics stay in float32 under bf16 autocast
+        for module in self.modules():
+            if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                module.register_forward_pre_hook(float32_inputs)
+
     def forward(self, points, inputs):
         assert points.size(0) == inputs.size(0)
         batch_size = points.size(0)
@@ -50,8 +89,13 @@ class Encoder(nn.Module):
         return latent_feat 
 
 class Decoder(nn.Module):
-    def __init__(self, input_dim, latent_dim, size_hidden):
+    '''
+    checkpoint_blocks: whether to recompute the activations of the
+        residual blocks in the backward pass instead of storing them
+    '''
+    def __init__(self, input_dim, latent_dim, size_hidden, checkpoint_blocks=False):
         super().__init__()
+        self.checkpoint_blocks = checkpoint_blocks
         self.fc_p = nn.Conv1d(input_dim, size_hidden, 1)
         
         self.block0 = CResnetBlockConv(latent_dim, size_hidden)
@@ -71,17 +115,22 @@ class Decoder(nn.Module):
         batch_size, D, T = p.size()
         net = self.fc_p(p)
 
-        net = self.block0(net, c)
-        net = self.block1(net, c)
-        net = self.block2(net, c)
-        net = self.block3(net, c)
-        net = self.block4(net, c)
+        net = self.run_block(self.block0, net, c)
+        net = self.run_block(self.block1, net, c)
+        net = self.run_block(self.block2, net, c)
+        net = self.run_block(self.block3, net, c)
+        net = self.run_block(self.block4, net, c)
 
         out = self.fc_out(self.actvn(self.bn(net, c)))
         out = out.squeeze(1)
 
         return out
 
+    def run_block(self, block, net, c):
+        if self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint_block(block, net, c)
+        return block(net, c)
+
 class CBatchNorm(nn.Module):
     def __init__(self, latent_dim, feature_dim):
         super().__init__()
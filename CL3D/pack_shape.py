@@ -0,0 +1,313 @@
+########### Pack a data split into a few large memory-mappable shard files
+import numpy as np
+import os
+import json
+import h5py
+import argparse
+from multiprocessing import Pool
+from tqdm import tqdm
+import config_shape as config
+import quantize_shape as quantize
+from dataloader_shape import Dataset, PTCL_NPY
+
+parser = argparse.ArgumentParser(description="Pack dataset split")
+parser.add_argument("--out_dir", default=config.path['packed_dataset_path'], type=str,
+                    help="Output directory of the packed dataset")
+parser.add_argument("--modes", default=['train', 'val', 'test'], nargs='+',
+                    help="Splits of data_split_json_path to pack")
+parser.add_argument("--inputs", action='store_true',
+                    help="Also store the decoded input tensors of every view")
+parser.add_argument("--num_workers", default=12, type=int,
+                    help="Number of processes decoding input views")
+parser.add_argument("--ptcl_npy", action='store_true',
+                    help="Instead of packing, write the GT pointcloud of every object "
+                    "as a memory-mappable %s next to its pointcloud.npz"%(PTCL_NPY))
+parser.add_argument("--quantize", action='store_true',
+                    help="Store sdf samples and pointclouds with 16-bit fixed-point "
+                    "coordinates, compact sdf values and bit-packed occupancy")
+parser.add_argument("--coord_bound", default=1., type=float,
+                    help="Coordinates of quantized shards are in [-coord_bound, coord_bound]")
+parser.add_argument("--sdf_encoding", default='float16', choices=['float16', 'int8log'],
+                    help="Encoding of quantized sdf values")
+parser.add_argument("--log_eps", default=1e-4, type=float,
+                    help="Scale of int8log sdf values, their error is about 4%% of |sdf|+log_eps")
+parser.add_argument("--iso", default=0.003, type=float,
+                    help="Iso value of the precomputed occupancy of quantized shards")
+
+# Shard files written for every split
+SDF_SHARD = 'sdf.npy'
+PTCL_SHARD = 'pointcloud.npy'
+META_SHARD = 'meta.npy'
+HVC_META_SHARD = 'hvc_meta.npy'
+# num objects x seq_len x C x input_size x input_size, float16 or float32
+# with lossless_depth
+INPUT_SHARD = 'inputs.npy'
+INDEX_FILE = 'index.npz'
+# Shards written instead of SDF_SHARD and PTCL_SHARD with --quantize, see
+# quantize_shape. Sdf coordinates and pointcloud points are fixed-point in
+# [-coord_bound, coord_bound], normals in [-1, 1]
+SDF_COORDS_SHARD = 'sdf_coords_q.npy'
+# float16 or int8 log-scaled
+SDF_VALUES_SHARD = 'sdf_values_q.npy'
+# Occupancy at iso, 8 samples per byte, each object starts at a byte
+OCC_SHARD = 'occ_bits.npy'
+PTCL_Q_SHARD = 'pointcloud_q.npy'
+
+
+def get_sdf_count(sdf_h5_file):
+    '''
+    Number of sdf samples of an object without reading them
+    '''
+    with h5py.File(sdf_h5_file, 'r') as h5_f:
+        shape = h5_f['pc_sdf_sample'].shape
+    if shape[1] != 4:
+        raise Exception("%s has no sample points"%(sdf_h5_file))
+    return shape[0]
+
+def get_pointcloud_count(pointcld_path):
+    '''
+    Number of GT points of an object, 0 if there is no pointcloud
+    '''
+    pointcld_file = os.path.join(pointcld_path, 'pointcloud.npz')
+    if not os.path.exists(pointcld_file):
+        return 0
+    with np.load(pointcld_file) as ptcld_dict:
+        return len(ptcld_dict['points'])
+
+# Dataset decoding input views in pack worker processes
+_pack_dataset = None
+
+def init_pack_worker(dataset):
+    global _pack_dataset
+    _pack_dataset = dataset
+
+def decode_object_inputs(index):
+    '''
+    Decoded input tensors of all views of an object
+    '''
+    return np.stack([_pack_dataset.decode_image_data(index, img_idx) \
+        for img_idx in range(_pack_dataset.seq_len)])
+
+def pack_inputs(dataset, split_dir, num_workers):
+    '''
+    Decode the input images of every (object, view) once and store the
+    final input tensors. Stored in float16, or in float32 with
+    lossless_depth
+    '''
+    num_obj = len(dataset.obj_cat_map)
+    if num_obj == 0:
+        return
+    input_shape = dataset.decode_image_data(0, 0).shape
+    dtype = np.float32 if dataset.lossless_depth else np.float16
+    inputs = np.lib.format.open_memmap(os.path.join(split_dir, INPUT_SHARD), \
+        mode='w+', dtype=dtype, shape=(num_obj, dataset.seq_len)+input_shape)
+
+    print('Decoding input views...')
+    with Pool(num_workers, initializer=init_pack_worker, initargs=(dataset,)) as pool:
+        with tqdm(total=num_obj, ascii=True) as pbar:
+            for i, obj_inputs in enumerate(pool.imap(decode_object_inputs, range(num_obj))):
+                inputs[i] = obj_inputs
+                pbar.update(1)
+    inputs.flush()
+    del inputs
+
+def get_quantize_setting(args):
+    '''
+    Quantization setting of the arguments, None without --quantize
+    '''
+    if not args.quantize:
+        return None
+    # Sdf values are at most the diagonal of the coordinate box
+    return {'coord_bound': args.coord_bound, 'sdf_encoding': args.sdf_encoding, \
+        'log_eps': args.log_eps, 'log_max': 2*np.sqrt(3)*args.coord_bound, \
+        'iso': args.iso}
+
+def quantize_object(obj_sdf, obj_ptcl, setting, errors):
+    '''
+    Encode the sdf samples and pointcloud of an object and verify the
+    decoding errors against their bounds
+    args:
+        obj_sdf: N x 4 sdf samples
+        obj_ptcl: M x 6 points and normals
+        setting: see get_quantize_setting
+        errors: maximum errors so far, updated in place
+    returns:
+        sdf coordinates, sdf values, occupancy bytes and pointcloud
+    '''
+    bound = setting['coord_bound']
+    sdf_args = (setting['sdf_encoding'], setting['log_eps'], setting['log_max'])
+    coords = quantize.encode_fixed(obj_sdf[:, :3], bound)
+    values = quantize.encode_sdf(obj_sdf[:, 3], *sdf_args)
+    occ = quantize.pack_occ(obj_sdf[:, 3], setting['iso'])
+    ptcl = np.concatenate([quantize.encode_fixed(obj_ptcl[:, :3], bound), \
+        quantize.encode_fixed(obj_ptcl[:, 3:], 1.)], axis=1)
+
+    errors['coord'] = max(errors['coord'], quantize.verify('Coordinate', \
+        obj_sdf[:, :3], quantize.decode_fixed(coords, bound), \
+        quantize.fixed_error_bound(bound)))
+    errors['sdf'] = max(errors['sdf'], quantize.verify('Sdf', obj_sdf[:, 3], \
+        quantize.decode_sdf(values, *sdf_args), \
+        quantize.sdf_error_bound(obj_sdf[:, 3], *sdf_args)))
+    errors['point'] = max(errors['point'], quantize.verify('Point', \
+        obj_ptcl[:, :3], quantize.decode_fixed(ptcl[:, :3], bound), \
+        quantize.fixed_error_bound(bound)))
+    errors['normal'] = max(errors['normal'], quantize.verify('Normal', \
+        obj_ptcl[:, 3:], quantize.decode_fixed(ptcl[:, 3:], 1.), \
+        quantize.fixed_error_bound(1.)))
+    rows = np.arange(len(obj_sdf))
+    if np.any(quantize.unpack_occ(occ, rows) != (obj_sdf[:, 3] <= setting['iso'])):
+        raise Exception("Occupancy decoding mismatch")
+    return coords, values, occ, ptcl
+
+def pack_split(mode, out_dir, inputs=False, num_workers=12, quantize_setting=None):
+    '''
+    Pack sdf samples, GT pointclouds and view metadata of a split.
+    Variable length arrays are concatenated into a single shard and
+    indexed by per object offsets
+    args:
+        mode: split name in data_split_json_path
+        out_dir: root directory of the packed dataset
+        inputs: whether to store decoded input tensors
+        num_workers: number of processes decoding input views
+        quantize_setting: see get_quantize_setting, None for float32
+    '''
+    # 3dvc so that 3-DOF VC metadata paths are resolved
+    dataset = Dataset(config, mode=mode, coord_system='3dvc')
+    num_obj = len(dataset.obj_cat_map)
+    seq_len = dataset.seq_len
+    split_dir = os.path.join(out_dir, mode)
+    os.makedirs(split_dir, exist_ok=True)
+    print('Packing %s objects of split %s...'%(num_obj, mode))
+
+    sdf_counts = np.zeros(num_obj, dtype=np.int64)
+    ptcl_counts = np.zeros(num_obj, dtype=np.int64)
+    obj_metas = []
+    for i in range(num_obj):
+        sdf_counts[i] = get_sdf_count(dataset.sdf_h5_paths[i])
+        ptcl_counts[i] = get_pointcloud_count(dataset.pointcld_split_paths[i])
+        obj_metas.append(np.loadtxt(dataset.metadata_split_paths[i], ndmin=2)[:seq_len, :2])
+    # Checked before any shard is written
+    short = [dataset.metadata_split_paths[i] for i in range(num_obj) \
+        if len(obj_metas[i]) < seq_len]
+    if len(short) != 0:
+        raise Exception("%s objects have fewer than seq_len=%s views in their metadata: %s"\
+            %(len(short), seq_len, ', '.join(short)))
+    sdf_offsets = np.concatenate([[0], np.cumsum(sdf_counts)])
+    ptcl_offsets = np.concatenate([[0], np.cumsum(ptcl_counts)])
+    # Byte offsets of the occupancy of each object
+    occ_offsets = np.concatenate([[0], np.cumsum((sdf_counts+7)//8)])
+
+    def open_shard(name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(split_dir, name), \
+            mode='w+', dtype=dtype, shape=shape)
+
+    num_sdf, num_ptcl = int(sdf_offsets[-1]), int(ptcl_offsets[-1])
+    if quantize_setting is None:
+        sdf = open_shard(SDF_SHARD, np.float32, (num_sdf, 4))
+        ptcl = open_shard(PTCL_SHARD, np.float32, (num_ptcl, 6))
+        shards = [sdf, ptcl]
+    else:
+        sdf_coords = open_shard(SDF_COORDS_SHARD, np.uint16, (num_sdf, 3))
+        sdf_values = open_shard(SDF_VALUES_SHARD, np.float16 \
+            if quantize_setting['sdf_encoding'] == 'float16' else np.int8, (num_sdf,))
+        occ = open_shard(OCC_SHARD, np.uint8, (int(occ_offsets[-1]),))
+        ptcl = open_shard(PTCL_Q_SHARD, np.uint16, (num_ptcl, 6))
+        shards = [sdf_coords, sdf_values, occ, ptcl]
+        errors = {'coord': 0., 'sdf': 0., 'point': 0., 'normal': 0.}
+    meta = open_shard(META_SHARD, np.float64, (num_obj, seq_len, 2))
+    hvc_meta = open_shard(HVC_META_SHARD, np.float64, (num_obj, 2))
+
+    for i in tqdm(range(num_obj), ascii=True):
+        with h5py.File(dataset.sdf_h5_paths[i], 'r') as h5_f:
+            obj_sdf = h5_f['pc_sdf_sample'][:]
+
+        obj_ptcl = np.zeros((ptcl_counts[i], 6), dtype=np.float32)
+        if ptcl_counts[i] != 0:
+            pointcld_file = os.path.join(dataset.pointcld_split_paths[i], \
+                'pointcloud.npz')
+            with np.load(pointcld_file) as ptcld_dict:
+                obj_ptcl[:, :3] = ptcld_dict['points']
+                obj_ptcl[:, 3:] = ptcld_dict['normals']
+
+        sdf_rows = slice(sdf_offsets[i], sdf_offsets[i+1])
+        ptcl_rows = slice(ptcl_offsets[i], ptcl_offsets[i+1])
+        if quantize_setting is None:
+            sdf[sdf_rows] = obj_sdf
+            ptcl[ptcl_rows] = obj_ptcl
+        else:
+            sdf_coords[sdf_rows], sdf_values[sdf_rows], \
+                occ[occ_offsets[i]:occ_offsets[i+1]], ptcl[ptcl_rows] = \
+                quantize_object(obj_sdf, obj_ptcl, quantize_setting, errors)
+
+        meta[i] = obj_metas[i]
+        if os.path.exists(dataset.hvc_metadata_split_paths[i]):
+            hvc_meta[i] = np.loadtxt(dataset.hvc_metadata_split_paths[i])[:2]
+        else:
+            hvc_meta[i] = np.nan
+
+    for shard in shards+[meta, hvc_meta]:
+        shard.flush()
+    del shards, meta, hvc_meta
+
+    index = {'obj': np.array([obj for obj, _ in dataset.obj_cat_map], dtype=np.bytes_), \
+        'cat': np.array([cat for _, cat in dataset.obj_cat_map], dtype=np.bytes_), \
+        'sdf_offsets': sdf_offsets, 'ptcl_offsets': ptcl_offsets, 'seq_len': seq_len}
+    if quantize_setting is not None:
+        print('Maximum quantization errors: %s'%(errors))
+        index.update(quantize_setting)
+        index.update({'quantized': True, 'occ_offsets': occ_offsets})
+        index.update({'%s_error'%(k): v for k, v in errors.items()})
+    np.savez(os.path.join(split_dir, INDEX_FILE), **index)
+
+    if inputs:
+        pack_inputs(dataset, split_dir, num_workers)
+
+def write_pointcloud_npy(mode):
+    '''
+    Write points and normals of every pointcloud.npz of a split as one
+    N x 6 float32 PTCL_NPY file in the same directory
+    args:
+        mode: split name in data_split_json_path
+    '''
+    # Object centered, view metadata is not needed
+    dataset = Dataset(config, mode=mode, coord_system='oc')
+    print('Writing %s of split %s...'%(PTCL_NPY, mode))
+    for pointcld_path in tqdm(dataset.pointcld_split_paths, ascii=True):
+        pointcld_file = os.path.join(pointcld_path, 'pointcloud.npz')
+        if not os.path.exists(pointcld_file):
+            continue
+        with np.load(pointcld_file) as ptcld_dict:
+            obj_ptcl = np.concatenate([ptcld_dict['points'], \
+                ptcld_dict['normals']], axis=1).astype(np.float32)
+        # Write to a temporary file first so readers never see partial files
+        npy_file = os.path.join(pointcld_path, PTCL_NPY)
+        tmp_file = '%s.%s.tmp'%(npy_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, obj_ptcl)
+        os.replace(tmp_file, npy_file)
+
+def main():
+    args = parser.parse_args()
+    if args.ptcl_npy:
+        with open(config.path['data_split_json_path'], 'r') as data_split_file:
+            data_splits = json.load(data_split_file)
+        for mode in args.modes:
+            if mode in data_splits:
+                write_pointcloud_npy(mode)
+        return
+    if args.out_dir is None:
+        raise Exception("Please specify --out_dir or packed_dataset_path in config")
+
+    with open(config.path['data_split_json_path'], 'r') as data_split_file:
+        data_splits = json.load(data_split_file)
+
+    for mode in args.modes:
+        if mode not in data_splits:
+            print('Split %s not in %s, skipping'%(mode, \
+                config.path['data_split_json_path']))
+            continue
+        pack_split(mode, args.out_dir, args.inputs, args.num_workers, \
+            get_quantize_setting(args))
+
+if __name__ == '__main__':
+    main()
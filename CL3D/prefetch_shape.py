@@ -0,0 +1,79 @@
+########### Background warming of the page cache for upcoming learning exposures
+import time
+import threading
+
+class ExposurePrefetcher(object):
+    '''
+    Reads the files of all objects of upcoming classes in a background
+    thread, so that they are in the OS page cache when their exposure
+    starts. Reads are rate limited to leave I/O bandwidth to the loaders
+    of the current exposure
+    args:
+        rate: maximum read rate in bytes per second
+        chunk_size: size of each read in bytes
+    '''
+    def __init__(self, rate, chunk_size=1<<20):
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.thread = None
+        self.stop_event = threading.Event()
+        # Bytes read by the last prefetch
+        self.bytes_read = 0
+
+    def prefetch(self, datasets, classes):
+        '''
+        Start warming the files of the objects of classes in datasets.
+        A running prefetch is stopped first
+        args:
+            datasets: Datasets whose files are read
+            classes: classes of the upcoming exposure
+        '''
+        self.stop()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, \
+            args=(list(datasets), list(classes), self.stop_event), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self, datasets, classes, stop_event):
+        buf = memoryview(bytearray(self.chunk_size))
+        start_time = time.time()
+        self.bytes_read = 0
+        for dataset in datasets:
+            for cls in classes:
+                for index in dataset.get_class_objects(cls):
+                    for path, offset, size in dataset.get_prefetch_ranges(index):
+                        if stop_event.is_set():
+                            return
+                        self.read_range(path, offset, size, buf, stop_event, start_time)
+
+    def read_range(self, path, offset, size, buf, stop_event, start_time):
+        '''
+        Read size bytes of a file from offset, size None for the rest of
+        the file. Missing files are skipped
+        '''
+        try:
+            f = open(path, 'rb', buffering=0)
+        except OSError:
+            return
+        with f:
+            f.seek(offset)
+            while size is None or size > 0:
+                if stop_event.is_set():
+                    return
+                n = self.chunk_size if size is None else min(size, self.chunk_size)
+                n = f.readinto(buf[:n])
+                if not n:
+                    return
+                self.bytes_read += n
+                if size is not None:
+                    size -= n
+                # Sleep until the average read rate is below the limit
+                delay = self.bytes_read/self.rate-(time.time()-start_time)
+                if delay > 0:
+                    stop_event.wait(delay)
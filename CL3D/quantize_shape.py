@@ -0,0 +1,86 @@
+########### Compact encodings of sdf samples, occupancy and pointclouds for packed shards
+import numpy as np
+
+# Number of steps of 16-bit fixed-point values
+FIXED_STEPS = 65535
+# Number of steps of each sign of int8 log-scaled sdf values
+LOG_STEPS = 127
+
+def encode_fixed(x, bound):
+    '''
+    16-bit fixed-point encoding of values in [-bound, bound]
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    if np.abs(x).max(initial=0) > bound:
+        raise Exception("Values outside of [-%s, %s], please increase the bound"\
+            %(bound, bound))
+    return np.round((x+bound)*(FIXED_STEPS/(2.*bound))).astype(np.uint16)
+
+def decode_fixed(q, bound):
+    return q.astype(np.float32)*np.float32(2.*bound/FIXED_STEPS)-np.float32(bound)
+
+def fixed_error_bound(bound):
+    '''
+    Maximum absolute error of encode_fixed: half a step, plus the float32
+    rounding of the decoded value
+    '''
+    return bound/FIXED_STEPS+bound*2.**-21
+
+def encode_sdf(sdf, encoding, log_eps, log_max):
+    '''
+    Encode sdf values as float16, or as int8 log1p(|sdf|/log_eps) scaled so
+    that log_max maps to LOG_STEPS
+    '''
+    sdf = np.asarray(sdf, dtype=np.float64)
+    if encoding == 'float16':
+        return sdf.astype(np.float16)
+    if encoding == 'int8log':
+        if np.abs(sdf).max(initial=0) > log_max:
+            raise Exception("Sdf values larger than %s"%(log_max))
+        step = np.log1p(log_max/log_eps)/LOG_STEPS
+        return (np.sign(sdf)*np.round(np.log1p(np.abs(sdf)/log_eps)/step)).astype(np.int8)
+    raise Exception("Sdf encoding %s not supported"%(encoding))
+
+def decode_sdf(q, encoding, log_eps, log_max):
+    if encoding == 'float16':
+        return q.astype(np.float32)
+    step = np.log1p(log_max/log_eps)/LOG_STEPS
+    q = q.astype(np.float32)
+    return (np.sign(q)*np.float32(log_eps)*np.expm1(np.abs(q)*np.float32(step)))\
+        .astype(np.float32)
+
+def sdf_error_bound(sdf, encoding, log_eps, log_max):
+    '''
+    Elementwise maximum absolute error of encode_sdf for values sdf
+    '''
+    sdf = np.abs(np.asarray(sdf, dtype=np.float64))
+    if encoding == 'float16':
+        # Half a unit in the last place, 2**-25 for subnormals
+        return sdf*2.**-11+2.**-25
+    step = np.log1p(log_max/log_eps)/LOG_STEPS
+    # Half a log step, plus float32 rounding of the decoded value
+    return (sdf+log_eps)*(np.expm1(step/2.)+2.**-20)
+
+def pack_occ(sdf, iso):
+    '''
+    Occupancy sdf <= iso packed 8 samples per byte
+    '''
+    return np.packbits(np.asarray(sdf) <= iso)
+
+def unpack_occ(bits, rows):
+    '''
+    Occupancy of rows from the bytes of pack_occ, as float32
+    '''
+    rows = np.asarray(rows)
+    return ((bits[rows >> 3] >> (7-(rows & 7))) & 1).astype(np.float32)
+
+def verify(name, x, decoded, bound):
+    '''
+    Check that decoded values are within the error bound of x
+    returns:
+        maximum absolute error
+    '''
+    error = np.abs(np.asarray(x, dtype=np.float64)-decoded)
+    if np.any(error > bound):
+        raise Exception("%s decoding error %s exceeds its bound"%(name, error.max()))
+    return float(error.max(initial=0))
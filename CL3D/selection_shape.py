@@ -0,0 +1,255 @@
+########### Best-model selection on a fixed class-stratified subset of the training classes, with bootstrap intervals
+import numpy as np
+from torch.utils.data import Sampler
+import distributed_shape as distributed
+
+class SubsetSampler(Sampler):
+    '''
+    Sampler of the loader evaluating the training classes. Iterates over
+    the dataset positions of indices when it is set, over sampler or the
+    current exposure otherwise. indices is changed between iterations,
+    so one loader and its persistent workers serve both. Processes take
+    strided parts of indices, as ExposureSampler without padding
+    args:
+        dataset: Dataset
+        sampler: sampler of the full evaluation, sequential if None
+    '''
+    def __init__(self, dataset, sampler=None):
+        self.dataset = dataset
+        self.sampler = sampler
+        self.indices = None
+
+    def get_indices(self):
+        if self.indices is not None:
+            return self.indices[distributed.get_rank()::distributed.get_world_size()].tolist()
+        if self.sampler is not None:
+            return list(self.sampler)
+        return list(range(len(self.dataset)))
+
+    def __iter__(self):
+        return iter(self.get_indices())
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(range(distributed.get_rank(), len(self.indices), \
+                distributed.get_world_size()))
+        if self.sampler is not None:
+            return len(self.sampler)
+        return len(self.dataset)
+
+def stratified_subset(dataset, num_objects, num_views, seed=0):
+    '''
+    Fixed subset of the current samples of a Dataset, with the same number
+    of objects of every current class and of views of every object. Views
+    are drawn at every access with random_view, and in groups of
+    views_per_object when the Dataset has them
+    args:
+        dataset: Dataset
+        num_objects: number of objects per class
+        num_views: number of views per object
+        seed: seed of the draw
+    returns:
+        sorted dataset positions, dict of number of current objects per class
+    '''
+    rng = np.random.RandomState(seed)
+    classes = sorted(set(cls for cls, _, _ in dataset.active_segments))
+    positions = []
+    class_objects = {}
+    for cls in classes:
+        objs = np.concatenate([np.arange(start, end) \
+            for seg_cls, start, end in dataset.active_segments if seg_cls == cls])
+        class_objects[cls] = len(objs)
+        if len(objs) == 0:
+            continue
+        objs = np.sort(rng.choice(objs, min(num_objects, len(objs)), replace=False))
+        if dataset.random_view:
+            positions.append(objs)
+            continue
+        # Dataset positions are groups of views_per_object views
+        views_per_object = dataset.views_per_object or 1
+        num_groups = dataset.seq_len//views_per_object
+        groups = np.stack([rng.choice(num_groups, min(-(-num_views//views_per_object), \
+            num_groups), replace=False) for _ in objs]).reshape(len(objs), -1)
+        positions.append((objs[:, None]*num_groups+np.sort(groups, axis=1)).reshape(-1))
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.int64), class_objects
+    return np.sort(np.concatenate(positions)).astype(np.int64), class_objects
+
+class ModelSelector(object):
+    '''
+    Decides whether the model of an epoch is the best of its exposure.
+    Candidates are scored on a fixed class-stratified subset of the
+    training classes, with a percentile bootstrap interval of every
+    selected metric. A candidate is better when its interval is above the
+    one of the best model, not better when it is not above the lower
+    bound of the best model, and otherwise the full set is evaluated and
+    its metric compared with the full metric of the best model (its
+    subset estimate when unknown)
+    args:
+        dataset: Dataset of the evaluation of the training classes
+        sampler: SubsetSampler of its loader
+        metric_ids: indices of the selected metrics in the metrics of eval
+        num_objects: objects per class of the subset, None to evaluate the
+            full set every time
+        num_views: views per object of the subset
+        num_resamples: number of bootstrap resamples
+        confidence: confidence level of the intervals
+        seed: seed of the subset and of the resamples
+    '''
+    def __init__(self, dataset, sampler, metric_ids, num_objects=None, num_views=1, \
+        num_resamples=1000, confidence=0.95, seed=0):
+        self.dataset = dataset
+        self.sampler = sampler
+        self.metric_ids = metric_ids
+        self.num_objects = num_objects
+        self.num_views = num_views
+        self.num_resamples = num_resamples
+        self.confidence = confidence
+        self.seed = seed
+        self.subset = None
+        self.class_weights = {}
+        self.reset()
+
+    def reset(self, exposure=0):
+        '''
+        Draw the subset of the current classes and forget the best model,
+        at the start of an exposure
+        '''
+        self.best = [dict(estimate=0., low=0., high=0., full=0.) for _ in self.metric_ids]
+        self.num_evals = 0
+        self.num_full = 0
+        if self.num_objects is None:
+            return
+        self.subset, class_objects = stratified_subset(self.dataset, self.num_objects, \
+            self.num_views, self.seed+exposure)
+        total = max(1., float(sum(class_objects.values())))
+        # Share of every class in the full set, by label
+        self.class_weights = {self.dataset.cat_map[cls]: count/total \
+            for cls, count in class_objects.items()}
+
+    def state_dict(self):
+        '''
+        Best model and counts of the current exposure, the subset is drawn
+        again by reset
+        '''
+        return {'best': [dict(best) for best in self.best], \
+            'num_evals': self.num_evals, 'num_full': self.num_full}
+
+    def load_state_dict(self, state):
+        self.best = [dict(best) for best in state['best']]
+        self.num_evals = state['num_evals']
+        self.num_full = state['num_full']
+
+    def bootstrap(self, values, labels):
+        '''
+        Estimate of the full-set mean of a metric from its values on the
+        subset, as the mean of the class means weighted by the class
+        shares, with its percentile bootstrap interval. Samples are
+        resampled within their class
+        returns:
+            estimate, lower and upper bounds of the interval
+        '''
+        rng = np.random.RandomState(self.seed)
+        estimate = 0.
+        resampled = np.zeros(self.num_resamples)
+        weights = {label: weight for label, weight in self.class_weights.items() \
+            if np.any(labels == label)}
+        total = sum(weights.values())
+        for label, weight in sorted(weights.items()):
+            class_values = values[labels == label]
+            draws = rng.randint(len(class_values), size=(self.num_resamples, len(class_values)))
+            estimate += weight/total*class_values.mean()
+            resampled += weight/total*class_values[draws].mean(axis=1)
+        alpha = 100.*(1.-self.confidence)/2.
+        low, high = np.percentile(resampled, [alpha, 100.-alpha])
+        return estimate, low, high
+
+    def evaluate(self, eval_fn):
+        '''
+        Score a candidate and update the best model
+        args:
+            eval_fn: eval_fn(samples) runs the evaluation of the training
+                classes over the loader of sampler, returning the mean loss
+                and metrics, and with samples the metrics and labels of
+                every sample
+        returns:
+            mean loss and metrics of the candidate, on the full set if it
+            was evaluated, whether the candidate is better for every
+            selected metric and whether the full set was evaluated
+        '''
+        self.num_evals += 1
+        full = None
+        if self.subset is None:
+            full = eval_fn(False)
+            self.num_full += 1
+            estimates = [(full[1][i],)*3 for i in self.metric_ids]
+            mean_loss, mean_metric = full
+        else:
+            self.sampler.indices = self.subset
+            try:
+                mean_loss, mean_metric, (values, labels) = eval_fn(True)
+            finally:
+                self.sampler.indices = None
+            estimates = [self.bootstrap(values[:, i], labels) for i in self.metric_ids]
+
+        better = []
+        for k, (estimate, low, high) in enumerate(estimates):
+            best = self.best[k]
+            if low > best['high']:
+                is_better = True
+            elif high <= best['low']:
+                is_better = False
+            else:
+                if full is None:
+                    print('Subset interval overlaps the best model, evaluating on full train data...')
+                    full = eval_fn(False)
+                    self.num_full += 1
+                reference = best['full'] if best['full'] is not None else best['estimate']
+                is_better = full[1][self.metric_ids[k]] > reference
+            if is_better:
+                full_metric = full[1][self.metric_ids[k]] if full is not None else None
+                self.best[k] = dict(estimate=estimate, low=low, high=high, full=full_metric)
+            better.append(is_better)
+        if full is not None:
+            mean_loss, mean_metric = full
+        return mean_loss, mean_metric, better, full is not None
+
+class PlateauStopper(object):
+    '''
+    Ends an exposure once its tracked metric has not improved by more
+    than min_delta for patience epochs, after at least min_epochs epochs
+    args:
+        min_epochs: number of epochs run before stopping
+        patience: number of epochs without improvement before stopping
+        min_delta: smallest increase of the metric counted as improvement
+    '''
+    def __init__(self, min_epochs, patience, min_delta=0.):
+        self.min_epochs = min_epochs
+        self.patience = patience
+        self.min_delta = min_delta
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the metric of the previous exposure
+        '''
+        self.best = -np.inf
+        self.best_epoch = 0
+
+    def state_dict(self):
+        return {'best': self.best, 'best_epoch': self.best_epoch}
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.best_epoch = state['best_epoch']
+
+    def step(self, epoch, metric):
+        '''
+        Track the metric of an epoch
+        returns:
+            whether to end the exposure
+        '''
+        if metric > self.best+self.min_delta:
+            self.best = metric
+            self.best_epoch = epoch
+        return epoch >= self.min_epochs and epoch-self.best_epoch >= self.patience
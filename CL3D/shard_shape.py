@@ -0,0 +1,124 @@
+########### Write each class of a data split into large sequentially readable tar shards
+import numpy as np
+import os
+import io
+import json
+import time
+import tarfile
+import argparse
+from tqdm import tqdm
+import config_shape as config
+from dataloader_shape import Dataset
+
+parser = argparse.ArgumentParser(description="Write tar shards of dataset splits")
+parser.add_argument("--out_dir", default=config.path['stream_dataset_path'], type=str,
+                    help="Output directory of the shards")
+parser.add_argument("--modes", default=['train'], nargs='+',
+                    help="Splits of data_split_json_path to write")
+parser.add_argument("--shard_size", default=1<<30, type=int,
+                    help="Approximate size of each shard in bytes")
+
+# Index of the shards of a split
+INDEX_FILE = 'index.json'
+# Members of an object in a shard are <obj>/<name>
+SDF_MEMBER = 'sdf.npy'
+META_MEMBER = 'meta.npy'
+HVC_META_MEMBER = 'hvc_meta.npy'
+# Per view input files are <obj>/<kind>/<file name>
+VIEW_KINDS = ['image', 'depth', 'seg', 'normal']
+
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+def add_array(tar, name, array):
+    f = io.BytesIO()
+    np.save(f, array)
+    add_bytes(tar, name, f.getvalue())
+
+def add_object(tar, dataset, index):
+    '''
+    Add the members of an object to a shard: all sdf samples, view
+    metadata and the input files of every view
+    returns:
+        number of bytes added
+    '''
+    obj, _ = dataset.obj_cat_map[index]
+    sdf = dataset.h5_pool.get(dataset.sdf_h5_paths[index])['pc_sdf_sample'][:]
+    add_array(tar, '%s/%s'%(obj, SDF_MEMBER), sdf.astype(np.float32))
+    size = sdf.size*4
+    meta = np.loadtxt(dataset.metadata_split_paths[index], ndmin=2)
+    add_array(tar, '%s/%s'%(obj, META_MEMBER), meta[:dataset.seq_len, :2])
+    if os.path.exists(dataset.hvc_metadata_split_paths[index]):
+        hvc_meta = np.loadtxt(dataset.hvc_metadata_split_paths[index])[:2]
+        add_array(tar, '%s/%s'%(obj, HVC_META_MEMBER), hvc_meta)
+
+    view_paths = [dataset.image_split_paths, dataset.depth_split_paths, \
+        dataset.seg_split_paths, dataset.normal_split_paths]
+    for kind, split_paths in zip(VIEW_KINDS, view_paths):
+        if split_paths is None:
+            continue
+        for path in split_paths[index][:dataset.seq_len]:
+            tar.add(path, arcname='%s/%s/%s'%(obj, kind, os.path.basename(path)))
+            size += os.path.getsize(path)
+    return size
+
+def write_split(mode, out_dir, shard_size):
+    '''
+    Write the objects of a split into tar shards of about shard_size
+    bytes. A shard only holds objects of one class, so that a stream can
+    skip inactive classes
+    args:
+        mode: split name in data_split_json_path
+        out_dir: root directory of the shards
+        shard_size: approximate size of each shard in bytes
+    '''
+    dataset = Dataset(config, mode=mode, coord_system='3dvc')
+    split_dir = os.path.join(out_dir, mode)
+    os.makedirs(split_dir, exist_ok=True)
+    print('Writing %s objects of split %s...'%(len(dataset.obj_cat_map), mode))
+
+    shards = []
+    with tqdm(total=len(dataset.obj_cat_map), ascii=True) as pbar:
+        for cls in dataset.class_names:
+            tar, size = None, 0
+            for index in dataset.get_class_objects(cls):
+                if tar is None:
+                    name = '%s-%05d.tar'%(cls, len([s for s in shards if s['cat'] == cls]))
+                    tmp_path = os.path.join(split_dir, '%s.tmp'%(name))
+                    tar = tarfile.open(tmp_path, 'w')
+                    shards.append({'name': name, 'cat': str(cls), 'num_objects': 0})
+                size += add_object(tar, dataset, index)
+                shards[-1]['num_objects'] += 1
+                pbar.update(1)
+                if size >= shard_size:
+                    tar.close()
+                    os.replace(tmp_path, os.path.join(split_dir, shards[-1]['name']))
+                    tar, size = None, 0
+            if tar is not None:
+                tar.close()
+                os.replace(tmp_path, os.path.join(split_dir, shards[-1]['name']))
+
+    with open(os.path.join(split_dir, INDEX_FILE), 'w') as index_file:
+        json.dump({'seq_len': dataset.seq_len, 'shards': shards}, index_file)
+
+def main():
+    args = parser.parse_args()
+    if args.out_dir is None:
+        raise Exception("Please specify --out_dir or stream_dataset_path in config")
+
+    with open(config.path['data_split_json_path'], 'r') as data_split_file:
+        data_splits = json.load(data_split_file)
+
+    for mode in args.modes:
+        if mode not in data_splits:
+            print('Split %s not in %s, skipping'%(mode, \
+                config.path['data_split_json_path']))
+            continue
+        write_split(mode, args.out_dir, args.shard_size)
+
+if __name__ == '__main__':
+    main()
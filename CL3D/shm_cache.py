@@ -0,0 +1,251 @@
+########### Sample cache in POSIX shared memory shared by all loader workers
+import numpy as np
+import os
+import json
+import fcntl
+import atexit
+import shutil
+from contextlib import contextmanager
+
+SHM_ROOT = '/dev/shm'
+# Caches are named <SHM_PREFIX><pid of the training process>
+SHM_PREFIX = 'cl3d-cache-'
+
+class SharedCache(object):
+    '''
+    Cache of decoded arrays stored as .npy files in shared memory. Entries
+    are memory mapped by every process reading them, so all workers of all
+    loaders see the same entries without copies. The total size is bounded
+    by a byte budget, least recently used entries are evicted first.
+    Entries are grouped by class, only classes in the current scope are
+    cached.
+    The process creating the cache removes it at exit, and records its
+    pid and start time so that the caches of killed processes are
+    removed by remove_stale
+    args:
+        name: name of the cache directory in SHM_ROOT
+        budget: maximum total size of the cached arrays in bytes
+    '''
+    def __init__(self, name, budget):
+        self.cache_dir = os.path.join(SHM_ROOT, name)
+        self.budget = budget
+        self.lock_path = os.path.join(self.cache_dir, '.lock')
+        self.usage_path = os.path.join(self.cache_dir, '.usage')
+        self.scope_path = os.path.join(self.cache_dir, '.scope')
+        self.owner_path = os.path.join(self.cache_dir, '.owner')
+        self.scope = None
+        self.scope_mtime = None
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self.locked():
+            if not os.path.exists(self.usage_path):
+                self.write_usage(0)
+            with open(self.owner_path, 'w') as owner_file:
+                json.dump([os.getpid(), get_start_time(os.getpid())], owner_file)
+        self.owner_pid = os.getpid()
+        atexit.register(self.remove)
+
+    @contextmanager
+    def locked(self):
+        '''
+        Exclusive lock of the cache across processes
+        '''
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_usage(self):
+        with open(self.usage_path, 'r') as usage_file:
+            return int(usage_file.read())
+
+    def write_usage(self, usage):
+        with open(self.usage_path, 'w') as usage_file:
+            usage_file.write(str(usage))
+
+    def get_path(self, cls, key):
+        return os.path.join(self.cache_dir, cls, '%s.npy'%(key))
+
+    def get_scope(self):
+        '''
+        Classes in scope, None if all classes are in scope
+        '''
+        try:
+            mtime = os.path.getmtime(self.scope_path)
+        except OSError:
+            return None
+        if mtime != self.scope_mtime:
+            with open(self.scope_path, 'r') as scope_file:
+                self.scope = set(json.load(scope_file))
+            self.scope_mtime = mtime
+        return self.scope
+
+    def set_scope(self, classes):
+        '''
+        Restrict the cache to classes, entries of other classes are removed
+        '''
+        classes = [str(cls) for cls in classes]
+        with self.locked():
+            usage = self.read_usage()
+            for cls in os.listdir(self.cache_dir):
+                cls_dir = os.path.join(self.cache_dir, cls)
+                if cls.startswith('.') or cls in classes:
+                    continue
+                for entry in os.scandir(cls_dir):
+                    usage -= entry.stat().st_size
+                shutil.rmtree(cls_dir, ignore_errors=True)
+            self.write_usage(max(usage, 0))
+            tmp_path = '%s.%s.tmp'%(self.scope_path, os.getpid())
+            with open(tmp_path, 'w') as scope_file:
+                json.dump(classes, scope_file)
+            os.replace(tmp_path, self.scope_path)
+
+    def get(self, cls, key):
+        '''
+        Memory mapped cached array, None if it is not cached
+        '''
+        path = self.get_path(cls, key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            # Modification time tracks the last access for LRU eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return array
+
+    def put(self, cls, key, array):
+        '''
+        Cache an array if its class is in scope and it fits in the budget
+        '''
+        scope = self.get_scope()
+        if scope is not None and cls not in scope:
+            return
+        array = np.ascontiguousarray(array)
+        if array.nbytes > self.budget:
+            return
+        path = self.get_path(cls, key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%s.tmp'%(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                np.save(tmp_file, array)
+        except OSError:
+            # Shared memory is full
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        size = os.path.getsize(tmp_path)
+        with self.locked():
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            usage = self.read_usage()+size
+            if usage > self.budget:
+                usage = self.evict(usage)
+            self.write_usage(usage)
+
+    def evict(self, usage):
+        '''
+        Remove least recently used entries until usage is at most 90% of
+        the budget. Must be called with the lock held
+        '''
+        entries = []
+        for cls in os.listdir(self.cache_dir):
+            if cls.startswith('.'):
+                continue
+            for entry in os.scandir(os.path.join(self.cache_dir, cls)):
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        target = 0.9*self.budget
+        for _, size, path in entries:
+            if usage <= target:
+                break
+            os.remove(path)
+            usage -= size
+        return usage
+
+    def remove(self):
+        '''
+        Remove the cache, only done by the process that created it
+        '''
+        if os.getpid() == self.owner_pid:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+def get_start_time(pid):
+    '''
+    Start time of a process in clock ticks after boot, None if unknown
+    '''
+    try:
+        with open('/proc/%s/stat'%(pid), 'r') as stat_file:
+            # Fields after the executable name, which may contain spaces
+            return int(stat_file.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def is_alive(pid, start_time=None):
+    '''
+    Whether process pid is running and, if start_time is known, was
+    started at start_time, i.e. its pid was not reused
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if start_time is None:
+        return True
+    current = get_start_time(pid)
+    return current is None or current == start_time
+
+def remove_stale():
+    '''
+    Remove the caches of this user whose training process is not running
+    anymore, e.g. after it was killed before its atexit handlers ran
+    '''
+    try:
+        names = os.listdir(SHM_ROOT)
+    except OSError:
+        return
+    for name in names:
+        if not name.startswith(SHM_PREFIX):
+            continue
+        cache_dir = os.path.join(SHM_ROOT, name)
+        try:
+            if os.stat(cache_dir).st_uid != os.getuid():
+                continue
+            pid = int(name[len(SHM_PREFIX):])
+        except (OSError, ValueError):
+            continue
+        start_time = None
+        try:
+            with open(os.path.join(cache_dir, '.owner'), 'r') as owner_file:
+                start_time = json.load(owner_file)[1]
+        except (OSError, ValueError, IndexError):
+            pass
+        if pid != os.getpid() and not is_alive(pid, start_time):
+            print('Removing stale sample cache %s'%(cache_dir))
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+# Caches created by this process, shared by all its Datasets
+_caches = {}
+
+def get_cache(budget):
+    '''
+    Shared cache of the current training process, named after its pid.
+    Stale caches of killed runs are removed when it is created
+    args:
+        budget: maximum total size of the cached arrays in bytes
+    '''
+    name = '%s%s'%(SHM_PREFIX, os.getpid())
+    if name not in _caches:
+        remove_stale()
+        _caches[name] = SharedCache(name, budget)
+    return _caches[name]
@@ -0,0 +1,64 @@
+import os
+import sys
+import io
+import json
+import tarfile
+import types
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shard_shape
+from dataloader_shape import get_data_loader
+from dataloader_stream import Dataset
+
+class SampleIdDataset(Dataset):
+    '''
+    Streaming Dataset yielding (object, view) names instead of decoded
+    samples, which only depend on the order of __iter__
+    '''
+    def load_object(self, obj, cat, members):
+        return obj
+
+    def get_sample(self, record, img_idx):
+        return '%s/%s'%(record, img_idx)
+
+def write_shards(root, num_shards=4, num_objects=3, seq_len=2):
+    split_dir = os.path.join(root, 'stream', 'train')
+    os.makedirs(split_dir)
+    shards = []
+    for i in range(num_shards):
+        name = 'c0-%05d.tar'%(i)
+        with tarfile.open(os.path.join(split_dir, name), 'w') as tar:
+            for j in range(num_objects):
+                info = tarfile.TarInfo('obj%s_%s/%s'%(i, j, shard_shape.SDF_MEMBER))
+                info.size = 1
+                tar.addfile(info, io.BytesIO(b'0'))
+        shards.append({'name': name, 'cat': 'c0', 'num_objects': num_objects})
+    with open(os.path.join(split_dir, shard_shape.INDEX_FILE), 'w') as index_file:
+        json.dump({'seq_len': seq_len, 'shards': shards}, index_file)
+    split_path = os.path.join(root, 'split.json')
+    with open(split_path, 'w') as split_file:
+        json.dump({'train': {'c0': []}}, split_file)
+    return types.SimpleNamespace(
+        path={'data_split_json_path': split_path, \
+            'stream_dataset_path': os.path.join(root, 'stream')},
+        data_setting={'input_size': 224, 'lossless_depth': False, 'random_view': False, \
+            'seq_len': seq_len, 'categories': None, 'shuffle_buffer': 4})
+
+def test_persistent_workers_reshuffle_every_epoch(tmp_path):
+    config = write_shards(str(tmp_path))
+    dataset = SampleIdDataset(config)
+    dataset.get_current_data_class('c0')
+    loader = get_data_loader(dataset, True, batch_size=None, num_workers=2)
+
+    dataset.set_epoch(0)
+    first = list(loader)
+    dataset.set_epoch(1)
+    second = list(loader)
+    dataset.set_epoch(0)
+    replay = list(loader)
+
+    assert sorted(first) == sorted(second)
+    assert len(first) == len(dataset)
+    assert first != second
+    assert first == replay
@@ -0,0 +1,212 @@
+########### Split of the CPU cores of a process between torch intra-op threads, loader workers and OpenMP threads
+import os
+import ctypes
+import torch
+from contextlib import contextmanager
+
+# Share of the cores of a process given to DataLoader workers, per entry
+# point and device. The remaining cores run torch intra-op threads, and
+# OpenMP threads of the kd-tree queries of utils_shape.distance_p2p,
+# which do not run at the same time
+WORKER_SHARE = {
+    'train': {'cpu': 0.5, 'cuda': 0.75},
+    # Mesh extraction and metrics also run in the main process
+    'eval': {'cpu': 0.25, 'cuda': 0.5},
+    'proxy': {'cpu': 0.5, 'cuda': 0.75},
+}
+# Number of workers of each loader before planning
+MAX_WORKERS = 12
+# OpenMP threads of the kd-tree queries and omp_set_num_threads of the
+# loaded runtimes, set by ThreadPlan.apply
+_omp_threads = None
+_omp_setters = []
+
+def add_thread_args(parser):
+    '''
+    Arguments overriding the thread plan of an entry point
+    '''
+    parser.add_argument("--num_workers", default=None, type=int,
+                        help="Number of workers of each data loader, planned from the "
+                        "available cores by default")
+    parser.add_argument("--intra_threads", default=None, type=int,
+                        help="Number of torch intra-op threads")
+    parser.add_argument("--omp_threads", default=None, type=int,
+                        help="Number of OpenMP threads of kd-tree queries")
+    parser.add_argument("--no_pin", action='store_true',
+                        help="Do not pin the main process and loader workers to cores")
+
+def get_cgroup_cpus():
+    '''
+    CPU quota of the cgroup of the process in cores, None if unlimited
+    '''
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(quota)/int(period)
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        if quota <= 0:
+            return None
+        return quota/period
+    except (OSError, ValueError):
+        return None
+
+def get_available_cpus():
+    '''
+    Cores the process may run on
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def get_openmp_setters():
+    '''
+    omp_set_num_threads of every OpenMP runtime loaded in the process
+    '''
+    if not os.path.exists('/proc/self/maps'):
+        return []
+    with open('/proc/self/maps', 'r') as maps:
+        paths = set(line.split()[-1] for line in maps if '/' in line)
+    setters = []
+    for path in sorted(paths):
+        if os.path.basename(path).startswith(('libgomp', 'libiomp', 'libomp')):
+            try:
+                setters.append(ctypes.CDLL(path).omp_set_num_threads)
+            except (OSError, AttributeError):
+                pass
+    return setters
+
+def set_openmp_threads(num_threads):
+    '''
+    Set the number of threads of the OpenMP runtimes loaded in the process.
+    The kd-tree extension reads OMP_NUM_THREADS only when it is loaded, so
+    omp_set_num_threads is called on every loaded runtime
+    '''
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    for setter in get_openmp_setters():
+        setter(num_threads)
+
+@contextmanager
+def kdtree_threads():
+    '''
+    Run the kd-tree queries of the context with the OpenMP threads of the
+    applied ThreadPlan. torch.set_num_threads also sets the threads of
+    the OpenMP runtime of torch, which the kd-tree extension shares when
+    both load the same libgomp, so the count is set around the queries
+    and the torch count is restored after them
+    '''
+    intra_threads = torch.get_num_threads()
+    if _omp_threads is None or _omp_threads == intra_threads:
+        yield
+        return
+    # Runtimes are resolved once by ThreadPlan.apply
+    for setter in _omp_setters:
+        setter(_omp_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(intra_threads)
+
+class ThreadPlan(object):
+    '''
+    Threads and cores of a process, see plan_threads
+    args:
+        cores: cores of the process
+        num_workers: number of workers of each data loader
+        intra_threads: number of torch intra-op threads
+        omp_threads: number of OpenMP threads
+        pin: whether to pin the main process and workers to their cores
+        cgroup_cpus: cgroup quota in cores, for logging
+    '''
+    def __init__(self, cores, num_workers, intra_threads, omp_threads, pin, \
+        cgroup_cpus=None):
+        self.cores = cores
+        self.num_workers = num_workers
+        self.intra_threads = intra_threads
+        self.omp_threads = omp_threads
+        self.pin = pin
+        self.cgroup_cpus = cgroup_cpus
+        # Intra-op threads get the first cores, workers the following ones.
+        # Workers share the cores of the process if none are left
+        self.main_cores = cores[:intra_threads]
+        self.worker_cores = cores[intra_threads:intra_threads+num_workers]
+        if len(self.worker_cores) == 0:
+            self.worker_cores = cores
+
+    def apply(self):
+        '''
+        Pin and set the threads of the calling process, before any thread
+        pool is started so that the pool threads inherit the affinity
+        '''
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.main_cores)
+        global _omp_threads, _omp_setters
+        set_openmp_threads(self.omp_threads)
+        # After the OpenMP runtimes, which may include the one of torch.
+        # kdtree_threads sets omp_threads again around the queries
+        torch.set_num_threads(self.intra_threads)
+        _omp_threads = self.omp_threads
+        _omp_setters = get_openmp_setters()
+
+    def worker_init_fn(self, worker_id):
+        '''
+        DataLoader worker_init_fn pinning each worker to one core
+        '''
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, [self.worker_cores[worker_id % len(self.worker_cores)]])
+
+    def __str__(self):
+        quota = '' if self.cgroup_cpus is None \
+            else ', cgroup quota %.2f cores'%(self.cgroup_cpus)
+        pinned = 'pinned' if self.pin else 'not pinned'
+        return '%s cores%s; %s intra-op threads on %s, %s loader workers on %s, '\
+            '%s OpenMP threads (%s)'%(len(self.cores), quota, self.intra_threads, \
+            self.main_cores, self.num_workers, self.worker_cores, self.omp_threads, pinned)
+
+def plan_threads(entry, device_type='cpu', args=None):
+    '''
+    Split the cores available to the process between torch intra-op
+    threads and DataLoader workers. The available cores are the affinity
+    of the process, limited by its cgroup quota and split between the
+    local processes of a distributed run (LOCAL_RANK, LOCAL_WORLD_SIZE)
+    args:
+        entry: key of WORKER_SHARE
+        device_type: 'cpu' or 'cuda'
+        args: parsed arguments of add_thread_args, overriding the plan
+    returns:
+        ThreadPlan
+    '''
+    cpus = get_available_cpus()
+    cgroup_cpus = get_cgroup_cpus()
+    budget = len(cpus)
+    if cgroup_cpus is not None:
+        budget = max(1, min(budget, int(cgroup_cpus)))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    budget = max(1, budget//local_world_size)
+    start = (local_rank*budget) % len(cpus)
+    cores = (cpus[start:]+cpus[:start])[:budget]
+
+    num_workers = min(MAX_WORKERS, int(budget*WORKER_SHARE[entry][device_type]))
+    intra_threads = max(1, budget-num_workers)
+    omp_threads = None
+    pin = True
+    if args is not None:
+        if args.num_workers is not None:
+            num_workers = args.num_workers
+        if args.intra_threads is not None:
+            intra_threads = args.intra_threads
+        omp_threads = args.omp_threads
+        pin = not args.no_pin
+    if omp_threads is None:
+        omp_threads = intra_threads
+    return ThreadPlan(cores, num_workers, intra_threads, omp_threads, pin, cgroup_cpus)
@@ -10,24 +10,58 @@ import subprocess
 import config_shape as config
 from datetime import datetime
 import utils_shape as utils
-from dataloader_shape import Dataset
+from dataloader_shape import Dataset, collate_rotate, collate_views, get_data_loader, \
+    seed_worker
+from dataloader_packed import Dataset as Dataset_Packed
 from dataloader_ptcl import Dataset as Dataset_Ptc
+from dataloader_ptcl_packed import Dataset as Dataset_Ptc_Packed
+from dataloader_stream import Dataset as Dataset_Stream
+from prefetch_shape import ExposurePrefetcher
+import distributed_shape as distributed
+from metrics_shape import EvalMetrics, sample_loss
+import threads_shape as threads
+from selection_shape import SubsetSampler, ModelSelector, PlateauStopper
+from checkpoint_shape import CheckpointManager, load_checkpoint, get_rng_state, set_rng_state
 
 from model_shape import SDFNet
 from model_pointcloud import PointCloudNet
 from tqdm import tqdm
 import copy
+import functools
+import gc
+import argparse
+
+parser = argparse.ArgumentParser(description="Train C-SDFNet")
+threads.add_thread_args(parser)
 
 def main():
+    args = parser.parse_args()
     torch.backends.cudnn.benchmark = True
 
+    # Each distributed process trains on its part of every batch, only
+    # the main process writes logs, checkpoints and npz files
+    _, world_size, local_rank = distributed.init_distributed(\
+        config.training['dist_backend'])
+    main_process = distributed.is_main_process()
+    device = torch.device(config.training['device'])
+    if device.type == 'cuda' and world_size > 1:
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+
+    # Cores for intra-op threads and loader workers
+    thread_plan = threads.plan_threads('train', device.type, args)
+    print('Thread plan: %s'%(thread_plan))
+    thread_plan.apply()
+    num_workers = thread_plan.num_workers
+
     # log params
     log_dir = config.logging['log_dir']
     exp_name = config.logging['exp_name']
     date = datetime.now().date().strftime("%m_%d_%Y")
     log_dir = os.path.join(log_dir, exp_name, date)
-    os.makedirs(log_dir, exist_ok=True)
-    utils.writelogfile(config, log_dir)
+    if main_process:
+        os.makedirs(log_dir, exist_ok=True)
+        utils.writelogfile(config, log_dir)
 
 
     # output directory
@@ -35,6 +69,8 @@ def main():
     os.makedirs(out_dir, exist_ok=True)
 
     batch_size = config.training['batch_size']
+    # Keep the total batch size of distributed runs
+    batch_size = max(1, batch_size//world_size)
     batch_size_eval = config.training['batch_size_eval']
     num_epochs = config.training['num_epochs']
 
@@ -60,29 +96,114 @@ def main():
     # Whether to use pointclouds as input
     pointcloud = config.training['pointcloud']
 
+    # Whether to run the network in bfloat16 autocast
+    bf16 = config.training['bf16']
+
+    # Whether to validate all seen classes in one loader pass
+    val_single_pass = config.training['val_single_pass']
+
+    # Objects per class and views per object of the subset of the training
+    # classes scoring best-model candidates, None to score the full set
+    eval_subset_objects = config.training['eval_subset_objects']
+
+    # Whether to end exposures once the train IoU stops improving
+    plateau_stop = config.training['plateau_stop']
+
+    # Whether to rotate points batch-wise at collate time
+    batch_rotate = config.data_setting['batch_rotate']
+    collate_fn = collate_rotate if batch_rotate else None
+
+    # Whether to stream training data from tar shards
+    stream = config.path['stream_dataset_path'] is not None and not pointcloud
+    if stream and world_size > 1:
+        raise Exception("Streaming is not supported in distributed training")
+
+    # Training samples are groups of views of one object, not used with
+    # pointcloud inputs or streaming
+    views_per_object = None if pointcloud or stream \
+        else config.data_setting['views_per_object']
+    train_collate_fn = collate_fn
+    train_batch_size = batch_size
+    if views_per_object is not None:
+        train_collate_fn = collate_views
+        if batch_rotate:
+            train_collate_fn = functools.partial(collate_views, collate_fn=collate_rotate)
+        train_batch_size = max(1, batch_size//views_per_object)
+    # Evaluation runs over all views of its objects, so only full-view
+    # evaluation reads them in groups
+    eval_views_per_object = None if config.data_setting['random_view'] \
+        else views_per_object
+    eval_collate_fn = collate_fn
+    eval_batch_size = batch_size_eval
+    if eval_views_per_object is not None:
+        eval_collate_fn = train_collate_fn
+        eval_batch_size = max(1, batch_size_eval//eval_views_per_object)
+
     # Dataset
     print('Loading data...')
     if not pointcloud:
-        train_dataset = Dataset(config, num_points=num_points, mode='train', \
-            shape_rep=shape_rep, coord_system=coord_system)
-        eval_train_dataset = Dataset(config, mode='val', shape_rep=shape_rep, \
-            coord_system=coord_system)
-        val_dataset = Dataset(config, mode='val', shape_rep=shape_rep, coord_system=coord_system)
+        # Read from packed shards if available
+        if config.path['packed_dataset_path'] is not None:
+            dataset_cls = Dataset_Packed
+        else:
+            dataset_cls = Dataset
+        if stream:
+            train_dataset = Dataset_Stream(config, num_points=num_points, mode='train', \
+                shape_rep=shape_rep, coord_system=coord_system, batch_rotate=batch_rotate)
+        else:
+            train_dataset = dataset_cls(config, num_points=num_points, mode='train', \
+                shape_rep=shape_rep, coord_system=coord_system, batch_rotate=batch_rotate, \
+                views_per_object=views_per_object)
+        eval_train_dataset = dataset_cls(config, mode='val', shape_rep=shape_rep, \
+            coord_system=coord_system, batch_rotate=batch_rotate, \
+            views_per_object=eval_views_per_object)
+        val_dataset = dataset_cls(config, mode='val', shape_rep=shape_rep, coord_system=coord_system, \
+            batch_rotate=batch_rotate, views_per_object=eval_views_per_object)
     else:
-        train_dataset = Dataset_Ptc(config, num_points=num_points, mode='train', \
-            shape_rep=shape_rep, coord_system=coord_system)
-        eval_train_dataset = Dataset_Ptc(config, mode='val', shape_rep=shape_rep, \
-            coord_system=coord_system)
-        val_dataset = Dataset_Ptc(config, mode='val', shape_rep=shape_rep, coord_system=coord_system)
-
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=batch_size, num_workers=12, shuffle=True, pin_memory=True)
-    eval_train_loader = torch.utils.data.DataLoader(
-        eval_train_dataset, batch_size=batch_size_eval, num_workers=12,\
-        drop_last=False, pin_memory=True)
-    val_loader = torch.utils.data.DataLoader(
-        val_dataset, batch_size=batch_size_eval, num_workers=12,\
-        drop_last=False, pin_memory=True)
+        if config.path['packed_dataset_path'] is not None:
+            dataset_cls = Dataset_Ptc_Packed
+        else:
+            dataset_cls = Dataset_Ptc
+        train_dataset = dataset_cls(config, num_points=num_points, mode='train', \
+            shape_rep=shape_rep, coord_system=coord_system, batch_rotate=batch_rotate)
+        eval_train_dataset = dataset_cls(config, mode='val', shape_rep=shape_rep, \
+            coord_system=coord_system, batch_rotate=batch_rotate)
+        val_dataset = dataset_cls(config, mode='val', shape_rep=shape_rep, coord_system=coord_system, \
+            batch_rotate=batch_rotate)
+
+    # Keep the garbage collector of forked workers from touching, and so
+    # copying, the objects built while loading data (python>=3.7)
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    # Whether to keep loader workers alive across epochs and exposures
+    persistent_workers = config.data_setting['persistent_workers']
+    pin_memory = device.type == 'cuda'
+    # Distributed processes split the samples of the current exposure
+    train_sampler, eval_train_sampler, val_sampler = None, None, None
+    if world_size > 1:
+        train_sampler = distributed.ExposureSampler(train_dataset)
+        eval_train_sampler = distributed.ExposureSampler(eval_train_dataset, \
+            shuffle=False, pad=False)
+        val_sampler = distributed.ExposureSampler(val_dataset, shuffle=False, pad=False)
+    # Switches between the full set and the subset of best-model selection
+    eval_train_sampler = SubsetSampler(eval_train_dataset, eval_train_sampler)
+    # Workers sample from seeds drawn from the torch RNG
+    worker_init_fn = functools.partial(seed_worker, worker_init_fn=thread_plan.worker_init_fn)
+    train_loader = get_data_loader(
+        train_dataset, persistent_workers, batch_size=train_batch_size, \
+        num_workers=num_workers, worker_init_fn=worker_init_fn, \
+        shuffle=not stream and train_sampler is None, sampler=train_sampler, \
+        pin_memory=pin_memory, collate_fn=train_collate_fn)
+    eval_train_loader = get_data_loader(
+        eval_train_dataset, persistent_workers, batch_size=eval_batch_size, \
+        num_workers=num_workers, worker_init_fn=worker_init_fn, \
+        drop_last=False, sampler=eval_train_sampler, pin_memory=pin_memory, \
+        collate_fn=eval_collate_fn)
+    val_loader = get_data_loader(
+        val_dataset, persistent_workers, batch_size=eval_batch_size, \
+        num_workers=num_workers, worker_init_fn=worker_init_fn, \
+        drop_last=False, sampler=val_sampler, pin_memory=pin_memory, collate_fn=eval_collate_fn)
 
     # Get all training classes
     all_classes_orig = train_dataset.catnames
@@ -97,6 +218,8 @@ def main():
         # Reshape to N exposures x nclass
         perm_all = perm_all.reshape((len(perm_all)//nclass,nclass))
         perm_all = np.random.permutation(perm_all)
+        # Same exposures in all processes
+        perm_all = distributed.broadcast_array(perm_all)
         all_classes = np.asarray(all_classes_orig)[perm_all]
     else:
         all_classes = np.load(perm_path)\
@@ -111,6 +234,17 @@ def main():
     eval_train_dataset.update_class_map(cat_map)
     val_dataset.update_class_map(cat_map)
 
+    # Selected metrics: IoU for occ, IoU and threshold accuracy for sdf
+    metric_ids = [0] if shape_rep == 'occ' else [2, 1]
+    selector = ModelSelector(eval_train_dataset, eval_train_sampler, metric_ids, \
+        num_objects=eval_subset_objects, num_views=config.training['eval_subset_views'], \
+        num_resamples=config.training['eval_bootstrap'], \
+        confidence=config.training['eval_confidence'])
+    stopper = None
+    if plateau_stop:
+        stopper = PlateauStopper(config.training['plateau_min_epochs'], \
+            config.training['plateau_patience'], config.training['plateau_min_delta'])
+
     # Model
     print('Initializing network...')
     if not pointcloud:
@@ -133,21 +267,27 @@ def main():
     metric_val_array = []
     epoch_val_array = []
     loss_val_array = []
+    # Exposure of each val evaluation
+    exposure_val_array = []
 
     # Stores val IoU for each class at each learning exposure
     # num exposure x num_classes
     metric_val_matrr = np.zeros((len(all_classes),len(all_classes_orig)),dtype=np.float32)
     seen_classes = []
 
-    if shape_rep == 'occ':
-        max_metric_train = 0
-    elif shape_rep == 'sdf':
-        max_metric_train = np.zeros(2, dtype=np.float32)
     metric_train_array = []
     epoch_train_array = []
     loss_train_array = []
+    # Whether each train evaluation ran on the full set
+    eval_full_array = []
+    # Exposure of each train evaluation
+    exposure_train_array = []
+    # Last epoch of each exposure
+    stop_epoch_array = []
 
     current_counter = 0
+    # Loop state of a checkpoint continued from any epoch
+    resume = None
 
 
     if cont is not None:
@@ -155,7 +295,7 @@ def main():
             current_counter = int(cont.split('-')[1])+1
         except Exception:
             print("Current counter is not an integer")
-        checkpoint = torch.load(os.path.join(out_dir, cont))
+        checkpoint = load_checkpoint(os.path.join(out_dir, cont), map_location=device)
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         perm_load = []
@@ -163,9 +303,11 @@ def main():
         for state in optimizer.state.values():
             for k, v in state.items():
                 if isinstance(v, torch.Tensor):
-                    state[k] = v.cuda()
+                    state[k] = v.to(device)
         epoch_it = checkpoint['epoch']
-        if epoch_it != num_epochs:
+        resume = checkpoint.get('resume')
+        # Exposures ended by plateau_stop save their last epoch
+        if resume is None and epoch_it != checkpoint.get('stop_epoch', num_epochs):
             raise Exception("Please make sure to continue from the last epoch of a learning exposure")
         if os.path.exists(os.path.join(out_dir, 'train.npz')):
             # Load saved data
@@ -179,9 +321,25 @@ def main():
                 # If num_epochs = 500, verbose_step = 10 and current_counter = 5
                 # then ckpt = 250 
                 ckpt = ((num_epochs-verbose_step)//verbose_step+1)*current_counter
+                # Exposures may end at different epochs with plateau_stop
+                if 'exposure' in train_npz.files:
+                    exposure_train_array = list(train_npz['exposure'])
+                    ckpt = int(np.sum(np.asarray(exposure_train_array) < current_counter))
+                    exposure_train_array = exposure_train_array[:ckpt]
+                else:
+                    # Earlier exposures
+                    exposure_train_array = [-1]*len(metric_train_array[:ckpt])
+                if 'stop_epoch' in train_npz.files:
+                    stop_epoch_array = list(train_npz['stop_epoch'][:current_counter])
+                else:
+                    stop_epoch_array = [num_epochs]*current_counter
                 metric_train_array = list(metric_train_array[:ckpt])
                 loss_train_array = list(loss_train_array[:ckpt])
                 epoch_train_array = list(epoch_train_array[:ckpt])
+                if 'eval_full' in train_npz.files:
+                    eval_full_array = list(train_npz['eval_full'][:ckpt])
+                else:
+                    eval_full_array = [True]*len(metric_train_array)
             except Exception:
                 print('Cannot load train npz')
         if os.path.exists(os.path.join(out_dir, 'val.npz')):
@@ -197,6 +355,12 @@ def main():
                 loss_val_array = val_npz['loss']
 
                 ckpt = ((num_epochs-eval_step)//eval_step+1)*current_counter
+                if 'exposure' in val_npz.files:
+                    exposure_val_array = list(val_npz['exposure'])
+                    ckpt = int(np.sum(np.asarray(exposure_val_array) < current_counter))
+                    exposure_val_array = exposure_val_array[:ckpt]
+                else:
+                    exposure_val_array = [-1]*len(metric_val_array[:ckpt])
                 metric_val_array = list(metric_val_array[:ckpt])
                 loss_val_array = list(loss_val_array[:ckpt])
                 epoch_val_array = list(epoch_val_array[:ckpt])
@@ -217,151 +381,328 @@ def main():
         
         seen_classes = list(seen_classes)
 
+        if resume is not None:
+            # State of the loop at the end of the saved epoch, which may
+            # be ahead of or behind the npz files
+            current_counter = resume['exposure']
+            all_classes = resume['all_classes']
+            seen_classes = list(resume['seen_classes'])
+            model_eval.load_state_dict(resume['model_eval_state_dict'])
+            metric_train_array = list(resume['metric_train'])
+            epoch_train_array = list(resume['epoch_train'])
+            loss_train_array = list(resume['loss_train'])
+            eval_full_array = list(resume['eval_full'])
+            exposure_train_array = list(resume['exposure_train'])
+            stop_epoch_array = list(resume['stop_epoch'])
+            metric_val_array = list(resume['metric_val'])
+            epoch_val_array = list(resume['epoch_val'])
+            loss_val_array = list(resume['loss_val'])
+            exposure_val_array = list(resume['exposure_val'])
+            metric_val_matrr = resume['metric_val_matrr'].copy()
+            if epoch_it == checkpoint.get('stop_epoch', num_epochs):
+                # Last epoch of the exposure, continue with the next one
+                stop_epoch_array.append(epoch_it)
+                current_counter += 1
+
 
     # Saving meta config for loading
     meta_config_path = os.path.join(out_dir, 'meta_config.npz')
-    np.savez(meta_config_path, training=config.training, \
-        testing=config.testing, data_setting=config.data_setting, \
-        logging=config.logging, path=config.path)
-    if not os.path.exists(perm_path):
+    if main_process:
+        np.savez(meta_config_path, training=config.training, \
+            testing=config.testing, data_setting=config.data_setting, \
+            logging=config.logging, path=config.path)
+    if not os.path.exists(perm_path) and main_process:
         os.makedirs('./perm',exist_ok=True)
         np.savez(perm_path, all_classes=all_classes)
 
 
     # Data parallel
-    model = torch.nn.DataParallel(model).cuda()
-    model_eval = torch.nn.DataParallel(model_eval).cuda()
-
-
-    print(metric_val_matrr.shape)
-    print('Start training...')
-    for cl_count, cl_group in enumerate(all_classes[current_counter:]):
-        cl_count += current_counter
-
-        for cl in cl_group:
-            print('Class: ', cl)
-
-            if cl not in seen_classes:
-                seen_classes.append(cl)
-
-            # Get current classes for train and val
-            train_dataset.get_current_data_class(cl)
-            eval_train_dataset.get_current_data_class(cl)
-
-        epoch_it = 0
-        if shape_rep == 'occ':
-            max_metric_train = 0
-        elif shape_rep == 'sdf':
-            max_metric_train = np.zeros(2, dtype=np.float32)
-
-        while True:
-            epoch_it += 1
-            if num_epochs is not None and epoch_it > num_epochs:
-                break
-            print("Starting epoch %s"%(epoch_it))
-            model = train(model, criterion, optimizer, train_loader, \
-                batch_size, epoch_it, shape_rep)
-
-            if epoch_it % save_model_step == 0:
-                print("Saving model...")
-                torch.save({
-                    'epoch': epoch_it,
-                    'model_state_dict': model.module.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict()},\
-                        os.path.join(out_dir, 'model-%s-%s.pth.tar'%(cl_count,epoch_it)))
-
-            if epoch_it % verbose_step == 0:
-                print("Evaluating on train data...")
-                mean_loss, mean_metric = eval(model, criterion, optimizer, \
-                    eval_train_loader, batch_size, epoch_it, shape_rep)
-                print('Mean loss on train set: %.4f'%(mean_loss))
-                if shape_rep == 'occ':
-
-                    print('Mean IoU on train set: %.4f'%(mean_metric[0]))
-                elif shape_rep == 'sdf':
-                    print('Mean IoU on train set: %.4f'%(mean_metric[2]))
-                    print('Mean accuracy on train set: %.4f'%(mean_metric[1]))
-
-                metric_train_array.append(mean_metric)
-                epoch_train_array.append(epoch_it)
-                loss_train_array.append(mean_loss)
+    if world_size > 1:
+        model = torch.nn.parallel.DistributedDataParallel(model.to(device), \
+            device_ids=[device.index] if device.type == 'cuda' else None)
+        # Only runs forward passes on the part of each process
+        model_eval = model_eval.to(device)
+    elif device.type == 'cuda':
+        # DataParallel replicas run on their own threads, outside the
+        # autocast context of the caller
+        if bf16 and torch.cuda.device_count() > 1:
+            raise Exception("bf16 is not supported with DataParallel over %s GPUs, "\
+                "please run with torchrun"%(torch.cuda.device_count()))
+        model = torch.nn.DataParallel(model).cuda()
+        model_eval = torch.nn.DataParallel(model_eval).cuda()
+    else:
+        model = model.to(device)
+        model_eval = model_eval.to(device)
+
+
+    # Writes checkpoints in the background, keeping the last
+    # keep_checkpoints periodic ones, including the ones of a previous run
+    checkpoints = CheckpointManager(out_dir, keep_last=config.training['keep_checkpoints'], \
+        background=config.training['async_checkpoints'])
+
+    try:
+        # Warms the files of the next exposure while the current one trains
+        prefetcher = None
+        if config.data_setting['prefetch_rate'] is not None:
+            prefetcher = ExposurePrefetcher(config.data_setting['prefetch_rate'])
+
+        sampler_epoch = 0 if resume is None else resume['sampler_epoch']
+        print(metric_val_matrr.shape)
+        print('Start training...')
+        for cl_count, cl_group in enumerate(all_classes[current_counter:]):
+            cl_count += current_counter
+
+            for cl in cl_group:
+                print('Class: ', cl)
+
+                if cl not in seen_classes:
+                    seen_classes.append(cl)
+
+                # Get current classes for train and val
+                train_dataset.get_current_data_class(cl)
+                eval_train_dataset.get_current_data_class(cl)
+
+            # Shared sample cache only keeps classes of the current exposure
+            train_dataset.set_cache_scope(cl_group)
+
+            if prefetcher is not None and cl_count+1 < len(all_classes):
+                prefetcher.prefetch([train_dataset, eval_train_dataset], \
+                    all_classes[cl_count+1])
+
+            epoch_it = 0
+            selector.reset(cl_count)
+            if stopper is not None:
+                stopper.reset()
+            stop = False
+            if resume is not None:
+                if resume['exposure'] == cl_count:
+                    # Continue the exposure after its saved epoch
+                    if list(resume['active_classes']) != list(cl_group):
+                        raise Exception("Classes of the resumed exposure do not match the checkpoint")
+                    epoch_it = resume['epoch']
+                    selector.load_state_dict(resume['selector'])
+                    if stopper is not None and resume['stopper'] is not None:
+                        stopper.load_state_dict(resume['stopper'])
+                rng_states = resume['rng']
+                set_rng_state(rng_states[distributed.get_rank()] \
+                    if len(rng_states) == world_size else rng_states[0])
+                resume = None
+
+            while True:
+                epoch_it += 1
+                if num_epochs is not None and epoch_it > num_epochs:
+                    break
+                print("Starting epoch %s"%(epoch_it))
+                # Different order in every epoch of every exposure
+                if train_sampler is not None:
+                    train_sampler.set_epoch(sampler_epoch)
+                if stream:
+                    train_dataset.set_epoch(sampler_epoch)
+                sampler_epoch += 1
+                model = train(model, criterion, optimizer, train_loader, \
+                    batch_size, epoch_it, shape_rep, device, bf16)
+
+                # State of this epoch is copied to CPU once for all its checkpoints
+                step = (cl_count, epoch_it)
+
+                if epoch_it % verbose_step == 0:
+                    print("Evaluating on train data...")
+                    mean_loss, mean_metric, better, eval_full = selector.evaluate(\
+                        functools.partial(eval, model, criterion, optimizer, \
+                        eval_train_loader, batch_size, epoch_it, shape_rep, device, bf16))
+                    print('Mean loss on train set: %.4f'%(mean_loss))
+                    if shape_rep == 'occ':
 
-                np.savez(os.path.join(out_dir, 'train.npz'), metric=metric_train_array, \
-                    epoch=epoch_train_array, loss=loss_train_array, perm=all_classes, \
-                    seen_classes=seen_classes, current_counter=cl_count)
-
-                # Saving best model based on metric
-                if shape_rep == 'occ':
-                    if mean_metric[0] > max_metric_train:
-                        print('Saving best model')
-                        max_metric_train = copy.deepcopy(mean_metric[0])
-                        print('Saving best model')
-                        torch.save(model.module.state_dict(), \
-                            os.path.join(out_dir, 'best_model_train-%s.pth.tar'%(cl_count)))
-                        model_eval.module.load_state_dict(\
-                            copy.deepcopy(model.module.state_dict()))
-                elif shape_rep == 'sdf':
-                    if mean_metric[2] > max_metric_train[0]:
-                        print('Saving best model')
-                        max_metric_train[0] = copy.deepcopy(mean_metric[2])
-                        torch.save(model.module.state_dict(), \
-                            os.path.join(out_dir, 'best_model_iou_train-%s.pth.tar'%(cl_count)))
-                        model_eval.module.load_state_dict(\
-                            copy.deepcopy(model.module.state_dict()))
-                                                
-                    if mean_metric[1] > max_metric_train[1]:
-                        max_metric_train[1] = copy.deepcopy(mean_metric[1])
-                        torch.save(model.module.state_dict(), os.path.join(out_dir, 'best_model_acc_train-%s.pth.tar'%(cl_count)))
-
-            if epoch_it % eval_step == 0:
-                for s in range(len(seen_classes)):
-                    val_dataset.clear()
-                    val_dataset.get_current_data_class(seen_classes[s])
-
-                    print('Evaluating on test data of class %s...'%(seen_classes[s]))
-                    mean_loss_val, mean_metric_val = eval(\
-                        model_eval, criterion, optimizer, val_loader, \
-                        batch_size, epoch_it, shape_rep)
-                    print('Mean loss on val set: %.4f'%(mean_loss_val))
+                        print('Mean IoU on train set: %.4f'%(mean_metric[0]))
+                    elif shape_rep == 'sdf':
+                        print('Mean IoU on train set: %.4f'%(mean_metric[2]))
+                        print('Mean accuracy on train set: %.4f'%(mean_metric[1]))
+
+                    metric_train_array.append(mean_metric)
+                    epoch_train_array.append(epoch_it)
+                    loss_train_array.append(mean_loss)
+                    eval_full_array.append(eval_full)
+                    exposure_train_array.append(cl_count)
+
+                    if stopper is not None:
+                        stop = stopper.step(epoch_it, mean_metric[metric_ids[0]])
+
+                    if main_process:
+                        np.savez(os.path.join(out_dir, 'train.npz'), metric=metric_train_array, \
+                            epoch=epoch_train_array, loss=loss_train_array, perm=all_classes, \
+                            seen_classes=seen_classes, current_counter=cl_count, \
+                            eval_full=eval_full_array, exposure=exposure_train_array, \
+                            stop_epoch=stop_epoch_array)
+
+                    # Saving best model based on metric
                     if shape_rep == 'occ':
-                        metric_val_matrr[cl_count, s] = mean_metric_val[0]
-                        print('Mean IoU on val set: %.4f'%(mean_metric_val[0]))
+                        if better[0]:
+                            print('Saving best model')
+                            if main_process:
+                                checkpoints.save(checkpoints.snapshot(\
+                                    distributed.get_module(model).state_dict(), 'model', step), \
+                                    'best_model_train-%s.pth.tar'%(cl_count))
+                            distributed.get_module(model_eval).load_state_dict(\
+                                copy.deepcopy(distributed.get_module(model).state_dict()))
                     elif shape_rep == 'sdf':
-                        metric_val_matrr[cl_count, s] = mean_metric_val[2]
-                        print('Mean IoU on val set: %.4f'%(mean_metric_val[2]))
-                        print('Mean accuracy on val set: %.4f'%(mean_metric_val[1]))
-
-                    metric_val_array.append(mean_metric_val)
-                    epoch_val_array.append(epoch_it)
-                    loss_val_array.append(mean_loss_val)
-
-                print(metric_val_matrr)
-                np.savez(os.path.join(out_dir, 'val.npz'), metric=metric_val_array, \
-                        epoch=epoch_val_array, loss=loss_val_array, metric_matrr=metric_val_matrr, \
-                        perm=all_classes, seen_classes=seen_classes, current_counter=cl_count)
-
-                del mean_loss_val
+                        if better[0]:
+                            print('Saving best model')
+                            if main_process:
+                                checkpoints.save(checkpoints.snapshot(\
+                                    distributed.get_module(model).state_dict(), 'model', step), \
+                                    'best_model_iou_train-%s.pth.tar'%(cl_count))
+                            distributed.get_module(model_eval).load_state_dict(\
+                                copy.deepcopy(distributed.get_module(model).state_dict()))
+                                                
+                        if better[1]:
+                            if main_process:
+                                checkpoints.save(checkpoints.snapshot(\
+                                    distributed.get_module(model).state_dict(), 'model', step), \
+                                    'best_model_acc_train-%s.pth.tar'%(cl_count))
+
+                if stop:
+                    print('Train IoU plateaued since epoch %s, ending exposure at epoch %s'\
+                        %(stopper.best_epoch, epoch_it))
+
+                # Seen classes are also evaluated at the end of ended exposures
+                if epoch_it % eval_step == 0 or stop:
+                    if val_single_pass:
+                        # One pass over all seen classes, metrics per label
+                        val_dataset.clear()
+                        for cl in seen_classes:
+                            val_dataset.get_current_data_class(cl)
+                        print('Evaluating on test data of %s seen classes...'%(len(seen_classes)))
+                        label_loss_val, label_metric_val = eval(\
+                            model_eval, criterion, optimizer, val_loader, \
+                            batch_size, epoch_it, shape_rep, device, bf16, \
+                            num_labels=len(cat_map))
+                    for s in range(len(seen_classes)):
+                        if val_single_pass:
+                            label = cat_map[seen_classes[s]]
+                            mean_loss_val = label_loss_val[label]
+                            mean_metric_val = label_metric_val[label]
+                            print('Class %s'%(seen_classes[s]))
+                        else:
+                            val_dataset.clear()
+                            val_dataset.get_current_data_class(seen_classes[s])
+
+                            print('Evaluating on test data of class %s...'%(seen_classes[s]))
+                            mean_loss_val, mean_metric_val = eval(\
+                                model_eval, criterion, optimizer, val_loader, \
+                                batch_size, epoch_it, shape_rep, device, bf16)
+                        print('Mean loss on val set: %.4f'%(mean_loss_val))
+                        if shape_rep == 'occ':
+                            metric_val_matrr[cl_count, s] = mean_metric_val[0]
+                            print('Mean IoU on val set: %.4f'%(mean_metric_val[0]))
+                        elif shape_rep == 'sdf':
+                            metric_val_matrr[cl_count, s] = mean_metric_val[2]
+                            print('Mean IoU on val set: %.4f'%(mean_metric_val[2]))
+                            print('Mean accuracy on val set: %.4f'%(mean_metric_val[1]))
+
+                        metric_val_array.append(mean_metric_val)
+                        epoch_val_array.append(epoch_it)
+                        loss_val_array.append(mean_loss_val)
+                        exposure_val_array.append(cl_count)
+
+                    print(metric_val_matrr)
+                    if main_process:
+                        np.savez(os.path.join(out_dir, 'val.npz'), metric=metric_val_array, \
+                                epoch=epoch_val_array, loss=loss_val_array, metric_matrr=metric_val_matrr, \
+                                perm=all_classes, seen_classes=seen_classes, current_counter=cl_count, \
+                                exposure=exposure_val_array)
+
+                    del mean_loss_val
+
+                # Checkpoint of the end of the epoch, after its evaluations, from
+                # which training continues
+                if epoch_it % save_model_step == 0 or stop:
+                    rng_states = distributed.all_gather_object(get_rng_state())
+                    if main_process:
+                        print("Saving model...")
+                        state = {
+                            'epoch': epoch_it,
+                            'model_state_dict': checkpoints.snapshot(\
+                                distributed.get_module(model).state_dict(), 'model', step),
+                            'optimizer_state_dict': checkpoints.snapshot(\
+                                optimizer.state_dict(), 'optimizer', step),
+                            'resume': {
+                                'exposure': cl_count,
+                                'epoch': epoch_it,
+                                'all_classes': all_classes,
+                                'active_classes': list(cl_group),
+                                'seen_classes': list(seen_classes),
+                                'model_eval_state_dict': checkpoints.snapshot(\
+                                    distributed.get_module(model_eval).state_dict(), \
+                                    'model_eval', step),
+                                'selector': selector.state_dict(),
+                                'stopper': stopper.state_dict() if stopper is not None else None,
+                                'sampler_epoch': sampler_epoch,
+                                'rng': rng_states,
+                                'metric_train': list(metric_train_array),
+                                'epoch_train': list(epoch_train_array),
+                                'loss_train': list(loss_train_array),
+                                'eval_full': list(eval_full_array),
+                                'exposure_train': list(exposure_train_array),
+                                'stop_epoch': list(stop_epoch_array),
+                                'metric_val': list(metric_val_array),
+                                'epoch_val': list(epoch_val_array),
+                                'loss_val': list(loss_val_array),
+                                'exposure_val': list(exposure_val_array),
+                                'metric_val_matrr': metric_val_matrr.copy()}}
+                        if stop:
+                            state['stop_epoch'] = epoch_it
+                        # The last epoch of an exposure is kept for cont
+                        checkpoints.save(state, 'model-%s-%s.pth.tar'%(cl_count,epoch_it), \
+                            periodic=True, keep=stop or epoch_it == num_epochs)
+
+                if stop:
+                    break
+
+            # Last epoch of the exposure, num_epochs without plateau_stop
+            stop_epoch_array.append(epoch_it if stop else epoch_it-1)
+            if main_process:
+                np.savez(os.path.join(out_dir, 'train.npz'), metric=metric_train_array, \
+                    epoch=epoch_train_array, loss=loss_train_array, perm=all_classes, \
+                    seen_classes=seen_classes, current_counter=cl_count, \
+                    eval_full=eval_full_array, exposure=exposure_train_array, \
+                    stop_epoch=stop_epoch_array)
         
-        train_dataset.clear()
-        eval_train_dataset.clear()
+            train_dataset.clear()
+            eval_train_dataset.clear()
+
+        if prefetcher is not None:
+            prefetcher.stop()
+    except BaseException:
+        # Checkpoints requested before an error are still written, an
+        # error of the writer is logged so that it does not hide it
+        try:
+            checkpoints.close()
+        except Exception as e:
+            print('Checkpoint writer failed after a training error: %s'%(e))
+        raise
+    checkpoints.close()
 
 def train(model, criterion, optimizer, train_loader, \
-            batch_size, epoch_it, shape_rep):
+            batch_size, epoch_it, shape_rep, device, bf16=False):
     model.train()
-    with tqdm(total=int(len(train_loader)), ascii=True) as pbar:
+    with tqdm(total=int(len(train_loader)), ascii=True, \
+            disable=not distributed.is_main_process()) as pbar:
         for mbatch in train_loader:
             img_input, points_input, values, labels = mbatch
-            img_input = Variable(img_input).cuda()
+            img_input = Variable(img_input).to(device)
 
-            points_input = Variable(points_input).cuda()
-            values = Variable(values).cuda()
+            points_input = Variable(points_input).to(device)
+            values = Variable(values).to(device)
 
-            labels = Variable(labels).cuda()
+            labels = Variable(labels).to(device)
 
 
             optimizer.zero_grad()
             
-            logits = model(points_input, img_input)
+            with utils.get_autocast(device, bf16):
+                logits = model(points_input, img_input)
+            # Loss in float32
+            logits = logits.float()
             if shape_rep == 'occ':
                 loss = criterion(logits, values)
             elif shape_rep == 'sdf':
@@ -376,54 +717,59 @@ def train(model, criterion, optimizer, train_loader, \
     return model
 
 
-def eval(model, criterion, optimizer, loader, batch_size, epoch_it, shape_rep):
+def eval(model, criterion, optimizer, loader, batch_size, epoch_it, shape_rep, device, \
+    bf16=False, samples=False, num_labels=None):
+    '''
+    Mean loss and metrics over the batches of loader. Distributed
+    processes evaluate their part of the data and the sums over batches
+    are all-reduced, so every process returns the same means
+    samples: whether to also return the metrics and labels of every
+        sample, with means over samples
+    num_labels: if not None, mean loss and metrics over the samples of
+        each label instead, as arrays indexed by label
+    '''
+    # Processes may run different numbers of batches, so the forward
+    # pass must not synchronize them
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        model = model.module
     model.eval()
-    loss_collect = []
-    metric_collect = []
-    if shape_rep == 'occ':
-        sigmoid = torch.nn.Sigmoid()
+    # Accumulated on the device, copied to host once
+    metrics = EvalMetrics(shape_rep, device, num_labels=num_labels, keep_samples=samples)
 
-    with tqdm(total=int(len(loader)), ascii=True) as pbar:
+    with tqdm(total=int(len(loader)), ascii=True, \
+            disable=not distributed.is_main_process()) as pbar:
         with torch.no_grad():
             for mbatch in loader:
                 img_input, points_input, values, labels = mbatch
-                img_input = Variable(img_input).cuda()
+                img_input = Variable(img_input).to(device)
 
-                points_input = Variable(points_input).cuda()
-                values = Variable(values).cuda()
+                points_input = Variable(points_input).to(device)
+                values = Variable(values).to(device)
 
-                labels = Variable(labels).cuda()
+                labels = Variable(labels).to(device)
 
 
                 optimizer.zero_grad()
 
-                logits = model(points_input, img_input)
-
-                loss = criterion(logits, values)
-
-                loss_collect.append(loss.data.cpu().item())
+                with utils.get_autocast(device, bf16):
+                    logits = model(points_input, img_input)
+                logits = logits.float()
 
-                if shape_rep == 'occ':
-                    logits = sigmoid(logits)
-
-                    iou = utils.compute_iou(logits.detach().cpu().numpy(), \
-                                values.detach().cpu().numpy())
-                    metric_collect.append([iou])
-                elif shape_rep == 'sdf':
-                    acc_sign, acc_thres, iou = utils.compute_acc(\
-                                        logits.detach().cpu().numpy(), \
-                                        values.detach().cpu().numpy())
-                    metric_collect.append([acc_sign, acc_thres, iou])
+                if num_labels is None and not samples:
+                    loss = criterion(logits, values)
+                else:
+                    loss = sample_loss(logits, values, shape_rep)
+                metrics.update(loss, logits, values, labels)
 
                 pbar.update(1)
 
-    mean_loss = np.mean(np.array(loss_collect))
-    if shape_rep == 'occ':
-        mean_metric = np.mean(np.concatenate(metric_collect))
-        mean_metric = [mean_metric]
-    else:
-        mean_metric = np.mean(np.array(metric_collect), axis=0)
+    mean_loss, mean_metric = metrics.compute()
+    if shape_rep == 'occ' and num_labels is None:
+        mean_metric = [mean_metric[0]]
 
+    if samples:
+        _, sample_metric, labels = metrics.get_samples()
+        return mean_loss, mean_metric, (sample_metric, labels)
     return mean_loss, mean_metric
 
 if __name__ == '__main__':
@@ -1,7 +1,6 @@
 import numpy as np
 import os
 from datetime import datetime
-import copy
 import torch
 from mesh_gen_utils.libmise import MISE
 from mesh_gen_utils.libmesh import check_mesh_contains
@@ -14,6 +13,9 @@ import torch.nn as nn
 import struct
 import pymesh
 from PIL import Image
+from collections import OrderedDict
+import contextlib
+import threads_shape as threads
 
 
 def writelogfile(config, log_dir):
@@ -68,8 +70,6 @@ def compute_iou(occ1, occ2):
         occ2 = occ2.reshape(occ2.shape[0], -1)
 
     # Convert to boolean values
-    occ1_temp = copy.deepcopy(occ1)
-    occ2_temp = copy.deepcopy(occ2)
     occ1 = (occ1 >= 0.5)
     occ2 = (occ2 >= 0.5)
 
@@ -124,19 +124,257 @@ def get_sdf_h5(sdf_h5_file):
         h5_f.close()
     return ori_pt, ori_sdf_val, sample_pt, sample_sdf_val, norm_params, sdf_params
 
+class StringTable(object):
+    '''
+    Immutable list of strings stored in one byte array indexed by offsets.
+    Reading an entry does not touch the refcount of a Python object per
+    string, so the pages of the table stay shared with forked loader
+    workers instead of being copied
+    args:
+        strings: list of str
+    '''
+    def __init__(self, strings):
+        encoded = [s.encode() for s in strings]
+        self.offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(s) for s in encoded])
+        self.blob = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index+1]]\
+            .tobytes().decode()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class ObjectTable(object):
+    '''
+    (obj, cat) pairs of a split stored in StringTables, indexed like
+    a list of tuples
+    args:
+        obj_cat_map: list of (obj, cat)
+    '''
+    def __init__(self, obj_cat_map):
+        self.objs = StringTable([obj for obj, _ in obj_cat_map])
+        self.cats = StringTable([cat for _, cat in obj_cat_map])
+
+    def __len__(self):
+        return len(self.objs)
+
+    def __getitem__(self, index):
+        return (self.objs[index], self.cats[index])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class PathTable(object):
+    '''
+    Paths root/cat/obj[/name] of the objects of an ObjectTable, built
+    on access
+    args:
+        root: root directory
+        objects: ObjectTable
+        name: file name in the object directory, None for the directory
+    '''
+    def __init__(self, root, objects, name=None):
+        self.root = root
+        self.objects = objects
+        self.name = name
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __getitem__(self, index):
+        obj, cat = self.objects[index]
+        if self.name is None:
+            return os.path.join(self.root, cat, obj)
+        return os.path.join(self.root, cat, obj, self.name)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class ViewPathTable(object):
+    '''
+    Per view file paths of objects, indexed as [object][view]. File names
+    are shared by most objects, so each object stores codes into a table
+    of unique names. Objects without file names are skipped, as in the
+    nested lists this replaces
+    args:
+        obj_paths: PathTable of the object directories
+        sub_dir: view directory in the object directory
+        files: list of sorted file names per object, None if missing
+    '''
+    def __init__(self, obj_paths, sub_dir, files):
+        self.obj_paths = obj_paths
+        self.sub_dir = sub_dir
+        self.rows = np.asarray([i for i, f in enumerate(files) if f is not None], \
+            dtype=np.int64)
+        files = [f for f in files if f is not None]
+        names, codes = np.unique([name for f in files for name in f] or [''], \
+            return_inverse=True)
+        self.names = StringTable(list(names))
+        self.codes = codes.astype(np.int32)
+        self.offsets = np.zeros(len(files)+1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(f) for f in files])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        obj_dir = os.path.join(self.obj_paths[self.rows[index]], self.sub_dir)
+        return [os.path.join(obj_dir, self.names[code]) for code in \
+            self.codes[self.offsets[index]:self.offsets[index+1]]]
+
+def get_process_memory(pid='self'):
+    '''
+    Resident memory of a process in bytes from /proc: rss, and private,
+    the pages only this process maps. Pages of a forked worker copied
+    on write are counted as private
+    '''
+    memory = {}
+    with open('/proc/%s/smaps_rollup'%(pid), 'r') as smaps_file:
+        for line in smaps_file:
+            fields = line.split()
+            if fields[0] in ['Rss:', 'Private_Clean:', 'Private_Dirty:']:
+                memory[fields[0][:-1]] = int(fields[1])*1024
+    return {'rss': memory['Rss'], \
+        'private': memory['Private_Clean']+memory['Private_Dirty']}
+
+class H5FilePool(object):
+    '''
+    LRU pool of open read-only h5py files. Handles are only used by the
+    process that opened them, so each DataLoader worker keeps its own pool
+    args:
+        max_open: maximum number of open files
+    '''
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.pid = os.getpid()
+
+    def get(self, path):
+        if self.pid != os.getpid():
+            # Handles inherited through fork are not safe to use
+            self.files = OrderedDict()
+            self.pid = os.getpid()
+        if path in self.files:
+            self.files.move_to_end(path)
+            return self.files[path]
+        h5_f = h5py.File(path, 'r')
+        self.files[path] = h5_f
+        if len(self.files) > self.max_open:
+            _, lru_f = self.files.popitem(last=False)
+            lru_f.close()
+        return h5_f
+
+    def close(self):
+        if self.pid == os.getpid():
+            for h5_f in self.files.values():
+                h5_f.close()
+        self.files = OrderedDict()
+
+    def __getstate__(self):
+        # Open handles are not transferred to other processes
+        state = self.__dict__.copy()
+        state['files'] = OrderedDict()
+        return state
+
+def read_h5_rows(dset, rows):
+    '''
+    Read rows of a h5py dataset
+    args:
+        dset: h5py dataset
+        rows: sorted unique row indices
+    '''
+    if dset.chunks is None:
+        # Contiguous storage, sorted fancy index read
+        return dset[rows]
+    # Chunked storage, read every run of consecutive chunks holding a
+    # selected row with one slice
+    chunk_len = dset.chunks[0]
+    chunk_ids = np.unique(rows//chunk_len)
+    out = np.empty((len(rows),)+dset.shape[1:], dtype=dset.dtype)
+    runs = np.split(chunk_ids, np.where(np.diff(chunk_ids) != 1)[0]+1)
+    for run in runs:
+        start = run[0]*chunk_len
+        end = min((run[-1]+1)*chunk_len, dset.shape[0])
+        selected = (rows >= start) & (rows < end)
+        out[selected] = dset[start:end][rows[selected]-start]
+    return out
+
+def get_sdf_h5_sample(sdf_h5_file, num_points, h5_pool):
+    '''
+    Read num_points random sdf samples of an object. Only the selected rows
+    of pc_sdf_sample are read, the other datasets are skipped. Rows are
+    drawn as in sample_points
+    args:
+        sdf_h5_file: path to the sdf h5 file
+        num_points: number of samples, -1 for all samples
+        h5_pool: H5FilePool of the current process
+    '''
+    dset = h5_pool.get(sdf_h5_file)['pc_sdf_sample']
+    if dset.shape[1] != 4:
+        raise Exception("no sample points")
+    if num_points != -1:
+        idx = torch.randint(dset.shape[0], size=(num_points,)).numpy()
+        rows, inverse = np.unique(idx, return_inverse=True)
+        sample_sdf = read_h5_rows(dset, rows)[inverse]
+    else:
+        sample_sdf = dset[:]
+    sample_sdf = sample_sdf.astype(np.float32)
+    return sample_sdf[:,:3], sample_sdf[:,3]
+
+def get_rotation_matrix(azim, elev):
+    '''
+    Composite rotation r_elev@r_azim for azim and elev in degrees.
+    azim and elev can be arrays of the same shape, the 3x3 matrices are
+    stacked along the leading dimensions
+    '''
+    theta_azim = np.pi+np.asarray(azim, dtype=np.float64)/180*np.pi
+    theta_elev = np.asarray(elev, dtype=np.float64)/180*np.pi
+    zeros = np.zeros_like(theta_azim)
+    ones = np.ones_like(theta_azim)
+    r_elev = np.stack([ones,       zeros,          zeros,
+                        zeros, np.cos(theta_elev), -np.sin(theta_elev),
+                        zeros, np.sin(theta_elev), np.cos(theta_elev)], axis=-1)
+    r_azim = np.stack([np.cos(theta_azim), zeros, np.sin(theta_azim),
+                        zeros,               ones,       zeros,
+                        -np.sin(theta_azim),zeros, np.cos(theta_azim)], axis=-1)
+    r_elev = r_elev.reshape(theta_elev.shape+(3,3))
+    r_azim = r_azim.reshape(theta_azim.shape+(3,3))
+    return r_elev@r_azim
+
+def get_view_rotations(meta, hvc_meta, coord_system):
+    '''
+    Composite rotations of all views of a set of objects
+    args:
+        meta: N x seq_len x 2 view metadata (azim, elev)
+        hvc_meta: N x 2 3-DOF VC metadata (azim, elev), only used for 3dvc
+        coord_system: 2dvc or 3dvc
+    returns:
+        N x seq_len x 3 x 3 float32 rotations, None for other coordinate
+        systems
+    '''
+    meta = np.asarray(meta, dtype=np.float64)
+    if coord_system == '2dvc':
+        rotations = get_rotation_matrix(meta[..., 0], meta[..., 1])
+    elif coord_system == '3dvc':
+        hvc_meta = np.asarray(hvc_meta, dtype=np.float64)
+        hvc_rotations = get_rotation_matrix(hvc_meta[:, 0], hvc_meta[:, 1])
+        rotations = get_rotation_matrix(meta[..., 0]-180, meta[..., 1])
+        rotations = rotations@hvc_rotations[:, None]
+    else:
+        return None
+    return rotations.astype(np.float32)
+
 def apply_rotate(input_points, rotate_dict):
-    theta_azim = rotate_dict['azim']
-    theta_elev = rotate_dict['elev']
-    theta_azim = np.pi+theta_azim/180*np.pi
-    theta_elev = theta_elev/180*np.pi
-    r_elev = np.array([[1,       0,          0],
-                        [0, np.cos(theta_elev), -np.sin(theta_elev)],
-                        [0, np.sin(theta_elev), np.cos(theta_elev)]])
-    r_azim = np.array([[np.cos(theta_azim), 0, np.sin(theta_azim)],
-                        [0,               1,       0],
-                        [-np.sin(theta_azim),0, np.cos(theta_azim)]])
-
-    rotated_points = r_elev@r_azim@input_points.T
+    rotation = get_rotation_matrix(rotate_dict['azim'], rotate_dict['elev'])
+    rotated_points = rotation@input_points.T
     return rotated_points.T
 
 def sample_points(input_points, input_occs, num_points):
@@ -148,6 +386,28 @@ def sample_points(input_points, input_occs, num_points):
     selected_occs = input_occs[idx]
     return selected_points, selected_occs
 
+def sample_rows(sample_sdf, num_points):
+    '''
+    Random rows of an array of sdf samples, drawn as in sample_points.
+    Only the selected rows are copied from memory mapped arrays. All rows
+    are copied too, as read-only maps must not back tensors
+    '''
+    if num_points != -1:
+        idx = torch.randint(len(sample_sdf), size=(num_points,)).numpy()
+        return sample_sdf[idx]
+    return np.array(sample_sdf)
+
+def sample_pointcloud(points, normals, num_points):
+    '''
+    Random points and normals of a pointcloud as float32 arrays, drawn as
+    in sample_points. Rows are gathered before any conversion, so only the
+    selected rows are read from memory mapped arrays
+    '''
+    if num_points != -1:
+        idx = torch.randint(len(points), size=(num_points,)).numpy()
+        points, normals = points[idx], normals[idx]
+    return np.array(points, dtype=np.float32), np.array(normals, dtype=np.float32)
+
 def normalize_imagenet(x):
     ''' Normalize input images according to ImageNet standards.
     Args:
@@ -159,15 +419,36 @@ def normalize_imagenet(x):
     x[:, 2] = (x[:, 2] - 0.406) / 0.225
     return x
 
-def LpLoss(logits, sdf, p=1, thres=0.01, weight=4.):
-
-    sdf = Variable(sdf.data, requires_grad=False).cuda()
-    loss = torch.abs(logits-sdf).pow(p).cuda()
-    weight_mask = torch.ones(loss.shape).cuda()
-    weight_mask[torch.abs(sdf) < thres] =\
-             weight_mask[torch.abs(sdf) < thres]*weight 
-    loss = loss * weight_mask
+def get_autocast(device, bf16=False):
+    '''
+    Context running the ops of a forward pass in bfloat16 where autocast
+    allows it (torch>=1.10), no-op if not bf16
+    args:
+        device: device of the forward pass
+        bf16: whether to autocast
+    '''
+    if not bf16:
+        # nullcontext is python>=3.7
+        if hasattr(contextlib, 'nullcontext'):
+            return contextlib.nullcontext()
+        return contextlib.ExitStack()
+    if not hasattr(torch, 'autocast'):
+        raise Exception("bf16 autocast requires torch>=1.10")
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+def LpLoss(logits, sdf, p=1, thres=0.01, weight=4., reduce=True):
+    '''
+    reduce: mean over the batch, the loss of each sample otherwise
+    '''
+    # Loss in float32 for bf16 logits
+    logits = logits.float()
+    sdf = Variable(sdf.data, requires_grad=False).to(logits.device)
+    loss = torch.abs(logits-sdf).pow(p)
+    # Weight samples near the surface
+    loss = torch.where(torch.abs(sdf) < thres, loss*weight, loss)
     loss = torch.sum(loss, dim=-1, keepdim=False)
+    if not reduce:
+        return loss
     loss = torch.mean(loss)
     return loss
 
@@ -330,7 +611,8 @@ def distance_p2p(points_src, normals_src, points_tgt, normals_tgt):
         normals_tgt (numpy array): target normals
     '''
     kdtree = KDTree(points_tgt)
-    dist, idx = kdtree.query(points_src)
+    with threads.kdtree_threads():
+        dist, idx = kdtree.query(points_src)
 
     if normals_src is not None and normals_tgt is not None:
         normals_src = \
@@ -385,9 +667,10 @@ def generate_mesh_sdf(img, model, obj_path, sdf_path, iso=0.003, box_size=1.01,
 
 
 def generate_mesh_mise_sdf(img, points, model, threshold=0.003, box_size=1.7, \
-            resolution=64, upsampling_steps=2):
+            resolution=64, upsampling_steps=2, bf16=False):
     '''
     Generates mesh for sdf representations using MISE algorithm
+    bf16: whether to run the network in bfloat16 autocast
     '''
     model.eval()
 
@@ -398,7 +681,7 @@ def generate_mesh_mise_sdf(img, points, model, threshold=0.003, box_size=1.7, \
     mesh_extractor = MISE(
         resolution0, upsampling_steps, threshold)
     p = mesh_extractor.query()
-    with torch.no_grad():
+    with torch.no_grad(), get_autocast(img.device, bf16):
         feats = model.encoder(img)
     while p.shape[0] != 0:
 
@@ -406,7 +689,7 @@ def generate_mesh_mise_sdf(img, points, model, threshold=0.003, box_size=1.7, \
 
         pq = box_size * (pq - 0.5)
         occ_pred = []
-        with torch.no_grad():
+        with torch.no_grad(), get_autocast(img.device, bf16):
             if pq.shape[0] > 128**3:
 
                 pq = np.array_split(pq, split_size)
@@ -414,14 +697,14 @@ def generate_mesh_mise_sdf(img, points, model, threshold=0.003, box_size=1.7, \
                 for ind in range(split_size):
 
                     occ_pred_split = model.decoder(torch.FloatTensor(pq[ind])\
-                            .cuda().unsqueeze(0), feats)
-                    occ_pred.append(occ_pred_split.cpu().numpy().reshape(-1))
+                            .to(img.device).unsqueeze(0), feats)
+                    occ_pred.append(occ_pred_split.float().cpu().numpy().reshape(-1))
                 occ_pred = np.concatenate(np.asarray(occ_pred),axis=0)
                 values = occ_pred.reshape(-1)
             else:
-                pq = torch.FloatTensor(pq).cuda().unsqueeze(0)
+                pq = torch.FloatTensor(pq).to(img.device).unsqueeze(0)
                 occ_pred = model.decoder(pq, feats)
-                values = occ_pred.squeeze(0).detach().cpu().numpy()
+                values = occ_pred.squeeze(0).detach().float().cpu().numpy()
         values = values.astype(np.float64)
         mesh_extractor.update(p, values)
 
@@ -0,0 +1,125 @@
+########### Report resident memory of DataLoader workers over a pass
+import torch
+import numpy as np
+import argparse
+import gc
+import multiprocessing
+import config_shape as config
+import utils_shape as utils
+from dataloader_shape import Dataset
+from dataloader_packed import Dataset as Dataset_Packed
+
+parser = argparse.ArgumentParser(description="Per worker memory report")
+parser.add_argument("--mode", default='train', type=str,
+                    help="Split to load")
+parser.add_argument("--num_workers", default=12, type=int,
+                    help="Number of loader workers")
+parser.add_argument("--num_batches", default=None, type=int,
+                    help="Number of batches to load, default a full pass")
+parser.add_argument("--layout", default='both', type=str,
+                    choices=['compact', 'lists', 'both'],
+                    help="Path tables of the Dataset: compact arrays, python lists "
+                    "of strings as before compact tables, or both one after the other")
+
+# Path tables of dataloader_shape.Dataset
+PATH_TABLES = ['img_paths', 'sdf_h5_paths', 'pointcld_split_paths', \
+    'metadata_split_paths', 'hvc_metadata_split_paths']
+VIEW_TABLES = ['image_split_paths', 'depth_split_paths', 'normal_split_paths', \
+    'seg_split_paths']
+
+def get_workers_memory():
+    '''
+    Memory of all live child processes, keyed by pid
+    '''
+    memory = {}
+    for child in multiprocessing.active_children():
+        try:
+            memory[child.pid] = utils.get_process_memory(child.pid)
+        except OSError:
+            continue
+    return memory
+
+def use_list_tables(dataset):
+    '''
+    Replace the compact path tables of a Dataset by python lists of
+    strings, the layout before compact tables, as a baseline
+    '''
+    dataset.obj_cat_map = list(dataset.obj_cat_map)
+    for name in PATH_TABLES:
+        if getattr(dataset, name, None) is not None:
+            setattr(dataset, name, list(getattr(dataset, name)))
+    for name in VIEW_TABLES:
+        table = getattr(dataset, name, None)
+        if table is not None:
+            setattr(dataset, name, [table[i] for i in range(len(table))])
+
+def measure(args, layout):
+    '''
+    Memory of the workers at the first and last batch of a pass
+    returns:
+        dicts of memory per worker pid at start and end, None if the
+        loader has no batches
+    '''
+    if config.path['packed_dataset_path'] is not None:
+        dataset_cls = Dataset_Packed
+    else:
+        dataset_cls = Dataset
+    dataset = dataset_cls(config, num_points=config.training['num_points'], \
+        mode=args.mode, coord_system=config.training['coord_system'])
+    if layout == 'lists':
+        use_list_tables(dataset)
+    classes = list(dataset.class_names)
+    dataset.update_class_map({cls: i for i, cls in enumerate(classes)})
+    dataset.activate_classes(classes)
+    # As in train_shape.py
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    print('Main process (%s tables): %s'%(layout, utils.get_process_memory()))
+
+    loader = torch.utils.data.DataLoader(dataset, \
+        batch_size=config.training['batch_size'], num_workers=args.num_workers, \
+        shuffle=True)
+    num_batches = len(loader) if args.num_batches is None \
+        else min(args.num_batches, len(loader))
+    if num_batches == 0:
+        return None, None
+    start, end = None, None
+    for i, _ in enumerate(loader):
+        if i == 0:
+            start = get_workers_memory()
+        if i == num_batches-1:
+            end = get_workers_memory()
+            break
+    if hasattr(gc, 'unfreeze'):
+        gc.unfreeze()
+    return start, end
+
+def main():
+    args = parser.parse_args()
+    layouts = ['lists', 'compact'] if args.layout == 'both' else [args.layout]
+    mb = 1024.*1024.
+    growths = {}
+    for layout in layouts:
+        start, end = measure(args, layout)
+        if start is None:
+            print('No batches to load in %s, nothing to report'%(args.mode))
+            return
+        print('%8s %8s %12s %12s %12s %12s'%('tables', 'pid', 'rss start', 'rss end', \
+            'priv start', 'priv end'))
+        for pid in sorted(start.keys()):
+            if pid not in end:
+                continue
+            print('%8s %8s %10.1fMB %10.1fMB %10.1fMB %10.1fMB'%(layout, pid, \
+                start[pid]['rss']/mb, end[pid]['rss']/mb, \
+                start[pid]['private']/mb, end[pid]['private']/mb))
+        growths[layout] = [end[pid]['private']-start[pid]['private'] \
+            for pid in start if pid in end]
+    for layout in layouts:
+        if len(growths[layout]) == 0:
+            print('%s tables: no worker was alive at both batches'%(layout))
+            continue
+        print('%s tables: mean private growth per worker %.1fMB'\
+            %(layout, np.mean(growths[layout])/mb))
+
+if __name__ == '__main__':
+    main()